@@ -35,7 +35,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const posts = document.querySelectorAll('.isu-post');
     const lastEl = posts[posts.length-1];
     const maxCreatedAt = lastEl.dataset.createdAt;
-    fetch(`/posts?max_created_at=${encodeURIComponent(maxCreatedAt)}`, {
+    const maxId = lastEl.getAttribute('id').replace('pid_', '');
+    fetch(`/posts?max_created_at=${encodeURIComponent(maxCreatedAt)}&max_id=${encodeURIComponent(maxId)}`, {
       method: 'GET',
     }).then(response => {
       if (!response.ok) {
@@ -4,79 +4,459 @@ import pathlib
 import re
 import shlex
 import hashlib
-import tempfile
 import json
 import base64
 import logging
-
+import threading
+import time
+import collections
+import bisect
+import concurrent.futures
+import functools
+import gzip
+
+import click
 import flask
+import msgspec
+import werkzeug.security
 import MySQLdb.cursors
 from flask_session import Session
-from jinja2 import pass_eval_context
 from markupsafe import Markup, escape
-from pymemcache.client.base import Client as MemcacheClient
-
-UPLOAD_LIMIT = 10 * 1024 * 1024  # 10mb
-POSTS_PER_PAGE = 20
-
-
-_config = None
-
-
-def config():
-    global _config
-    if _config is None:
-        _config = {
-            "db": {
-                "host": os.environ.get("ISUCONP_DB_HOST", "localhost"),
-                "port": int(os.environ.get("ISUCONP_DB_PORT", "3306")),
-                "user": os.environ.get("ISUCONP_DB_USER", "root"),
-                "db": os.environ.get("ISUCONP_DB_NAME", "isuconp"),
-            },
-            "memcache": {
-                "address": os.environ.get(
-                    "ISUCONP_MEMCACHED_ADDRESS", "127.0.0.1:11211"
-                ),
-            },
-            'otel': {
-                'endpoint': os.getenv('OTEL_ENDPOINT', '18.183.232.7:4317'),
-                'insecure': True,
-                'export_interval_millis': int(os.getenv('OTEL_EXPORT_INTERVAL_MS', '5000')),
-            },
+from pymemcache.client.base import PooledClient as MemcacheClient
+
+# app_async.pyと共有するもの。app.Xとしても参照できるようにここでimportしておく
+from common import (
+    IMMUTABLE_CACHE_CONTROL,
+    INVALIDATION_KEY_PREFIX,
+    POSTS_PER_PAGE,
+    STATIC_CACHE_CONTROL,
+    UPLOAD_LIMIT,
+    WARMUP_STATUS_KEY,
+    _ADD_BODY_HTML_SQL,
+    _BODY_HTML_PENDING_SQL,
+    _BODY_HTML_PROBE_SQL,
+    _COUNTER_KEYS,
+    _COUNTER_SOURCES,
+    _INCR_COMMENT_COUNTER_SQLS,
+    _INCR_POST_COUNTER_SQL,
+    _INITIALIZE_SQLS,
+    _MIME_BY_EXT,
+    _POST_GENERATION_KEY,
+    _POST_IMAGES_SCHEMA,
+    _TIMELINE_COLUMNS,
+    _USER_SNAPSHOT_FIELDS,
+    ImageUploadStream,
+    _parse_iso8601,
+    _post_cache_key,
+    _write_file_atomic,
+    asset_url,
+    assets,
+    body_html,
+    body_html_update,
+    calculate_passhash,
+    config,
+    counter_rebuild_sqls,
+    image_blob_path,
+    image_created_at,
+    image_etag,
+    image_ext,
+    image_file_validators,
+    image_path,
+    image_url,
+    is_not_modified,
+    link_image_file,
+    nl2br,
+    page_cache_key,
+    page_purge_key,
+    render_body,
+    set_validators,
+    static_path,
+    store_image_blob,
+    timeline_page_query,
+    validate_user,
+    write_image_file,
+)
+
+
+def db_connect():
+    driver = config()["db_driver"]
+    if driver["name"] == "connector":
+        # 実体はdb_connector.py。MySQLdbのDictCursorと同じように使える接続を返す
+        import db_connector
+
+        return db_connector.connect(config()["db"], driver["statement_cache"])
+    if driver["name"] != "mysqldb":
+        raise RuntimeError(f"unknown db driver: {driver['name']}")
+
+    conf = config()["db"].copy()
+    conf["charset"] = "utf8mb4"
+    conf["cursorclass"] = MySQLdb.cursors.DictCursor
+    conf["autocommit"] = True
+    return MySQLdb.connect(**conf)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """スレッドセーフなMySQL接続プール
+
+    gthreadワーカーで同時に処理されるリクエストがそれぞれ別の接続を使えるようにする。
+    アイドル接続はチェックアウト時にpingで死活確認し、切れていれば張り直す。
+    """
+
+    def __init__(self, connect, min_size, max_size, timeout, health_check_interval, name="default"):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.name = name
+        self._cond = threading.Condition()
+        self._idle = collections.deque()  # (conn, 最後に返却された時刻)
+        self._size = 0
+        self.in_use = 0
+
+        meter = otel_meter()
+        self._attrs = {"pool": name}
+        self._wait_hist = meter.create_histogram(
+            "db.pool.wait_time", unit="ms", description="接続のチェックアウト待ち時間"
+        )
+        self._in_use_counter = meter.create_up_down_counter(
+            "db.pool.in_use", description="使用中の接続数"
+        )
+        self._timeout_counter = meter.create_counter(
+            "db.pool.timeouts", description="チェックアウトのタイムアウト回数"
+        )
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # 接続はロックの外で張る
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeout_counter.add(1, self._attrs)
+                    raise PoolTimeout(f"db pool '{self.name}': no connection within {self.timeout}s")
+                self._cond.wait(remaining)
+            self.in_use += 1
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.monotonic() - released_at >= self.health_check_interval:
+                conn = self._check(conn)
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+
+        self._wait_hist.record((time.monotonic() - start) * 1000, self._attrs)
+        self._in_use_counter.add(1, self._attrs)
+        return conn
+
+    def release(self, conn, broken=False):
+        if broken:
+            conn = self._check(conn, reconnect=False)
+        with self._cond:
+            self.in_use -= 1
+            if conn is None:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        self._in_use_counter.add(-1, self._attrs)
+
+    def _check(self, conn, reconnect=True):
+        try:
+            conn.ping()
+            return conn
+        except MySQLdb.Error:
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
+        return self._connect() if reconnect else None
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "max_size": self.max_size,
+            }
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_local = threading.local()
+
+
+def db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                conf = config()["db_pool"]
+                _db_pool = ConnectionPool(
+                    db_connect,
+                    min_size=conf["min_size"],
+                    max_size=conf["max_size"],
+                    timeout=conf["timeout"],
+                    health_check_interval=conf["health_check_interval"],
+                )
+    return _db_pool
+
+
+def db():
+    """リクエスト中はプールから借りた接続を返し、teardownで返却する
+
+    リクエスト外（CLIやバックグラウンドスレッド）ではスレッドごとに1本借りたままにする。
+    """
+    if flask.has_app_context():
+        conn = flask.g.get("_db")
+        if conn is None:
+            conn = flask.g._db = db_pool().acquire()
+        stats = flask.g.get("_query_stats")
+        if stats is not None:
+            return ProfiledConnection(conn, stats)
+        return conn
+
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = db_pool().acquire()
+    return conn
+
+
+# クエリの集計
+# query_statsが有効なとき、リクエスト中のdb()はProfiledConnectionを返し、
+# そのカーソルで発行したクエリの件数・時間・取得した行数とバイト数をQueryStatsに積む
+def _row_bytes(row):
+    n = 0
+    for v in row.values():
+        n += len(v) if isinstance(v, (bytes, str)) else 8
+    return n
+
+
+class QueryStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.shapes = collections.Counter()  # 空白を詰めたクエリ文字列 -> 回数
+        self.explains = []
+
+    def add_rows(self, rows):
+        self.rows += len(rows)
+        self.bytes += sum(_row_bytes(row) for row in rows)
+
+    def repeated(self):
+        """repeat_threshold回以上発行された同じ形のクエリ"""
+        threshold = config()["query_stats"]["repeat_threshold"]
+        return {shape: n for shape, n in self.shapes.items() if n >= threshold}
+
+    def summary(self):
+        return {
+            "queries": self.queries,
+            "db_ms": round(self.db_time * 1000, 3),
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "repeated": self.repeated(),
+            "explains": self.explains,
         }
-        password = os.environ.get("ISUCONP_DB_PASSWORD")
-        if password:
-            _config["db"]["passwd"] = password
-    return _config
 
+    def header(self):
+        return (
+            f"queries={self.queries}; db_ms={self.db_time * 1000:.3f}; rows={self.rows};"
+            f" bytes={self.bytes}; repeated={len(self.repeated())}"
+        )
 
-_db = None
 
+class ProfiledCursor:
+    def __init__(self, conn, cursor, stats):
+        self._conn = conn
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, query, args=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self._stats
+            stats.queries += 1
+            stats.db_time += elapsed
+            stats.shapes[" ".join(query.split())] += 1
+            explain_ms = config()["query_stats"]["explain_ms"]
+            if explain_ms and elapsed * 1000 >= explain_ms and query.lstrip()[:6].upper() == "SELECT":
+                self._explain(query, args, elapsed)
+
+    def _explain(self, query, args, elapsed):
+        # EXPLAINは集計に含めない
+        cur = self._conn.cursor()
+        try:
+            cur.execute("EXPLAIN " + query, args)
+            plan = list(cur.fetchall())
+        except MySQLdb.Error as e:
+            plan = str(e)
+        self._stats.explains.append(
+            {"query": " ".join(query.split()), "ms": round(elapsed * 1000, 3), "plan": plan}
+        )
 
-def db():
-    global _db
-    if _db is None:
-        conf = config()["db"].copy()
-        conf["charset"] = "utf8mb4"
-        conf["cursorclass"] = MySQLdb.cursors.DictCursor
-        conf["autocommit"] = True
-        _db = MySQLdb.connect(**conf)
-    return _db
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.add_rows([row])
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._stats.add_rows(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.add_rows(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._stats.add_rows([row])
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ProfiledConnection:
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def cursor(self, *args):
+        return ProfiledCursor(self._conn, self._conn.cursor(*args), self._stats)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+_query_history = None
+
+
+def query_history():
+    """/debug/queriesに出す直近のリクエストの集計"""
+    global _query_history
+    if _query_history is None:
+        _query_history = collections.deque(maxlen=config()["query_stats"]["history"])
+    return _query_history
 
 
 def db_initialize():
     cur = db().cursor()
-    sqls = [
-        "DELETE FROM users WHERE id > 1000",
-        "DELETE FROM posts WHERE id > 10000",
-        "DELETE FROM comments WHERE id > 100000",
-        "UPDATE users SET del_flg = 0",
-        "UPDATE users SET del_flg = 1 WHERE id % 50 = 0",
-    ]
-    for q in sqls:
+    for q in _INITIALIZE_SQLS:
+        cur.execute(q)
+    ensure_body_html_column()
+    backfill_body_html()
+    invalidate_user_cache()
+    reset_banned_user_ids()
+    rebuild_counters()
+
+
+# 非正規化したカウンタ
+# user_stats: ユーザーごとの投稿数・コメント数・被コメント数
+# post_stats: 投稿ごとのコメント数
+# post_index / post_commentで書き込み時に更新し、/initializeで一括再構築する
+
+
+def rebuild_counters():
+    cur = db().cursor()
+    for q in counter_rebuild_sqls():
         cur.execute(q)
 
 
+def check_counters(repair=False):
+    """カウンタと実データを突き合わせ、ずれている (table, column, key, 保存値, 正しい値) を返す"""
+    cur = db().cursor()
+    mismatches = []
+    for (table, column), source in _COUNTER_SOURCES.items():
+        key = _COUNTER_KEYS[table]
+        cur.execute(source)
+        expected = {row["k"]: row["v"] for row in cur.fetchall()}
+        cur.execute(f"SELECT `{key}` AS k, `{column}` AS v FROM `{table}`")
+        stored = {row["k"]: row["v"] for row in cur.fetchall()}
+        for k in expected.keys() | stored.keys():
+            if expected.get(k, 0) != stored.get(k, 0):
+                mismatches.append((table, column, k, stored.get(k, 0), expected.get(k, 0)))
+
+    if repair:
+        for table, column, k, _, value in mismatches:
+            key = _COUNTER_KEYS[table]
+            cur.execute(
+                f"INSERT INTO `{table}` (`{key}`, `{column}`) VALUES (%s, %s)"
+                f" ON DUPLICATE KEY UPDATE `{column}` = VALUES(`{column}`)",
+                (k, value),
+            )
+    return mismatches
+
+
+def incr_post_counter(user_id):
+    db().cursor().execute(_INCR_POST_COUNTER_SQL, {"user_id": user_id})
+
+
+def incr_comment_counters(post_id, user_id):
+    cur = db().cursor()
+    for q in _INCR_COMMENT_COUNTER_SQLS:
+        cur.execute(q, {"post_id": post_id, "user_id": user_id})
+
+
+# 投稿本文のHTML
+# 本文は投稿後に変わらないので、投稿時にrender_bodyで作ってposts.body_htmlに保存し、表示ではそのまま出す。
+# 初期データの投稿は/initializeでbody_htmlが空のものだけまとめて埋める
+
+
+def ensure_body_html_column():
+    cur = db().cursor()
+    try:
+        cur.execute(_BODY_HTML_PROBE_SQL)
+    except MySQLdb.OperationalError:
+        cur.execute(_ADD_BODY_HTML_SQL)
+
+
+def backfill_body_html(batch_size=500, progress=None):
+    """body_htmlが空の投稿をid順にbatch_size件ずつ埋め、埋めた件数を返す"""
+    cur = db().cursor()
+    last_id = 0
+    filled = 0
+    while True:
+        cur.execute(_BODY_HTML_PENDING_SQL, (last_id, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        cur.execute(*body_html_update(rows))
+        last_id = rows[-1]["id"]
+        filled += len(rows)
+        if progress:
+            progress(last_id, filled)
+    return filled
+
+
 _mcclient = None
 
 
@@ -84,6 +464,7 @@ def memcache():
     global _mcclient
     if _mcclient is None:
         conf = config()["memcache"]
+        # gthreadワーカーでも安全に使えるようスレッドセーフなPooledClientを使う
         _mcclient = MemcacheClient(
             conf["address"], 
             no_delay=True, 
@@ -92,43 +473,153 @@ def memcache():
     return _mcclient
 
 
-from opentelemetry import trace, metrics
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.mysql import MySQLInstrumentor
+# 無効化バス
+# プロセス内キャッシュ（ユーザー・タイムライン・フラグメント）の無効化を全ワーカー・全ホストへ伝える。
+# 名前空間ごとの世代番号をmemcachedに置き、変更した側がbumpで進める。
+# 各プロセスはリクエストの最初（またはget_manyのついで）に世代番号を読み、動いていればハンドラで手元を捨てる
+#   global:    /initialize。すべて
+#   users:     BAN。ユーザーキャッシュ・BAN済みid・フラグメント
+#   timeline:  投稿。ほかのプロセスが追加した投稿をタイムラインに取り込む
+#   post:<id>: コメント。その投稿のフラグメント
+class InvalidationBus:
+    key_prefix = INVALIDATION_KEY_PREFIX
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._seen = {}  # 名前空間 -> 最後に見た世代番号（str）
+        self._handlers = []  # (名前空間または "xxx:" で終わるprefix, handler(namespace))
+        self._checked_at = 0.0
+
+    def on(self, pattern, handler):
+        self._handlers.append((pattern, handler))
+
+    def key(self, namespace):
+        return self.key_prefix + namespace
+
+    def generation(self, namespace):
+        return self._seen.get(namespace)
+
+    def bump(self, *namespaces):
+        """世代番号を進める。自分のプロセスの手元は呼び出し側で直接無効化しておくこと"""
+        for namespace in namespaces:
+            key = self.key(namespace)
+            generation = memcache().incr(key, 1)
+            if generation is None:
+                # 初回。同時に作ろうとしたプロセスがいればaddに負けるのでincrし直す
+                generation = 1 if memcache().add(key, "1", noreply=False) else memcache().incr(key, 1)
+            # 手元がひとつ前の世代（世代1を作ったときは世代なし）のときだけ追いつき、自分のbumpでハンドラを呼ばない。
+            # 間にほかのプロセスのbumpが挟まっていたら、ここで進めるとそのハンドラが呼ばれなくなるので次のcheckに任せる
+            previous = str(generation - 1) if generation > 1 else None
+            with self._lock:
+                if self._seen.get(namespace) == previous:
+                    self._seen[namespace] = str(generation)
+
+    def observe(self, values):
+        """名前空間 -> memcachedの値（bytesかNone）を受け取り、世代が動いたもののハンドラを呼ぶ"""
+        moved = []
+        with self._lock:
+            for namespace, value in values.items():
+                generation = value.decode() if value is not None else None
+                if self._seen.get(namespace) != generation:
+                    self._seen[namespace] = generation
+                    moved.append(namespace)
+        for namespace in moved:
+            for pattern, handler in self._handlers:
+                if namespace == pattern or (pattern.endswith(":") and namespace.startswith(pattern)):
+                    handler(namespace)
+
+    def check(self, namespaces):
+        """namespacesの世代番号を1回のget_manyで読む。intervalが設定されていればその間は読まない"""
+        if self.interval:
+            now = time.monotonic()
+            if now - self._checked_at < self.interval:
+                return
+            self._checked_at = now
+        keys = {self.key(namespace): namespace for namespace in namespaces}
+        values = memcache().get_many(list(keys))
+        self.observe({namespace: values.get(key) for key, namespace in keys.items()})
+
+
+def _drop_all_local_caches(namespace):
+    invalidate_user_cache()
+    reset_banned_user_ids()
+    reset_timeline()
+    invalidate_fragments()
+    # ほかのワーカーの/initializeを見たとき。このワーカーの手元のキャッシュも温め直す
+    if config()["warmup"]["enabled"]:
+        start_warmup(local=True)
+
+
+def _drop_user_caches(namespace):
+    invalidate_user_cache()
+    reset_banned_user_ids()
+    invalidate_fragments()
+
+
+def _refresh_timeline(namespace):
+    if _timeline is not None:
+        _timeline.refresh()
+
+
+def _drop_post_fragments(namespace):
+    invalidate_fragments(int(namespace.split(":", 1)[1]))
+
+
+_invalidation = None
+
+
+def invalidation():
+    global _invalidation
+    if _invalidation is None:
+        bus = InvalidationBus(interval=config()["invalidation"]["interval_ms"] / 1000)
+        bus.on("global", _drop_all_local_caches)
+        bus.on("users", _drop_user_caches)
+        bus.on("timeline", _refresh_timeline)
+        bus.on("post:", _drop_post_fragments)
+        _invalidation = bus
+    return _invalidation
+
+
+# テレメトリ
+# 実体はtelemetry.pyにあり、offのときはOTelを一切importしない
+class _NoopInstrument:
+    def add(self, amount, attributes=None):
+        pass
+
+    def record(self, amount, attributes=None):
+        pass
 
-def otel_setup(app):
-    resource = Resource.create({"service.name": "isuconp"})
-    tracer_provider = TracerProvider(resource=resource)
-    tracer_provider.add_span_processor(
-        BatchSpanProcessor(
-            OTLPSpanExporter(
-                endpoint=config()['otel']['endpoint'],
-                insecure=config()['otel']['insecure'],
-            )
-        )
-    )
-    trace.set_tracer_provider(tracer_provider)
 
-    metric_exporter = OTLPMetricExporter(
-        endpoint=config()['otel']['endpoint'],
-        insecure=config()['otel']['insecure'],
-    )
-    reader = PeriodicExportingMetricReader(
-        metric_exporter,
-        export_interval_millis=config()['otel']['export_interval_millis']
-    )
-    meter_provider = MeterProvider(metric_readers=[reader], resource=resource)
-    metrics.set_meter_provider(meter_provider)
+class _NoopMeter:
+    def create_histogram(self, name, unit="", description=""):
+        return _NoopInstrument()
+
+    create_counter = create_histogram
+    create_up_down_counter = create_histogram
+
+
+_otel_meter = None
+
+
+def otel_meter():
+    global _otel_meter
+    if _otel_meter is None:
+        if config()['otel']['mode'] == 'off':
+            _otel_meter = _NoopMeter()
+        else:
+            from opentelemetry import metrics
 
-    FlaskInstrumentor().instrument_app(app)
-    MySQLInstrumentor().instrument()
+            _otel_meter = metrics.get_meter("isuconp")
+    return _otel_meter
+
+
+def otel_setup(app):
+    if config()['otel']['mode'] == 'off':
+        return
+    import telemetry
+
+    telemetry.setup(app, config()['otel'])
 
 def log_setup(app):
     handler = logging.StreamHandler()
@@ -138,14 +629,344 @@ def log_setup(app):
     app.logger.addHandler(handler)
     app.logger.setLevel(logging.DEBUG)
 
-def try_login(account_name, password):
+# ユーザーキャッシュ
+# usersテーブルは小さく、変更はpost_register / post_banned / db_initializeのみなので
+# idとaccount_nameの両方をキーにしてプロセス内に保持する。変更時は明示的に無効化する。
+_user_cache_by_id = {}
+_user_cache_by_name = {}
+# ユーザーキャッシュとBAN済みidの無効化のたびに進む。DBから読む前の値と比べ、
+# 読んでいる間に無効化（BANなど）が走っていたら読んだ行をキャッシュに書き戻さない
+_user_cache_lock = threading.Lock()
+_user_cache_epoch = 0
+_banned_user_ids_epoch = 0
+
+
+def _cache_users(users, epoch):
+    with _user_cache_lock:
+        if epoch != _user_cache_epoch:
+            return
+        for user in users:
+            _user_cache_by_id[user["id"]] = user
+            _user_cache_by_name[user["account_name"]] = user
+
+
+def users_version():
+    """BANなどでユーザー情報が変わるたびに進む。セッションに持たせたスナップショットはこれと比べて使う
+
+    無効化バスのusersの世代番号なので、どのワーカー・ホストでも同じ値になる。
+    """
+    return invalidation().generation("users")
+
+
+def invalidate_user_cache(user_ids=None):
+    """user_idsを省略した場合はキャッシュ全体を破棄する"""
+    global _user_cache_epoch
+    with _user_cache_lock:
+        _user_cache_epoch += 1
+        if user_ids is None:
+            _user_cache_by_id.clear()
+            _user_cache_by_name.clear()
+            return
+        for user_id in user_ids:
+            user = _user_cache_by_id.pop(user_id, None)
+            if user:
+                _user_cache_by_name.pop(user["account_name"], None)
+
+
+# BANされたユーザーのid。タイムラインを読むときにLIMITの前で除外するために使う
+_banned_user_ids = None
+_banned_user_ids_lock = threading.Lock()
+
+
+def banned_user_ids():
+    global _banned_user_ids
+    banned = _banned_user_ids
+    if banned is None:
+        # 読み込みは1スレッドだけ。_user_cache_lockはDBを待つ間は持たない
+        with _banned_user_ids_lock:
+            banned = _banned_user_ids
+            if banned is None:
+                epoch = _banned_user_ids_epoch
+                cur = db().cursor()
+                cur.execute("SELECT `id` FROM `users` WHERE `del_flg` = 1")
+                banned = frozenset(row["id"] for row in cur.fetchall())
+                with _user_cache_lock:
+                    if epoch == _banned_user_ids_epoch:
+                        _banned_user_ids = banned
+    return banned
+
+
+def add_banned_user_ids(user_ids):
+    global _banned_user_ids, _banned_user_ids_epoch
+    with _user_cache_lock:
+        # 読み込み中の集合はBAN前の可能性があるので、未読み込みでも世代は進める
+        _banned_user_ids_epoch += 1
+        if _banned_user_ids is not None:
+            _banned_user_ids = _banned_user_ids | set(user_ids)
+
+
+def reset_banned_user_ids():
+    global _banned_user_ids, _banned_user_ids_epoch
+    with _user_cache_lock:
+        _banned_user_ids_epoch += 1
+        _banned_user_ids = None
+
+
+def get_users(user_ids):
+    """id -> userのdictを返す。キャッシュにないものだけまとめてDBから取得する"""
+    users = {}
+    missing = []
+    for user_id in user_ids:
+        user = _user_cache_by_id.get(user_id)
+        if user is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = user
+
+    if missing:
+        epoch = _user_cache_epoch
+        cur = db().cursor()
+        cur.execute("SELECT * FROM `users` WHERE `id` IN %s", (missing,))
+        rows = cur.fetchall()
+        _cache_users(rows, epoch)
+        for user in rows:
+            users[user["id"]] = user
+    return users
+
+
+def get_user(user_id):
+    return get_users([user_id]).get(user_id)
+
+
+def get_user_by_account_name(account_name):
+    user = _user_cache_by_name.get(account_name)
+    if user is None:
+        epoch = _user_cache_epoch
+        cur = db().cursor()
+        cur.execute("SELECT * FROM `users` WHERE `account_name` = %s", (account_name,))
+        user = cur.fetchone()
+        if user:
+            _cache_users([user], epoch)
+    return user
+
+
+def migrate_image_blobs(batch_size=200, drop_blobs=False, start_id=0, pause=0.0, progress=None):
+    """posts.imgdataを画像ストアへ移し、post_imagesに参照を記録する
+
+    アプリを動かしたまま実行できるよう、idの範囲ごとに小さなバッチで進める。
+    読み出し側は post_images → posts.imgdata の順に見るので、途中の状態でも画像は返せる。
+    drop_blobs=Trueなら移行済みの行のimgdataを空にする（容量の回収にはOPTIMIZE TABLEが別途必要）。
+    空にするのはobjects/にblobがあると確かめた行だけ。空にした後はblobが唯一のコピーになるので、
+    画像ディレクトリを失うとその投稿の画像は404になる。
+    """
+    stats = {"migrated": 0, "dropped": 0, "last_id": start_id}
+    conn = db_connect()
+    try:
+        cur = conn.cursor()
+        while True:
+            cur.execute(
+                "SELECT p.`id`, i.`post_id` AS ref FROM `posts` p"
+                " LEFT JOIN `post_images` i ON i.`post_id` = p.`id`"
+                " WHERE p.`id` > %s ORDER BY p.`id` LIMIT %s",
+                (stats["last_id"], batch_size),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            missing = [row["id"] for row in rows if row["ref"] is None]
+            if missing:
+                refs = []
+                ss = conn.cursor(MySQLdb.cursors.SSDictCursor)
+                ss.execute("SELECT `id`, `imgdata` FROM `posts` WHERE `id` IN %s", (missing,))
+                for row in ss:
+                    refs.append((row["id"], store_image_blob(row["imgdata"]), len(row["imgdata"])))
+                ss.close()
+                cur.executemany(
+                    "INSERT IGNORE INTO `post_images` (`post_id`, `sha256`, `size`) VALUES (%s, %s, %s)",
+                    refs,
+                )
+                stats["migrated"] += len(refs)
+
+            if drop_blobs:
+                cur.execute(
+                    "SELECT p.`id`, i.`sha256` FROM `posts` p JOIN `post_images` i ON i.`post_id` = p.`id`"
+                    " WHERE p.`id` BETWEEN %s AND %s AND p.`imgdata` != ''",
+                    (rows[0]["id"], rows[-1]["id"]),
+                )
+                stored = [row["id"] for row in cur.fetchall() if os.path.exists(image_blob_path(row["sha256"]))]
+                if stored:
+                    cur.execute("UPDATE `posts` SET `imgdata` = '' WHERE `id` IN %s", (stored,))
+                    stats["dropped"] += cur.rowcount
+
+            stats["last_id"] = rows[-1]["id"]
+            if progress:
+                progress(stats)
+            if pause:
+                time.sleep(pause)
+    finally:
+        conn.close()
+    return stats
+
+
+class Request(flask.Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return ImageUploadStream(UPLOAD_LIMIT)
+
+
+def gc_image_blobs():
+    """post_imagesから参照されなくなったblobと、残った一時ファイルを消す"""
     cur = db().cursor()
-    cur.execute(
-        "SELECT * FROM users WHERE account_name = %s AND del_flg = 0", (account_name,)
-    )
-    user = cur.fetchone()
+    cur.execute("SELECT DISTINCT `sha256` FROM `post_images`")
+    referenced = {row["sha256"] for row in cur.fetchall()}
+    image_dir = config()["image"]["dir"]
+    removed = 0
+    for root, _, filenames in os.walk(os.path.join(image_dir, "objects")):
+        for filename in filenames:
+            if filename not in referenced:
+                os.remove(os.path.join(root, filename))
+                removed += 1
+    tmp_dir = os.path.join(image_dir, "tmp")
+    if os.path.isdir(tmp_dir):
+        for filename in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, filename))
+    return removed
+
+
+def cacheable_response(resp, etag, cache_control, complete_length, last_modified=None):
+    """バリデータを付け、Rangeがあれば206にする"""
+    set_validators(resp, etag, cache_control, last_modified)
+    return resp.make_conditional(flask.request, accept_ranges=True, complete_length=complete_length)
+
+
+def nginx_asset_locations(store, cache_control=STATIC_CACHE_CONTROL):
+    """storeの各ファイルをnginxが直接返すためのlocationを返す。.gzはgzip_staticで使う"""
+    lines = ["# flask --app app build-assets で生成。手で編集しない"]
+    for name, _ in sorted(store.items()):
+        lines += [
+            f"location = /{name} {{",
+            "  gzip_static on;",
+            "  gzip_vary on;",
+            f'  add_header Cache-Control "{cache_control}";',
+            "}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def image_response(pid, ext, mime, etag, last_modified):
+    accel_prefix = config()["image"]["accel_prefix"]
+    if accel_prefix:
+        # Rangeはリダイレクト先でnginxが処理する
+        resp = flask.Response(mimetype=mime)
+        resp.headers["X-Accel-Redirect"] = f"{accel_prefix}{pid}{ext}"
+        return set_validators(resp, etag, IMMUTABLE_CACHE_CONTROL, last_modified)
+    resp = flask.send_file(image_path(pid, ext), mimetype=mime, conditional=False, etag=False)
+    return cacheable_response(resp, etag, IMMUTABLE_CACHE_CONTROL, resp.content_length, last_modified)
+
+
+def image_not_modified(etag, last_modified):
+    return set_validators(flask.Response(status=304), etag, IMMUTABLE_CACHE_CONTROL, last_modified)
+
+
+def export_images_bulk(
+    image_dir=None,
+    batch_size=500,
+    workers=4,
+    start_id=0,
+    progress=None,
+    newest_first=False,
+    max_posts=None,
+    stop=None,
+):
+    """DBの画像をまとめてファイルに書き出す
+
+    idの範囲ごとに、まだファイルがない投稿だけをサーバーサイドカーソルで1行ずつ読み、
+    スレッドプールで書き出す。書き出し待ちの行数に上限を設けているので、
+    画像の枚数によらずメモリ使用量は一定。既存のファイルは飛ばすので、途中で止めても
+    再実行（またはstart_id指定）で続きから再開できる。
+    newest_firstならidの大きい方から進む。max_posts件見るか、stop（Event）がセットされたら止める。
+    """
+    image_dir = image_dir or config()["image"]["dir"]
+    os.makedirs(image_dir, exist_ok=True)
+    if newest_first:
+        query = "SELECT `id`, `mime` FROM `posts` WHERE `id` < %s ORDER BY `id` DESC LIMIT %s"
+        start_id = start_id or 2**31
+    else:
+        query = "SELECT `id`, `mime` FROM `posts` WHERE `id` > %s ORDER BY `id` LIMIT %s"
+    stats = {"exported": 0, "skipped": 0, "last_id": start_id}
+    seen = 0
+    pending = threading.BoundedSemaphore(workers * 2)
+
+    def write(pid, ext, imgdata):
+        try:
+            write_image_file(pid, ext, imgdata, image_dir)
+        finally:
+            pending.release()
+
+    # サーバーサイドカーソルは読み切るまで接続を占有するので専用の接続を使う
+    conn = db_connect()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while stop is None or not stop.is_set():
+                limit = batch_size if max_posts is None else min(batch_size, max_posts - seen)
+                if limit <= 0:
+                    break
+                cur = conn.cursor()
+                cur.execute(query, (stats["last_id"], limit))
+                headers = cur.fetchall()
+                if not headers:
+                    break
+                seen += len(headers)
+
+                missing = [
+                    h["id"] for h in headers
+                    if image_ext(h["mime"])
+                    and not os.path.exists(image_path(h["id"], image_ext(h["mime"]), image_dir))
+                ]
+                stats["skipped"] += len(headers) - len(missing)
+
+                futures = []
+                if missing:
+                    # アップロード画像はblobへのリンクを張るだけ
+                    cur.execute(
+                        "SELECT `post_id`, `sha256` FROM `post_images` WHERE `post_id` IN %s",
+                        (missing,),
+                    )
+                    refs = {row["post_id"]: row["sha256"] for row in cur.fetchall()}
+                    for h in headers:
+                        if h["id"] in refs:
+                            link_image_file(h["id"], image_ext(h["mime"]), refs[h["id"]], image_dir)
+                    stats["exported"] += len(refs)
+                    missing = [pid for pid in missing if pid not in refs]
+
+                if missing:
+                    cur = conn.cursor(MySQLdb.cursors.SSDictCursor)
+                    cur.execute(
+                        "SELECT `id`, `mime`, `imgdata` FROM `posts` WHERE `id` IN %s", (missing,)
+                    )
+                    for row in cur:
+                        pending.acquire()
+                        futures.append(
+                            executor.submit(write, row["id"], image_ext(row["mime"]), row["imgdata"])
+                        )
+                    cur.close()
+
+                # 範囲内の書き出しが終わってから進めるので、last_idまでは必ずファイルがある
+                for future in futures:
+                    future.result()
+                stats["exported"] += len(futures)
+                stats["last_id"] = headers[-1]["id"]
+                if progress:
+                    progress(stats)
+    finally:
+        conn.close()
+    return stats
+
+
+def try_login(account_name, password):
+    user = get_user_by_account_name(account_name)
 
-    if not user:
+    if not user or user["del_flg"]:
         return None
     
     user_correct_pass = user["passhash"]
@@ -159,77 +980,283 @@ def try_login(account_name, password):
     return None
 
 
-def validate_user(account_name: str, password: str):
-    if not re.match(r"[0-9a-zA-Z]{3,}", account_name):
-        return False
-    if not re.match(r"[0-9a-zA-Z_]{6,}", password):
-        return False
-    return True
+def store_user_snapshot(user):
+    snapshot = {k: user[k] for k in _USER_SNAPSHOT_FIELDS}
+    snapshot["version"] = users_version()
+    flask.session["user_data"] = snapshot
 
 
-def digest(src: str, is_new_user=False):
-    src_bytes = src.encode('utf-8')
+def get_session_user():
+    user = flask.session.get("user")
+    if user:
+        cached_user = _user_cache_by_id.get(user["id"])
+        if cached_user:
+            return cached_user
 
-    if is_new_user:
-        hashed_str = hashlib.sha1(src_bytes).hexdigest().strip()
-        hased_str = "NEWUSER" + hased_str
-    else:
-        hased_str = hashlib.sha512(src_bytes).hexdigest().strip()
-    
-    return hased_str
+        # セッションにキャッシュされたユーザー情報があるかチェック
+        # BANなどでユーザー情報が変わっていれば(versionが違えば)使わない
+        snapshot = flask.session.get("user_data")
+        if snapshot and snapshot.get("version") == users_version() and snapshot["id"] == user["id"]:
+            return snapshot
 
+        # キャッシュがない場合のみDBアクセス
+        user_data = get_user(user["id"])
+        if user_data:
+            store_user_snapshot(user_data)
+        return user_data
+    return None
 
-def calculate_salt(account_name: str):
-    return digest(account_name)
 
+# タイムラインインデックス
+# 投稿ヘッダを (created_at, id) 昇順でメモリに持ち、/ と /posts?max_created_at= を二分探索で返す
 
-def calculate_passhash(account_name: str, password: str, is_new_user=False):
-    return digest(f"{password}:{calculate_salt(account_name)}", is_new_user)
 
+class TimelineIndex:
+    def __init__(self, max_posts):
+        self.max_posts = max_posts
+        self._lock = threading.Lock()
+        self._keys = []  # (created_at, id)
+        self._posts = []  # _keysと同じ順の投稿ヘッダ
+        # DBから読んだ（load/refresh）投稿の最大id。自プロセスのaddでは進めない。
+        # 自分の投稿のidで進めると、それより小さいidでほかのプロセスが先に入れた投稿をrefreshで取りこぼす
+        self._synced_id = 0
+        # 上限で古い投稿を切り捨てていなければTrue。Falseなら末尾より古いページはSQLに任せる
+        self.complete = True
 
-def get_session_user():
-    user = flask.session.get("user")
-    if user:
-        # # セッションにキャッシュされたユーザー情報があるかチェック
-        # cached_user = flask.session.get("user_data")
-        # if cached_user:
-        #     return cached_user
-            
-        # キャッシュがない場合のみDBアクセス
+    def load(self):
         cur = db().cursor()
-        cur.execute("SELECT * FROM `users` WHERE `id` = %s", (user["id"],))
-        user_data = cur.fetchone()
-        
-        ## セッションにキャッシュ
-        #if user_data:
-        #    flask.session["user_data"] = user_data
-        #
-        return user_data
-    return None
+        cur.execute(
+            f"SELECT {_TIMELINE_COLUMNS} FROM `posts` ORDER BY `created_at` DESC, `id` DESC LIMIT %s",
+            (self.max_posts + 1,),
+        )
+        rows = list(cur.fetchall())
+        complete = len(rows) <= self.max_posts
+        rows = rows[: self.max_posts]
+        rows.reverse()
+        with self._lock:
+            self._posts = rows
+            self._keys = [(p["created_at"], p["id"]) for p in rows]
+            self._synced_id = max((p["id"] for p in rows), default=0)
+            self.complete = complete
+
+    def refresh(self):
+        """ほかのプロセスが追加した投稿を取り込む。自プロセスで追加済みのものはaddが飛ばす"""
+        cur = db().cursor()
+        cur.execute(
+            f"SELECT {_TIMELINE_COLUMNS} FROM `posts` WHERE `id` > %s ORDER BY `id`",
+            (self._synced_id,),
+        )
+        rows = cur.fetchall()
+        for post in rows:
+            self.add(post)
+        if rows:
+            with self._lock:
+                self._synced_id = max(self._synced_id, rows[-1]["id"])
+
+    def add(self, post):
+        key = (post["created_at"], post["id"])
+        with self._lock:
+            i = bisect.bisect_right(self._keys, key)
+            if i > 0 and self._keys[i - 1] == key:
+                return  # refreshと自プロセスの追加が重なった
+            self._keys.insert(i, key)
+            self._posts.insert(i, post)
+            excess = len(self._posts) - self.max_posts
+            if excess > 0:
+                del self._keys[:excess]
+                del self._posts[:excess]
+                self.complete = False
+
+    def page(self, limit, max_created_at=None, max_id=None, skip_user_ids=frozenset()):
+        """新しい順にskip_user_idsの投稿を除いてlimit件。インデックスで答えられなければNone
+
+        max_idなしなら created_at <= max_created_at、ありなら (created_at, id) < (max_created_at, max_id)
+        """
+        with self._lock:
+            if max_created_at is None:
+                end = len(self._keys)
+            elif max_id is None:
+                end = bisect.bisect_right(self._keys, (max_created_at, float("inf")))
+            else:
+                end = bisect.bisect_left(self._keys, (max_created_at, max_id))
+            rows = []
+            for i in range(end - 1, -1, -1):
+                post = self._posts[i]
+                if post["user_id"] not in skip_user_ids:
+                    rows.append(post)
+                    if len(rows) >= limit:
+                        break
+            if len(rows) < limit and not self.complete:
+                return None
+        # make_postsが書き換えるのでコピーを返す
+        return [dict(p) for p in rows]
+
+
+_timeline = None
+_timeline_lock = threading.Lock()
+
+
+def timeline():
+    global _timeline
+    if _timeline is None:
+        with _timeline_lock:
+            if _timeline is None:
+                index = TimelineIndex(config()["timeline"]["max_posts"])
+                index.load()
+                _timeline = index
+    return _timeline
+
+
+def reset_timeline():
+    """次にtimeline()を呼んだときに読み直させる"""
+    global _timeline
+    with _timeline_lock:
+        _timeline = None
+
+
+def timeline_add_post(post_id):
+    cur = db().cursor()
+    cur.execute(f"SELECT {_TIMELINE_COLUMNS} FROM `posts` WHERE `id` = %s", (post_id,))
+    post = cur.fetchone()
+    if post:
+        timeline().add(post)
 
 
-def make_posts(results, all_comments=False):
-    if not results:
-        return []
-    
+def recent_posts(max_created_at=None, max_id=None):
+    """BANされたユーザーの投稿を除いて、ちょうどPOSTS_PER_PAGE件（足りなければある分）を返す"""
+    banned = banned_user_ids()
+    posts = timeline().page(POSTS_PER_PAGE, max_created_at, max_id, banned)
+    if posts is not None:
+        return posts
+
+    # インデックスの上限より古いページ。(created_at, id)で区切りながら必要な件数まで読み進める
+    cursor = db().cursor()
     posts = []
+    while len(posts) < POSTS_PER_PAGE:
+        cursor.execute(*timeline_page_query(max_created_at, max_id))
+        rows = cursor.fetchall()
+        posts.extend(row for row in rows if row["user_id"] not in banned)
+        if len(rows) < POSTS_PER_PAGE:
+            break
+        max_created_at, max_id = rows[-1]["created_at"], rows[-1]["id"]
+    return posts[:POSTS_PER_PAGE]
+
+
+# memcachedに置く投稿ごとの組み立て済みデータ（コメント数と表示するコメント）
+# 全ワーカー・全ホストで共有する。形式を変えたら_POST_CACHE_VERSIONを上げる。
+# ユーザー情報はBANを即時反映するためキャッシュに含めず、組み立て時にget_usersで付ける
+# 値には書き込み時の世代番号を入れておき、/initializeで世代を進めて全体を無効にする
+# memcachedはほかのプロセスからも書けるので、pickleではなく型を決めたmsgpackで読み書きする
+
+
+class _CachedComment(msgspec.Struct, array_like=True):
+    id: int
+    post_id: int
+    user_id: int
+    comment: str
+    created_at: datetime.datetime
+
+
+class _CachedPostDetails(msgspec.Struct, array_like=True):
+    generation: bytes | None
+    comment_count: int
+    comments: list[_CachedComment]
+
+
+_post_details_encoder = msgspec.msgpack.Encoder()
+_post_details_decoder = msgspec.msgpack.Decoder(_CachedPostDetails)
+
+
+def _encode_post_details(generation, d):
+    comments = [
+        _CachedComment(c["id"], c["post_id"], c["user_id"], c["comment"], c["created_at"])
+        for c in d["comments"]
+    ]
+    return _post_details_encoder.encode(_CachedPostDetails(generation, d["comment_count"], comments))
+
+
+def _decode_post_details(value):
+    """(世代番号, {"comment_count", "comments"}) を返す。形式の違う値ならNone"""
+    try:
+        cached = _post_details_decoder.decode(value)
+    except msgspec.DecodeError:
+        return None
+    comments = [msgspec.structs.asdict(c) for c in cached.comments]
+    return cached.generation, {"comment_count": cached.comment_count, "comments": comments}
+
+
+def invalidate_post_cache(post_id=None):
+    """post_idを省略した場合はすべて無効にし、新しい世代番号を返す"""
+    if post_id is None:
+        generation = memcache().incr(_POST_GENERATION_KEY, 1)
+        if generation is None:
+            generation = 1
+            memcache().set(_POST_GENERATION_KEY, str(generation))
+        return str(generation).encode()
+    memcache().delete_many([_post_cache_key(post_id, False), _post_cache_key(post_id, True)])
+
+
+def append_recent_comment(post_id, comment):
+    """タイムライン用の最新3件に新しいコメントを追加する
+
+    memcachedの値をgets/casで書き換えるので、同時にコメントされても取りこぼさない。
+    キャッシュにない投稿は何もせず、次に読まれたときにSQLから作る。
+    """
+    key = _post_cache_key(post_id, False)
+    for _ in range(3):
+        value, cas = memcache().gets(key)
+        if value is None:
+            return
+        if value == _POST_LEASE:
+            # 読み込み中の投稿。消しておけば読み込んだ側の書き戻しが失敗する
+            memcache().delete(key)
+            return
+        decoded = _decode_post_details(value)
+        if decoded is None:
+            break
+        generation, d = decoded
+        d["comment_count"] += 1
+        d["comments"] = (d["comments"] + [comment])[-3:]
+        if memcache().cas(key, _encode_post_details(generation, d), cas, expire=config()["memcache"]["post_ttl"]):
+            return
+    # 競合が続いた場合と読めない値だった場合は捨てて次の読み込みで作り直す
+    memcache().delete(key)
+
+
+# SQLから作った値を書き戻すときは、読む前に置いたリース（またはその時点の値）のcasトークンで書く。
+# 読み込み中にpost_commentが消したりcasで追記したりしていれば書き戻しは失敗し、古いコメントを戻さない
+_POST_LEASE = b"lease"
+_POST_LEASE_TTL = 10
+
+
+def load_and_store_post_details(post_ids, all_comments, generation):
+    mc = memcache()
+    keys = {_post_cache_key(post_id, all_comments): post_id for post_id in post_ids}
+    tokens = mc.gets_many(list(keys))
+    absent = [key for key in keys if key not in tokens]
+    if absent:
+        for key in absent:
+            mc.add(key, _POST_LEASE, expire=_POST_LEASE_TTL, noreply=False)
+        tokens.update(mc.gets_many(absent))
+
+    loaded = load_post_details(post_ids, all_comments)
+    expire = config()["memcache"]["post_ttl"]
+    for key, (_, cas) in tokens.items():
+        mc.cas(key, _encode_post_details(generation, loaded[keys[key]]), cas, expire=expire, noreply=True)
+    return loaded
+
+
+def load_post_details(post_ids, all_comments=False):
+    """post_id -> {"comment_count", "comments"} をSQLでまとめて作る"""
     cursor = db().cursor()
-    
-    # 投稿IDとユーザーIDを事前に収集
-    post_ids = [post["id"] for post in results]
-    user_ids = list(set(post["user_id"] for post in results))
-    
-    # ユーザー情報を一括取得
-    cursor.execute("SELECT * FROM `users` WHERE `id` IN %s", (user_ids,))
-    users_dict = {user["id"]: user for user in cursor.fetchall()}
-    
+
     # コメント数を一括取得
     cursor.execute(
-        "SELECT post_id, COUNT(*) as count FROM comments WHERE post_id IN %s GROUP BY post_id",
+        "SELECT `post_id`, `comment_count` FROM `post_stats` WHERE `post_id` IN %s",
         (post_ids,)
     )
-    comment_counts = {row["post_id"]: row["count"] for row in cursor.fetchall()}
-    
+    comment_counts = {row["post_id"]: row["comment_count"] for row in cursor.fetchall()}
+
     # コメント情報を一括取得
     if all_comments:
         cursor.execute(
@@ -248,38 +1275,76 @@ def make_posts(results, all_comments=False):
             WHERE rn <= 3
             ORDER BY post_id, created_at DESC
         """, (post_ids,))
-    
-    # コメントをpost_id別に分類し、ユーザーIDを収集
+
+    # コメントをpost_id別に分類
     comments_by_post = {}
-    comment_user_ids = set()
     for comment in cursor.fetchall():
-        post_id = comment["post_id"]
-        if post_id not in comments_by_post:
-            comments_by_post[post_id] = []
-        comments_by_post[post_id].append(comment)
-        comment_user_ids.add(comment["user_id"])
+        comments_by_post.setdefault(comment["post_id"], []).append(comment)
+
+    details = {}
+    for post_id in post_ids:
+        comments = comments_by_post.get(post_id, [])
+        if not all_comments:
+            comments.reverse()
+        details[post_id] = {
+            "comment_count": comment_counts.get(post_id, 0),
+            "comments": comments,
+        }
+    return details
+
+
+def get_post_details(post_ids, all_comments=False):
+    """memcachedからget_manyで取り、なかったものだけload_post_detailsで作って書き戻す"""
+    keys = {_post_cache_key(post_id, all_comments): post_id for post_id in post_ids}
+    # フラグメントの無効化（post:<id>の世代番号）も同じget_manyで確認する
+    bus = invalidation()
+    bus_keys = {bus.key(f"post:{post_id}"): f"post:{post_id}" for post_id in post_ids}
+    values = memcache().get_many(list(keys) + list(bus_keys) + [_POST_GENERATION_KEY])
+    bus.observe({namespace: values.pop(key, None) for key, namespace in bus_keys.items()})
+    generation = values.pop(_POST_GENERATION_KEY, None)
+    details = {}
+    for key, value in values.items():
+        if value == _POST_LEASE:
+            continue
+        decoded = _decode_post_details(value)
+        if decoded is not None and decoded[0] == generation:
+            details[keys[key]] = decoded[1]
+
+    missing = [post_id for post_id in post_ids if post_id not in details]
+    if missing:
+        details.update(load_and_store_post_details(missing, all_comments, generation))
+    return details
+
+
+def make_posts(results, all_comments=False):
+    if not results:
+        return []
     
-    # コメントユーザー情報を一括取得
-    if comment_user_ids:
-        cursor.execute("SELECT * FROM `users` WHERE `id` IN %s", (list(comment_user_ids),))
-        comment_users_dict = {user["id"]: user for user in cursor.fetchall()}
-    else:
-        comment_users_dict = {}
+    posts = []
+    
+    # 投稿IDを事前に収集
+    post_ids = [post["id"] for post in results]
+    
+    # コメント数とコメントを一括取得
+    details = get_post_details(post_ids, all_comments)
+    
+    # 投稿者とコメントユーザーの情報を一括取得
+    user_ids = {post["user_id"] for post in results}
+    for d in details.values():
+        user_ids.update(comment["user_id"] for comment in d["comments"])
+    users_dict = get_users(user_ids)
     
     # データを組み立て
     for post in results:
-        post["comment_count"] = comment_counts.get(post["id"], 0)
+        post["comment_count"] = details[post["id"]]["comment_count"]
         post["user"] = users_dict.get(post["user_id"])
         
         if not post["user"]:
             continue
             
-        comments = comments_by_post.get(post["id"], [])
+        comments = details[post["id"]]["comments"]
         for comment in comments:
-            comment["user"] = comment_users_dict.get(comment["user_id"])
-        
-        if not all_comments:
-            comments.reverse()
+            comment["user"] = users_dict.get(comment["user_id"])
         post["comments"] = comments
         
         if not post["user"]["del_flg"]:
@@ -292,47 +1357,564 @@ def make_posts(results, all_comments=False):
 
 
 # app setup
-static_path = pathlib.Path(__file__).resolve().parent.parent / "public"
 app = flask.Flask(__name__, static_folder=str(static_path), static_url_path="")
 # app.debug = True
+app.add_template_global(asset_url)
+app.add_template_global(image_url)
+app.add_template_global(body_html)
+app.add_template_filter(nl2br)
 
 otel_setup(app)
 log_setup(app)
 
-# Flask-Session
-app.config["SESSION_TYPE"] = "memcached"
-app.config["SESSION_MEMCACHED"] = memcache()
-Session(app)
+# クエリの集計はほかのbefore_requestより先に始める。check_invalidationsなどが流すクエリも数えるため
+if config()["query_stats"]["enabled"]:
+
+    @app.before_request
+    def start_query_stats():
+        flask.g._query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = flask.g.pop("_query_stats", None)
+        if stats is None:
+            return response
+        response.headers["X-Query-Stats"] = stats.header()
+        route = flask.request.url_rule.rule if flask.request.url_rule else flask.request.path
+        summary = stats.summary()
+        summary["route"] = f"{flask.request.method} {route}"
+        summary["path"] = flask.request.full_path
+        summary["status"] = response.status_code
+        query_history().append(summary)
+        for shape, n in summary["repeated"].items():
+            app.logger.warning(f"N+1 suspected: {summary['route']} ran {n}x: {shape}")
+        for e in summary["explains"]:
+            app.logger.warning(f"slow query ({e['ms']}ms) in {summary['route']}: {e['query']} plan={e['plan']}")
+        app.logger.debug(f"{summary['route']} {stats.header()}")
+        return response
+
+
+# 手元のキャッシュを使わないエンドポイント。memcachedへの往復を省く
+_INVALIDATION_EXEMPT_ENDPOINTS = frozenset(("static", "get_image"))
+
+
+@app.before_request
+def check_invalidations():
+    if flask.request.endpoint in _INVALIDATION_EXEMPT_ENDPOINTS:
+        return
+    invalidation().check(("global", "users", "timeline"))
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = flask.g.pop("_db", None)
+    if conn is not None:
+        db_pool().release(conn, broken=isinstance(exc, MySQLdb.OperationalError))
+
+
+if config()["session"]["backend"] == "cookie":
+    # Flask標準の署名付きCookieセッション。リクエストごとのmemcachedアクセスがなくなる
+    if not config()["session"]["secret"]:
+        raise RuntimeError("ISUCONP_SESSION_SECRET is required for the cookie session backend")
+    app.secret_key = config()["session"]["secret"]
+else:
+    # Flask-Session
+    app.config["SESSION_TYPE"] = "memcached"
+    app.config["SESSION_MEMCACHED"] = memcache()
+    Session(app)
+app.request_class = Request
+
+
+assets()
+
+
+def send_static_asset(filename):
+    """起動時に読み込んだファイルを、Accept-Encodingに合わせて圧縮済みのものから返す"""
+    asset = assets().get(filename)
+    if asset is None:
+        return send_static_file(filename)
+
+    encoding = asset.negotiate(flask.request.accept_encodings)
+    body, etag = asset.variants[encoding]
+    if flask.request.args.get("v") == asset.fingerprint:
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = STATIC_CACHE_CONTROL
 
+    if is_not_modified(flask.request, etag, asset.last_modified):
+        resp = set_validators(flask.Response(status=304), etag, cache_control, asset.last_modified)
+    else:
+        resp = flask.Response(body, mimetype=asset.mime)
+        if encoding != "identity":
+            resp.headers["Content-Encoding"] = encoding
+        resp = cacheable_response(resp, etag, cache_control, len(body), asset.last_modified)
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+def send_static_file(filename):
+    """起動後に置かれたwebapp/publicのファイルを画像と同じバリデータ処理で返す"""
+    path = werkzeug.security.safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        flask.abort(404)
+    st = os.stat(path)
+    etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    last_modified = datetime.datetime.fromtimestamp(int(st.st_mtime), datetime.timezone.utc)
+    if is_not_modified(flask.request, etag, last_modified):
+        return set_validators(flask.Response(status=304), etag, STATIC_CACHE_CONTROL, last_modified)
+    resp = flask.send_file(path, conditional=False, etag=False)
+    return cacheable_response(resp, etag, STATIC_CACHE_CONTROL, st.st_size, last_modified)
 
-@app.template_global()
-def image_url(post):
-    ext = ""
-    mime = post["mime"]
-    if mime == "image/jpeg":
-        ext = ".jpg"
-    elif mime == "image/png":
-        ext = ".png"
-    elif mime == "image/gif":
-        ext = ".gif"
 
-    return "/image/%s%s" % (post["id"], ext)
+app.view_functions["static"] = send_static_asset
 
 
-# http://flask.pocoo.org/snippets/28/
-_paragraph_re = re.compile(r"(?:\r\n|\r|\n){2,}")
+@app.after_request
+def compress_response(response):
+    """大きいHTMLはその場でgzipして返す"""
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.mimetype != "text/html"
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    conf = config()["compress"]
+    if conf["min_size"] <= 0:
+        return response
+    # 圧縮するかどうかはAccept-Encodingとサイズで変わるので、圧縮しなかったレスポンスにもVaryを付けておく。
+    # 付けないと前段のキャッシュが素のHTMLをgzip対応のクライアントにも返し続ける
+    response.vary.add("Accept-Encoding")
+    if flask.request.accept_encodings.quality("gzip") <= 0:
+        return response
+    data = response.get_data()
+    if len(data) < conf["min_size"]:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=conf["level"], mtime=0))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+@app.cli.command("build-assets")
+@click.option(
+    "--nginx-include",
+    default=str(static_path.parent / "etc" / "nginx" / "conf.d" / "static_assets.inc"),
+    show_default=True,
+    help="nginxのserverブロックでincludeするファイル",
+)
+def build_assets_command(nginx_include):
+    """webapp/publicの各ファイルの隣に.gzを置き、nginxが直接返すためのlocationを書き出す"""
+    store = assets()
+    for name, asset in store.items():
+        if "gzip" in asset.variants:
+            _write_file_atomic(os.path.join(store.root, name + ".gz"), asset.variants["gzip"][0])
+    _write_file_atomic(nginx_include, nginx_asset_locations(store).encode())
+    click.echo(f"wrote {nginx_include}")
+
+
+@app.cli.command("check-counters")
+@click.option("--repair", is_flag=True, help="ずれているカウンタを正しい値に書き換える")
+def check_counters_command(repair):
+    """user_stats / post_statsのカウンタを実データと突き合わせる"""
+    mismatches = check_counters(repair=repair)
+    for table, column, key, stored, expected in mismatches:
+        click.echo(f"{table}.{column} [{key}]: stored={stored} expected={expected}")
+    click.echo(f"{len(mismatches)} mismatches" + (" repaired" if repair else ""))
+
+
+@app.cli.command("export-images")
+@click.option("--dir", "image_dir", default=None, help="書き出し先（省略時はISUCONP_IMAGE_DIR）")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--workers", default=4, show_default=True)
+@click.option("--start-id", default=0, show_default=True, help="このidより後の投稿から再開する")
+def export_images_command(image_dir, batch_size, workers, start_id):
+    """DBの画像をファイルに書き出す。ベンチマーク前に実行しておくと初回アクセスでDBを読まずに済む"""
+    stats = export_images_bulk(
+        image_dir=image_dir,
+        batch_size=batch_size,
+        workers=workers,
+        start_id=start_id,
+        progress=lambda stats: click.echo(
+            f"last_id={stats['last_id']} exported={stats['exported']} skipped={stats['skipped']}"
+        ),
+    )
+    click.echo(f"done: {stats}")
+
+
+@app.cli.command("migrate-images")
+@click.option("--batch-size", default=200, show_default=True)
+@click.option(
+    "--drop-blobs",
+    is_flag=True,
+    help="移行済みでblobがobjects/にある行のposts.imgdataを空にする。以後は画像ディレクトリが唯一のコピーになる",
+)
+@click.option("--start-id", default=0, show_default=True, help="このidより後の投稿から再開する")
+@click.option("--pause", default=0.0, show_default=True, help="バッチごとに休む秒数")
+def migrate_images_command(batch_size, drop_blobs, start_id, pause):
+    """posts.imgdataを画像ストアへ移す。稼働中に実行してよい"""
+    db().cursor().execute(_POST_IMAGES_SCHEMA)
+    stats = migrate_image_blobs(
+        batch_size=batch_size,
+        drop_blobs=drop_blobs,
+        start_id=start_id,
+        pause=pause,
+        progress=lambda stats: click.echo(
+            f"last_id={stats['last_id']} migrated={stats['migrated']} dropped={stats['dropped']}"
+        ),
+    )
+    click.echo(f"done: {stats}")
+    if drop_blobs:
+        click.echo("run 'OPTIMIZE TABLE posts' to reclaim the space")
+
+
+@app.cli.command("backfill-body-html")
+@click.option("--batch-size", default=500, show_default=True)
+def backfill_body_html_command(batch_size):
+    """posts.body_htmlが空の投稿を埋める。/initializeでも実行される"""
+    ensure_body_html_column()
+    filled = backfill_body_html(
+        batch_size=batch_size,
+        progress=lambda last_id, filled: click.echo(f"last_id={last_id} filled={filled}"),
+    )
+    click.echo(f"done: {filled} posts")
+
+
+# post.htmlのフラグメントキャッシュ
+# (post_id, all_comments) -> (comment_count, html)。コメント数が変われば作り直す。
+# 閲覧者ごとに異なるのはcsrf_tokenだけなので、プレースホルダで描画して組み立て時に差し込む。
+# プレースホルダはMarkupなのでエスケープされず、投稿本文に同じ文字列が現れても区別できる
+_CSRF_PLACEHOLDER = Markup("<!--csrf_token-->")
+_fragment_cache = {}
+# gthreadワーカーでは追加・追い出しが並行するので、書き込みはロックを取る（読むだけならdict.getで足りる）
+_fragment_lock = threading.Lock()
+
+
+def invalidate_fragments(post_id=None):
+    """post_idを省略した場合はすべて破棄する"""
+    with _fragment_lock:
+        if post_id is None:
+            _fragment_cache.clear()
+            return
+        _fragment_cache.pop((post_id, False), None)
+        _fragment_cache.pop((post_id, True), None)
+
+
+def render_post_fragment(post, all_comments=False):
+    key = (post["id"], all_comments)
+    entry = _fragment_cache.get(key)
+    if entry is None or entry[0] != post["comment_count"]:
+        html = app.jinja_env.get_template("post.html").render(
+            post=post, session={"csrf_token": _CSRF_PLACEHOLDER}
+        )
+        entry = (post["comment_count"], html)
+        max_entries = config()["fragment"]["max_entries"]
+        with _fragment_lock:
+            while len(_fragment_cache) >= max_entries:
+                _fragment_cache.pop(next(iter(_fragment_cache)), None)
+            _fragment_cache[key] = entry
+
+    csrf_token = escape(flask.session.get("csrf_token", ""))
+    return Markup(entry[1].replace(_CSRF_PLACEHOLDER, csrf_token))
 
 
-@app.template_filter()
-@pass_eval_context
-def nl2br(eval_ctx, value):
-    result = "\n\n".join(
-        "<p>%s</p>" % p.replace("\n", "<br>\n")
-        for p in _paragraph_re.split(escape(value))
+@app.template_global()
+def post_fragment(post):
+    return render_post_fragment(post)
+
+
+# 匿名ユーザー向けのページキャッシュ
+# ログインしていなければ / と /@<account_name> と /posts/<id> は誰に対しても同じHTML（CSRFトークンも空）なので、
+# memcachedにページ丸ごと短いTTLで置いて全ワーカーで共有する。
+# 作り直しはmemcachedのaddで取るロックで1リクエストに絞り（single-flight）、ほかは古いページを返すか少し待つ。
+# 書き込みではpurge_pagesで該当ページを消す。BANと/initializeは無効化バスの世代がキーに入っているので全体が切り替わる。
+# purge_pagesはページを消す前にパスごとのpurge番号を進める。作り直しは始める前の番号を覚えておき、
+# 置いたあとに番号が動いていたら置いたページを消す（purge前のDBから作ったHTMLを残さないため）。
+# gzipはページを置くときに一度だけ作って一緒に入れておき、ヒットのたびに圧縮し直さない
+_PAGE_LOCK_EXPIRE = 5
+_CACHEABLE_PATH_RE = re.compile(r"^/[0-9A-Za-z_@/.-]{0,200}$")
+
+
+def _page_cache_key(path):
+    bus = invalidation()
+    return page_cache_key(path, bus.generation("global"), bus.generation("users"))
+
+
+def purge_pages(*paths):
+    mc = memcache()
+    for path in paths:
+        key = page_purge_key(path)
+        if mc.incr(key, 1) is None and not mc.add(key, "1", noreply=False):
+            mc.incr(key, 1)
+    mc.delete_many([_page_cache_key(path) for path in paths])
+
+
+def _encode_page_entry(html):
+    """「作った時刻 HTMLの長さ\n」+ HTML + gzip済みのHTML（小さいページは空）"""
+    conf = config()["compress"]
+    gz = b""
+    if 0 < conf["cached_min_size"] <= len(html):
+        gz = gzip.compress(html, compresslevel=conf["level"], mtime=0)
+    return f"{time.time():.6f} {len(html)}\n".encode() + html + gz
+
+
+def _decode_page_entry(entry):
+    header, data = entry.split(b"\n", 1)
+    built_at, size = header.split()
+    size = int(size)
+    return float(built_at), data[:size], data[size:]
+
+
+def _page_cache_response(resp, gz, state):
+    """置いてあるgzipを受け付けるクライアントにはそれをそのまま返す"""
+    if gz:
+        resp.vary.add("Accept-Encoding")
+        if flask.request.accept_encodings.quality("gzip") > 0:
+            resp.set_data(gz)
+            resp.headers["Content-Encoding"] = "gzip"
+    resp.headers["X-Page-Cache"] = state
+    return resp
+
+
+def cached_page(view):
+    """ログインしていないリクエストだけページキャッシュから返すデコレータ"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        conf = config()["page_cache"]
+        path = flask.request.path
+        if (
+            conf["ttl"] <= 0
+            or flask.session.get("user")
+            or "_flashes" in flask.session
+            or flask.request.query_string
+            or not _CACHEABLE_PATH_RE.match(path)
+        ):
+            return view(*args, **kwargs)
+
+        mc = memcache()
+        key = _page_cache_key(path)
+        lock_key = key + ":lock"
+        purge_key = page_purge_key(path)
+        wait_until = time.monotonic() + conf["wait_ms"] / 1000
+        while True:
+            values = mc.get_many([key, purge_key])
+            purged = values.get(purge_key)
+            entry = values.get(key)
+            if entry is not None:
+                built_at, html, gz = _decode_page_entry(entry)
+                if time.time() - built_at < conf["ttl"]:
+                    return _page_cache_response(flask.Response(html, mimetype="text/html"), gz, "hit")
+                if not mc.add(lock_key, b"1", expire=_PAGE_LOCK_EXPIRE, noreply=False):
+                    # ほかのリクエストが作り直している
+                    return _page_cache_response(flask.Response(html, mimetype="text/html"), gz, "stale")
+                break
+            if mc.add(lock_key, b"1", expire=_PAGE_LOCK_EXPIRE, noreply=False):
+                break
+            if time.monotonic() >= wait_until:
+                # 待ちきれなければ自分で作って返す。キャッシュには入れない
+                return view(*args, **kwargs)
+            time.sleep(0.005)
+
+        try:
+            resp = flask.make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                resp.headers["X-Page-Cache"] = "miss"
+                return resp
+            entry = _encode_page_entry(resp.get_data())
+            mc.set(key, entry, expire=max(1, int(conf["ttl"] + conf["stale"] + 0.999)))
+            if mc.get(purge_key) != purged:
+                # 作っている間にpurgeされた。purge前の内容かもしれないので置いたものを消す
+                mc.delete(key)
+            _, _, gz = _decode_page_entry(entry)
+            return _page_cache_response(resp, gz, "miss")
+        finally:
+            mc.delete(lock_key)
+
+    return wrapper
+
+
+# /initialize後のウォームアップ
+# 初期化直後はプロセス内キャッシュも画像ファイルも空なので、バックグラウンドスレッドで温める。
+# deadline秒で打ち切る。状態はmemcachedに置き、どのワーカーの/initialize/statusからも見られるようにする。
+# 全ステップを実行して状態を報告するのは/initializeを受けたワーカーだけ。ほかのワーカーは無効化バスで
+# globalの世代が進んだのを次のリクエストで見たときに、プロセス内のキャッシュだけを温める（画像ファイルはディスクで共有）
+_warmup_lock = threading.Lock()
+_warmup_thread = None
+_warmup_stop = None
+
+
+def warmup_status():
+    value = memcache().get(WARMUP_STATUS_KEY)
+    return json.loads(value) if value else {"state": "idle"}
+
+
+def _warm_users(stop):
+    epoch = _user_cache_epoch
+    cur = db().cursor()
+    cur.execute("SELECT * FROM `users`")
+    users = cur.fetchall()
+    _cache_users(users, epoch)
+    banned_user_ids()
+    return len(users)
+
+
+def _warm_templates(stop):
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def _warm_pages(stop):
+    """タイムラインの先頭から数ページ分、投稿データとフラグメントを作る"""
+    rendered = 0
+    max_created_at = max_id = None
+    with app.test_request_context():
+        for _ in range(config()["warmup"]["pages"]):
+            if stop.is_set():
+                break
+            results = recent_posts(max_created_at, max_id)
+            if not results:
+                break
+            max_created_at, max_id = results[-1]["created_at"], results[-1]["id"]
+            for post in make_posts(results):
+                render_post_fragment(post)
+                rendered += 1
+    return rendered
+
+
+def _warm_images(stop):
+    conf = config()["warmup"]
+    return export_images_bulk(
+        batch_size=100,
+        workers=conf["image_workers"],
+        newest_first=True,
+        max_posts=conf["images"],
+        stop=stop,
     )
-    if eval_ctx.autoescape:
-        result = Markup(result)
-    return result
+
+
+_WARMUP_STEPS = [
+    ("users", _warm_users),
+    ("templates", _warm_templates),
+    ("pages", _warm_pages),
+    ("images", _warm_images),
+]
+_LOCAL_WARMUP_STEPS = [step for step in _WARMUP_STEPS if step[0] != "images"]
+
+
+def run_local_warmup(stop):
+    """プロセス内のキャッシュだけを温める。状態は報告しない"""
+    timer = threading.Timer(config()["warmup"]["deadline"], stop.set)
+    timer.daemon = True
+    timer.start()
+    try:
+        with app.app_context():
+            for _, step in _LOCAL_WARMUP_STEPS:
+                if stop.is_set():
+                    break
+                step(stop)
+    except Exception:
+        app.logger.exception("local warm-up failed")
+    finally:
+        timer.cancel()
+
+
+def run_warmup(stop):
+    conf = config()["warmup"]
+    status = {"state": "running", "started_at": time.time(), "steps": {}}
+    memcache().set(WARMUP_STATUS_KEY, json.dumps(status))
+    timer = threading.Timer(conf["deadline"], stop.set)
+    timer.daemon = True
+    timer.start()
+    try:
+        with app.app_context():
+            for name, step in _WARMUP_STEPS:
+                if stop.is_set():
+                    break
+                started = time.monotonic()
+                result = step(stop)
+                status["steps"][name] = {
+                    "result": result,
+                    "ms": round((time.monotonic() - started) * 1000),
+                }
+                memcache().set(WARMUP_STATUS_KEY, json.dumps(status))
+        # 打ち切られたかどうかは最後まで進んだステップで分かる
+        status["state"] = "done" if len(status["steps"]) == len(_WARMUP_STEPS) and not stop.is_set() else "stopped"
+    except Exception as e:
+        app.logger.exception("warm-up failed")
+        status["state"] = "failed"
+        status["error"] = str(e)
+    finally:
+        timer.cancel()
+    status["finished_at"] = time.time()
+    memcache().set(WARMUP_STATUS_KEY, json.dumps(status))
+    app.logger.info(f"warm-up {status['state']}: {status['steps']}")
+
+
+def start_warmup(local=False):
+    """実行中のウォームアップがあれば止めてから、新しく始める。localならプロセス内のキャッシュだけ"""
+    global _warmup_thread, _warmup_stop
+    with _warmup_lock:
+        if _warmup_thread is not None:
+            _warmup_stop.set()
+            _warmup_thread.join()
+        _warmup_stop = threading.Event()
+        _warmup_thread = threading.Thread(
+            target=run_local_warmup if local else run_warmup,
+            args=(_warmup_stop,),
+            name="warmup",
+            daemon=True,
+        )
+        _warmup_thread.start()
+
+
+# /admin/export-images
+# 画像の多いDBだと書き出しに何分もかかり、リクエストの中で走らせるとワーカーを占有してタイムアウトするので
+# バックグラウンドのスレッドで進める。1プロセスで同時に走るのは1本だけ。ほかのワーカーと重なっても
+# 書き出し済みのファイルは飛ばし、書き込みもアトミックなので壊れはしない。
+# 状態はmemcachedに置き、どのワーカーの/admin/export-images/statusからも見られるようにする
+_EXPORT_STATUS_KEY = "export:v1:status"
+_export_lock = threading.Lock()
+_export_thread = None
+
+
+def export_status():
+    value = memcache().get(_EXPORT_STATUS_KEY)
+    return json.loads(value) if value else {"state": "idle"}
+
+
+def run_export():
+    status = {"state": "running", "started_at": time.time()}
+
+    def progress(stats):
+        status.update(stats)
+        memcache().set(_EXPORT_STATUS_KEY, json.dumps(status))
+        app.logger.info(f"Exporting images: {stats}")
+
+    memcache().set(_EXPORT_STATUS_KEY, json.dumps(status))
+    try:
+        with app.app_context():
+            status.update(export_images_bulk(progress=progress))
+        status["state"] = "done"
+        app.logger.info(f"Exported {status['exported']} images to filesystem")
+    except Exception as e:
+        app.logger.exception("Error exporting images")
+        status["state"] = "failed"
+        status["error"] = str(e)
+    status["finished_at"] = time.time()
+    memcache().set(_EXPORT_STATUS_KEY, json.dumps(status))
+
+
+def start_export():
+    """画像の書き出しをバックグラウンドで始める。このプロセスで実行中ならFalse"""
+    global _export_thread
+    with _export_lock:
+        if _export_thread is not None and _export_thread.is_alive():
+            return False
+        _export_thread = threading.Thread(target=run_export, name="export-images", daemon=True)
+        _export_thread.start()
+        return True
 
 
 # endpoints
@@ -341,22 +1923,40 @@ def nl2br(eval_ctx, value):
 @app.route("/initialize")
 def get_initialize():
     db_initialize()
+    timeline().load()
+    invalidate_fragments()
+    # 組み立て済み投稿データは世代を進めるだけ。読まれたものから作り直す（先頭のページはウォームアップが作る）
+    invalidate_post_cache()
+    invalidation().bump("global", "users")
     
     # 既存の画像保存ディレクトリの中身を削除
-    upload_image_dir = "/home/isucon/upload_images"
+    # 初期データの画像は次回アクセス時にget_imageが書き出し直す
+    upload_image_dir = config()["image"]["dir"]
+    os.makedirs(upload_image_dir, exist_ok=True)
     # ディレクトリ内のファイルを削除（画像ファイルのみ想定）
+    # objects/ のblobは参照が消えたものだけ消す
     for filename in os.listdir(upload_image_dir):
         file_path = os.path.join(upload_image_dir, filename)
-        os.remove(file_path)
-    app.logger.info(f"Cleared contents of upload image directory: {upload_image_dir}")
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+    removed = gc_image_blobs()
+    app.logger.info(f"Cleared contents of upload image directory: {upload_image_dir} ({removed} blobs)")
     
     # publicディレクトリも念のため作成
     public_image_dir = pathlib.Path(__file__).resolve().parent.parent / "public" / "images"
     public_image_dir.mkdir(exist_ok=True)
-    
+
+    # 画像ファイルとキャッシュはバックグラウンドで温める。進み具合は/initialize/statusで見る
+    if config()["warmup"]["enabled"]:
+        start_warmup()
     return ""
 
 
+@app.route("/initialize/status")
+def get_initialize_status():
+    return flask.jsonify(warmup_status())
+
+
 @app.route("/login")
 def get_login():
     if get_session_user():
@@ -372,7 +1972,7 @@ def post_login():
     user = try_login(flask.request.form["account_name"], flask.request.form["password"])
     if user:
         flask.session["user"] = {"id": user["id"]}
-        flask.session["user_data"] = user  # ユーザー情報をキャッシュ
+        store_user_snapshot(user)  # ユーザー情報をキャッシュ
         flask.session["csrf_token"] = os.urandom(8).hex()
         return flask.redirect("/")
 
@@ -400,15 +2000,14 @@ def post_register():
         )
         return flask.redirect("/register")
 
-    cursor = db().cursor()
-    cursor.execute("SELECT 1 FROM users WHERE `account_name` = %s", (account_name,))
-    user = cursor.fetchone()
-    if user:
+    if get_user_by_account_name(account_name):
         flask.flash("アカウント名がすでに使われています")
         return flask.redirect("/register")
 
+    cursor = db().cursor()
     query = "INSERT INTO `users` (`account_name`, `passhash`) VALUES (%s, %s)"
     cursor.execute(query, (account_name, calculate_passhash(account_name, password)))
+    invalidate_user_cache([cursor.lastrowid])
 
     flask.session["user"] = {"id": cursor.lastrowid}
     flask.session["csrf_token"] = os.urandom(8).hex()
@@ -422,54 +2021,39 @@ def get_logout():
 
 
 @app.route("/")
+@cached_page
 def get_index():
     me = get_session_user()
 
-    cursor = db().cursor()
-    cursor.execute(
-        "SELECT `id`, `user_id`, `body`, `created_at`, `mime` FROM `posts` ORDER BY `created_at` DESC LIMIT %s",
-        (POSTS_PER_PAGE,)
-    )
-    posts = make_posts(cursor.fetchall())
+    posts = make_posts(recent_posts())
 
     return flask.render_template("index.html", posts=posts, me=me)
 
 
 @app.route("/@<account_name>")
+@cached_page
 def get_user_list(account_name):
-    cursor = db().cursor()
-
-    cursor.execute(
-        "SELECT * FROM `users` WHERE `account_name` = %s AND `del_flg` = 0",
-        (account_name,),
-    )
-    user = cursor.fetchone()
-    if user is None:
+    user = get_user_by_account_name(account_name)
+    if user is None or user["del_flg"]:
         flask.abort(404)
 
+    cursor = db().cursor()
+
     cursor.execute(
-        "SELECT `id`, `user_id`, `body`, `mime`, `created_at` FROM `posts` WHERE `user_id` = %s ORDER BY `created_at` DESC LIMIT %s",
+        f"SELECT {_TIMELINE_COLUMNS} FROM `posts` WHERE `user_id` = %s ORDER BY `created_at` DESC LIMIT %s",
         (user["id"], POSTS_PER_PAGE)
     )
     posts = make_posts(cursor.fetchall())
 
-    # 統計情報を効率的に取得
-    cursor.execute("""
-        SELECT 
-            COUNT(DISTINCT c.id) as comment_count,
-            COUNT(DISTINCT p.id) as post_count,
-            COUNT(DISTINCT c2.id) as commented_count
-        FROM users u
-        LEFT JOIN comments c ON u.id = c.user_id
-        LEFT JOIN posts p ON u.id = p.user_id
-        LEFT JOIN comments c2 ON p.id = c2.post_id
-        WHERE u.id = %s
-    """, (user["id"],))
-    
-    stats = cursor.fetchone()
-    comment_count = stats["comment_count"] or 0
-    post_count = stats["post_count"] or 0
-    commented_count = stats["commented_count"] or 0
+    # 統計情報はカウンタテーブルから取得
+    cursor.execute(
+        "SELECT `post_count`, `comment_count`, `commented_count` FROM `user_stats` WHERE `user_id` = %s",
+        (user["id"],),
+    )
+    stats = cursor.fetchone() or {}
+    comment_count = stats.get("comment_count", 0)
+    post_count = stats.get("post_count", 0)
+    commented_count = stats.get("commented_count", 0)
 
     me = get_session_user()
 
@@ -484,46 +2068,29 @@ def get_user_list(account_name):
     )
 
 
-def _parse_iso8601(s):
-    # http://bugs.python.org/issue15873
-    # Ignore timezone
-    m = re.match(r"(\d{4})-(\d{2})-(\d{2})[ tT](\d{2}):(\d{2}):(\d{2}).*", s)
-    if not m:
-        raise ValueError("Invlaid iso8601 format: %r" % (s,))
-    return datetime.datetime(*map(int, m.groups()))
-
-
 @app.route("/posts")
 def get_posts():
-    cursor = db().cursor()
     max_created_at = flask.request.args["max_created_at"] or None
     if max_created_at:
         max_created_at = _parse_iso8601(max_created_at)
-        cursor.execute(
-            "SELECT `id`, `user_id`, `body`, `mime`, `created_at` FROM `posts` WHERE `created_at` <= %s ORDER BY `created_at` DESC LIMIT %s",
-            (max_created_at, POSTS_PER_PAGE,),
-        )
-    else:
-        cursor.execute(
-            "SELECT `id`, `user_id`, `body`, `mime`, `created_at` FROM `posts` ORDER BY `created_at` DESC LIMIT %s",
-            (POSTS_PER_PAGE,)
-        )
-    results = cursor.fetchall()
-    posts = make_posts(results)
+    # max_idがあれば (created_at, id) のキーセットで前ページの最後の投稿の直後から返す
+    max_id = flask.request.args.get("max_id", type=int) if max_created_at else None
+    posts = make_posts(recent_posts(max_created_at, max_id))
     return flask.render_template("posts.html", posts=posts)
 
 
 @app.route("/posts/<id>")
+@cached_page
 def get_posts_id(id):
     cursor = db().cursor()
 
-    cursor.execute("SELECT * FROM `posts` WHERE `id` = %s LIMIT %s", (id, POSTS_PER_PAGE))
+    # imgdataまで読まないよう列を絞る
+    cursor.execute(f"SELECT {_TIMELINE_COLUMNS} FROM `posts` WHERE `id` = %s", (id,))
     posts = make_posts(cursor.fetchall(), all_comments=True)
     if not posts:
         flask.abort(404)
 
-    me = get_session_user()
-    return flask.render_template("post.html", post=posts[0], me=me)
+    return render_post_fragment(posts[0], all_comments=True)
 
 
 @app.route("/", methods=["POST"])
@@ -546,106 +2113,58 @@ def post_index():
         flask.flash("投稿できる画像形式はjpgとpngとgifだけです")
         return flask.redirect("/")
 
-    with tempfile.TemporaryFile() as tempf:
-        file.save(tempf)
-        tempf.flush()
-
-        if tempf.tell() > UPLOAD_LIMIT:
-            flask.flash("ファイルサイズが大きすぎます")
-            return flask.redirect("/")
+    # ファイル本体はリクエストのパース中にImageUploadStreamが一時ファイルへ書き出し済み
+    upload = file.stream
+    if upload.too_large:
+        flask.flash("ファイルサイズが大きすぎます")
+        return flask.redirect("/")
 
-        tempf.seek(0)
-        imgdata = tempf.read()
+    digest = upload.commit()
 
     app.logger.debug("%s", me)
-    query = "INSERT INTO `posts` (`user_id`, `mime`, `imgdata`, `body`) VALUES (%s,%s,%s,%s)"
+    # 画像本体はファイルに置き、DBには参照だけを記録する
+    # 本文のHTMLもここで作って保存しておく
+    body = flask.request.form.get("body")
+    query = "INSERT INTO `posts` (`user_id`, `mime`, `imgdata`, `body`, `body_html`) VALUES (%s,%s,%s,%s,%s)"
     cursor = db().cursor()
-    cursor.execute(query, (me["id"], mime, imgdata, flask.request.form.get("body")))
+    cursor.execute(query, (me["id"], mime, b"", body, render_body(body)))
     pid = cursor.lastrowid
+    cursor.execute(
+        "INSERT INTO `post_images` (`post_id`, `sha256`, `size`) VALUES (%s, %s, %s)",
+        (pid, digest, upload.size),
+    )
+    incr_post_counter(me["id"])
+    timeline_add_post(pid)
+    invalidation().bump("timeline")
+    purge_pages("/", f"/@{me['account_name']}")
     
-    # 画像をローカルファイルシステムにも保存
     try:
-        # 画像保存ディレクトリを作成
-        image_dir = "/home/isucon/upload_images"
-        os.makedirs(image_dir, exist_ok=True)
-        
-        # ファイル拡張子を決定
-        ext = ""
-        if mime == "image/jpeg":
-            ext = ".jpg"
-        elif mime == "image/png":
-            ext = ".png"
-        elif mime == "image/gif":
-            ext = ".gif"
-        
-        if ext:  # 有効な拡張子の場合のみ保存
-            # ファイルパスを作成
-            image_path = os.path.join(image_dir, f"{pid}{ext}")
-            
-            # 画像ファイルを保存
-            with open(image_path, 'wb') as f:
-                f.write(imgdata)
-            
-            app.logger.info(f"Saved image to filesystem: {image_path}")
-        
+        path = link_image_file(pid, image_ext(mime), digest)
+        app.logger.info(f"Saved image to filesystem: {path}")
     except Exception as e:
         app.logger.error(f"Error saving image to filesystem: {str(e)}")
-        # ファイルシステムへの保存が失敗してもアップロード自体は成功させる
+        # リンクに失敗してもget_imageがpost_imagesから張り直す
     
     return flask.redirect("/posts/%d" % pid)
 
 @app.route("/admin/export-images", methods=["POST"])
 def export_images():
-    """全ての画像をDBから取得してファイルシステムに保存するAPI"""
+    """全ての画像をDBから取得してファイルシステムに保存するAPI
 
-    try:
-        # 画像保存ディレクトリを作成
-        image_dir = "/tmp/images"
-        os.makedirs(image_dir, exist_ok=True)
-        
-        cursor = db().cursor()
-        cursor.execute("SELECT `id`, `mime`, `imgdata` FROM `posts` ORDER BY `id`")
-        posts = cursor.fetchall()
-        
-        exported_count = 0
-        for post in posts:
-            post_id = post["id"]
-            mime = post["mime"]
-            imgdata = post["imgdata"]
-            
-            # ファイル拡張子を決定
-            ext = ""
-            if mime == "image/jpeg":
-                ext = ".jpg"
-            elif mime == "image/png":
-                ext = ".png"
-            elif mime == "image/gif":
-                ext = ".gif"
-            else:
-                continue
-                
-            # ファイルパスを作成
-            image_path = image_dir + "/" + f"{post_id}{ext}"
-            
-            # 既にファイルが存在する場合はスキップ
-            if os.path.exists(image_path):
-                continue
-                
-            # 画像ファイルを保存
-            with open(image_path, 'wb') as f:
-                f.write(imgdata)
-            exported_count += 1
-        
-        app.logger.info(f"Exported {exported_count} images to filesystem")
-        flask.flash(f"{exported_count}個の画像をファイルシステムに保存しました")
-        
-    except Exception as e:
-        app.logger.error(f"Error exporting images: {str(e)}")
-        flask.flash("画像の保存中にエラーが発生しました")
-    
+    書き出しはバックグラウンドで進める。進み具合は/admin/export-images/statusで見る
+    """
+    if start_export():
+        flask.flash("画像のファイルシステムへの保存を始めました")
+    else:
+        flask.flash("画像の保存はすでに実行中です")
     return flask.redirect("/admin/banned")
 
 
+@app.route("/admin/export-images/status")
+def get_export_images_status():
+    return flask.jsonify(export_status())
+
+
 @app.route("/image/<id>.<ext>")
 def get_image(id, ext):
     if not id:
@@ -657,38 +2176,63 @@ def get_image(id, ext):
     except (ValueError, TypeError):
         flask.abort(404)
 
-    # Memcacheでキャッシュ確認
-    # cache_key = f"image:{id}"
-    # cached_image = memcache().get(cache_key)
-    # 
-    # if cached_image and isinstance(cached_image, dict):
-    #     # base64デコードして画像データを復元
-    #     imgdata = base64.b64decode(cached_image["imgdata"])
-    #     return flask.Response(imgdata, mimetype=cached_image["mime"])
+    # 書き出し済みならDBを見ずにファイルを返す
+    # ファイル名の拡張子はmimeから決めているので、存在すればextとmimeは一致している
+    ext = "." + ext
+    mime = _MIME_BY_EXT.get(ext)
+    if mime is None:
+        flask.abort(404)
+    validators = image_file_validators(image_path(id, ext))
+    if validators is not None:
+        if is_not_modified(flask.request, *validators, immutable=True):
+            return image_not_modified(*validators)
+        return image_response(id, ext, mime, *validators)
 
     cursor = db().cursor()
-    cursor.execute("SELECT `mime`, `imgdata` FROM `posts` WHERE `id` = %s", (id,))
+    cursor.execute(
+        "SELECT p.`mime`, p.`created_at`, i.`sha256` FROM `posts` p"
+        " LEFT JOIN `post_images` i ON i.`post_id` = p.`id` WHERE p.`id` = %s",
+        (id,),
+    )
     post = cursor.fetchone()
     
     if not post:
         flask.abort(404)
 
-    mime = post["mime"]
-    if (
-        ext == "jpg" and mime == "image/jpeg"
-        or ext == "png" and mime == "image/png"
-        or ext == "gif" and mime == "image/gif"
-    ):
-        # # 画像データをbase64エンコードしてMemcacheにキャッシュ（1時間）
-        # cache_data = {
-        #     "imgdata": base64.b64encode(post["imgdata"]).decode('utf-8'),
-        #     "mime": mime
-        # }
-        # memcache().set(cache_key, cache_data, expire=3600)
-        
-        return flask.Response(post["imgdata"], mimetype=mime)
+    if post["mime"] != mime:
+        flask.abort(404)
 
-    flask.abort(404)
+    # 投稿があってextも合っていると分かってから304を返す
+    last_modified = image_created_at(post)
+    if post["sha256"]:
+        etag = image_etag(post["sha256"])
+        if is_not_modified(flask.request, etag, last_modified, immutable=True):
+            return image_not_modified(etag, last_modified)
+        try:
+            link_image_file(id, ext, post["sha256"])
+            return image_response(id, ext, mime, etag, last_modified)
+        except FileNotFoundError:
+            # blobが消えている（ボリュームの喪失など）。imgdataが残っていればそちらから返す
+            app.logger.error(f"image blob {post['sha256']} for post {id} is missing")
+
+    cursor.execute("SELECT `imgdata` FROM `posts` WHERE `id` = %s", (id,))
+    post = cursor.fetchone()
+    if not post["imgdata"]:
+        flask.abort(404)
+    etag = image_etag(hashlib.sha256(post["imgdata"]).hexdigest())
+    if is_not_modified(flask.request, etag, last_modified, immutable=True):
+        return image_not_modified(etag, last_modified)
+    try:
+        write_image_file(id, ext, post["imgdata"])
+    except OSError as e:
+        app.logger.error(f"Error saving image to filesystem: {str(e)}")
+    return cacheable_response(
+        flask.Response(post["imgdata"], mimetype=mime),
+        etag,
+        IMMUTABLE_CACHE_CONTROL,
+        len(post["imgdata"]),
+        last_modified,
+    )
 
 
 @app.route("/comment", methods=["POST"])
@@ -710,6 +2254,23 @@ def post_comment():
     )
     cursor = db().cursor()
     cursor.execute(query, (post_id, me["id"], flask.request.form["comment"]))
+    comment_id = cursor.lastrowid
+    incr_comment_counters(post_id, me["id"])
+    invalidate_fragments(post_id)
+    invalidation().bump(f"post:{post_id}")
+    # コメント数はトップと、コメントした人・された人のユーザーページにも出る
+    pages = ["/", f"/posts/{post_id}", f"/@{me['account_name']}"]
+    cursor.execute("SELECT `user_id` FROM `posts` WHERE `id` = %s", (post_id,))
+    post = cursor.fetchone()
+    author = get_user(post["user_id"]) if post else None
+    if author:
+        pages.append(f"/@{author['account_name']}")
+    purge_pages(*pages)
+
+    # タイムライン用の最新3件には追記し、全コメントの方は読み直させる
+    cursor.execute("SELECT * FROM `comments` WHERE `id` = %s", (comment_id,))
+    append_recent_comment(post_id, cursor.fetchone())
+    memcache().delete(_post_cache_key(post_id, True))
 
     return flask.redirect("/posts/%d" % post_id)
 
@@ -746,7 +2307,27 @@ def post_banned():
 
     cursor = db().cursor()
     query = "UPDATE `users` SET `del_flg` = %s WHERE `id` = %s"
-    for id in flask.request.form.getlist("uid", type=int):
+    uids = flask.request.form.getlist("uid", type=int)
+    for id in uids:
         cursor.execute(query, (1, id))
+    invalidate_user_cache(uids)
+    add_banned_user_ids(uids)
+    invalidate_fragments()
+    invalidation().bump("users")
 
     return flask.redirect("/admin/banned")
+
+
+@app.route("/debug/queries")
+def get_debug_queries():
+    """直近のリクエストのクエリ集計。ISUCONP_QUERY_STATS=1のときだけ使える"""
+    if not config()["query_stats"]["enabled"]:
+        flask.abort(404)
+    history = list(query_history())
+    by_route = {}
+    for summary in history:
+        r = by_route.setdefault(summary["route"], {"requests": 0, "queries": 0, "db_ms": 0.0})
+        r["requests"] += 1
+        r["queries"] += summary["queries"]
+        r["db_ms"] += summary["db_ms"]
+    return flask.jsonify(routes=by_route, requests=history[::-1])
@@ -0,0 +1,731 @@
+"""asyncio版のエントリポイント
+
+app.py と同じルート・テンプレートを Quart + aiomysql + aiomcache で提供する。
+1プロセスで多数のリクエストを同時に捌けるよう、MySQLとmemcachedへのI/Oはすべてawaitする。
+
+    hypercorn app_async:app -b 0.0.0.0:8080
+
+セッションはFlask-Sessionと同じ形式（"session:<sid>" にmsgpack）でmemcachedに保存するので、
+同期版 (app:app) と混在させてもログイン状態を共有できる。ISUCONP_SESSION_BACKEND=cookieなら同期版と同じ署名付きCookie。
+同期版と共有する設定・定数・関数はcommon.pyから読む（app.pyはimportしない）。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import secrets
+import time
+
+import aiomcache
+import aiomysql
+import msgspec
+import quart
+from flask_session.base import ServerSideSession
+from markupsafe import Markup
+from quart.sessions import SessionInterface
+
+from common import (
+    IMMUTABLE_CACHE_CONTROL,
+    INVALIDATION_KEY_PREFIX,
+    POSTS_PER_PAGE,
+    UPLOAD_LIMIT,
+    WARMUP_STATUS_KEY,
+    _ADD_BODY_HTML_SQL,
+    _BODY_HTML_PENDING_SQL,
+    _BODY_HTML_PROBE_SQL,
+    _INCR_COMMENT_COUNTER_SQLS,
+    _INCR_POST_COUNTER_SQL,
+    _INITIALIZE_SQLS,
+    _MIME_BY_EXT,
+    _POST_GENERATION_KEY,
+    _TIMELINE_COLUMNS,
+    _USER_SNAPSHOT_FIELDS,
+    ImageUploadStream,
+    _parse_iso8601,
+    _post_cache_key,
+    asset_url,
+    body_html,
+    body_html_update,
+    calculate_passhash,
+    config,
+    counter_rebuild_sqls,
+    image_created_at,
+    image_etag,
+    image_ext,
+    image_file_validators,
+    image_path,
+    image_url,
+    is_not_modified,
+    link_image_file,
+    page_cache_key,
+    page_purge_key,
+    nl2br,
+    render_body,
+    set_validators,
+    static_path,
+    timeline_page_query,
+    validate_user,
+    write_image_file,
+)
+
+_pool = None
+_mc = None
+
+
+async def fetchall(query, args=None):
+    async with _pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(query, args)
+            return await cur.fetchall()
+
+
+async def fetchone(query, args=None):
+    rows = await fetchall(query, args)
+    return rows[0] if rows else None
+
+
+async def execute(query, args=None):
+    """INSERT/UPDATE用。lastrowidを返す"""
+    async with _pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(query, args)
+            return cur.lastrowid
+
+
+class MemcachedSessionInterface(SessionInterface):
+    """Flask-Sessionのmemcachedバックエンドと互換のセッション"""
+
+    key_prefix = "session:"
+    sid_length = 32
+
+    def __init__(self):
+        self.encoder = msgspec.msgpack.Encoder()
+        self.decoder = msgspec.msgpack.Decoder()
+
+    def _new_session(self):
+        return ServerSideSession(sid=secrets.token_urlsafe(self.sid_length), permanent=True)
+
+    def _store_id(self, sid):
+        return (self.key_prefix + sid).encode()
+
+    async def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return self._new_session()
+        try:
+            data = await _mc.get(self._store_id(sid))
+        except aiomcache.exceptions.ValidationException:
+            return self._new_session()
+        if data:
+            return ServerSideSession(self.decoder.decode(data), sid=sid)
+        return self._new_session()
+
+    async def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        store_id = self._store_id(session.sid)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            if session.modified:
+                await _mc.delete(store_id)
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add("Cookie")
+            return
+
+        if not (session.modified or app.config["SESSION_REFRESH_EACH_REQUEST"]):
+            return
+
+        timeout = int(app.permanent_session_lifetime.total_seconds())
+        if timeout > 2592000:  # 30日を超える場合memcachedは絶対時刻として扱う
+            timeout += int(time.time())
+        await _mc.set(store_id, self.encoder.encode(dict(session)), exptime=timeout)
+
+        if not self.should_set_cookie(app, session):
+            return
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add("Cookie")
+
+
+class Request(quart.Request):
+    def make_form_data_parser(self):
+        # 同期版のRequestと同じく、ファイルパートは画像ディレクトリの一時ファイルへ直接書き込む
+        return self.form_data_parser_class(
+            max_content_length=self.max_content_length,
+            max_form_memory_size=self.max_form_memory_size,
+            max_form_parts=self.max_form_parts,
+            cls=self.parameter_storage_class,
+            stream_factory=_image_upload_stream,
+        )
+
+
+def _image_upload_stream(total_content_length, content_type, filename=None, content_length=None):
+    return ImageUploadStream(UPLOAD_LIMIT)
+
+
+app = quart.Quart(__name__, static_folder=str(static_path), static_url_path="")
+app.request_class = Request
+if config()["session"]["backend"] == "cookie":
+    # 同期版と同じ署名付きCookieセッション（Quart標準）。同じ秘密鍵なら同期版とCookieを共有できる
+    if not config()["session"]["secret"]:
+        raise RuntimeError("ISUCONP_SESSION_SECRET is required for the cookie session backend")
+    app.secret_key = config()["session"]["secret"]
+else:
+    app.session_interface = MemcachedSessionInterface()
+app.add_template_global(image_url)
+app.add_template_global(asset_url)
+app.add_template_global(body_html)
+app.add_template_filter(nl2br)
+
+
+@app.before_serving
+async def startup():
+    global _pool, _mc
+    conf = config()["db"]
+    pool_conf = config()["db_pool"]
+    _pool = await aiomysql.create_pool(
+        host=conf["host"],
+        port=conf["port"],
+        user=conf["user"],
+        password=conf.get("passwd", ""),
+        db=conf["db"],
+        charset="utf8mb4",
+        autocommit=True,
+        cursorclass=aiomysql.DictCursor,
+        minsize=pool_conf["min_size"],
+        maxsize=pool_conf["max_size"],
+    )
+    host, port = config()["memcache"]["address"].rsplit(":", 1)
+    _mc = aiomcache.Client(host, int(port), pool_size=pool_conf["max_size"])
+
+
+@app.after_serving
+async def shutdown():
+    _pool.close()
+    await _pool.wait_closed()
+    await _mc.close()
+
+
+@app.template_global()
+async def post_fragment(post):
+    # posts.html から呼ばれる。同期版と同じくpost.htmlを投稿ごとに描画する
+    template = app.jinja_env.get_template("post.html")
+    return Markup(await template.render_async(post=post, session=quart.session))
+
+
+async def try_login(account_name, password):
+    user = await fetchone(
+        "SELECT * FROM users WHERE account_name = %s AND del_flg = 0", (account_name,)
+    )
+    if not user:
+        return None
+
+    is_new_user = user["passhash"].find("NEWUSER") == 0
+    if user["passhash"] == calculate_passhash(user["account_name"], password, is_new_user):
+        return user
+    return None
+
+
+async def get_session_user():
+    user = quart.session.get("user")
+    if user:
+        return await fetchone("SELECT * FROM `users` WHERE `id` = %s", (user["id"],))
+    return None
+
+
+async def get_users(user_ids):
+    if not user_ids:
+        return {}
+    rows = await fetchall("SELECT * FROM `users` WHERE `id` IN %s", (list(user_ids),))
+    return {user["id"]: user for user in rows}
+
+
+async def make_posts(results, all_comments=False):
+    if not results:
+        return []
+
+    post_ids = [post["id"] for post in results]
+    users_dict, count_rows = await asyncio.gather(
+        get_users({post["user_id"] for post in results}),
+        fetchall(
+            "SELECT `post_id`, `comment_count` FROM `post_stats` WHERE `post_id` IN %s",
+            (post_ids,),
+        ),
+    )
+    comment_counts = {row["post_id"]: row["comment_count"] for row in count_rows}
+
+    if all_comments:
+        comment_rows = await fetchall(
+            "SELECT * FROM comments WHERE post_id IN %s ORDER BY post_id, created_at DESC",
+            (post_ids,),
+        )
+    else:
+        comment_rows = await fetchall("""
+            SELECT * FROM (
+                SELECT c.*,
+                       ROW_NUMBER() OVER (PARTITION BY post_id ORDER BY created_at DESC) as rn
+                FROM comments c
+                WHERE post_id IN %s
+            ) ranked
+            WHERE rn <= 3
+            ORDER BY post_id, created_at DESC
+        """, (post_ids,))
+
+    comments_by_post = {}
+    for comment in comment_rows:
+        comments_by_post.setdefault(comment["post_id"], []).append(comment)
+    comment_users_dict = await get_users({c["user_id"] for c in comment_rows})
+
+    posts = []
+    for post in results:
+        post["comment_count"] = comment_counts.get(post["id"], 0)
+        post["user"] = users_dict.get(post["user_id"])
+        if not post["user"]:
+            continue
+
+        comments = comments_by_post.get(post["id"], [])
+        for comment in comments:
+            comment["user"] = comment_users_dict.get(comment["user_id"])
+        if not all_comments:
+            comments.reverse()
+        post["comments"] = comments
+
+        if not post["user"]["del_flg"]:
+            posts.append(post)
+        if len(posts) >= POSTS_PER_PAGE:
+            break
+    return posts
+
+
+async def generations(*namespaces):
+    """無効化バスの世代番号（strかNone）をまとめて読む"""
+    keys = [(INVALIDATION_KEY_PREFIX + namespace).encode() for namespace in namespaces]
+    return tuple(v.decode() if v is not None else None for v in await _mc.multi_get(*keys))
+
+
+# BANされたユーザーのid。読んだときのglobalとusersの世代番号と組で持ち、世代が進んでいたら読み直す。
+# 読んでいる間にBANされても、次の呼び出しでは世代が変わっているので古い集合は使われない
+_banned_user_ids = (None, frozenset())
+
+
+async def banned_user_ids():
+    global _banned_user_ids
+    generation = await generations("global", "users")
+    if _banned_user_ids[0] != generation:
+        rows = await fetchall("SELECT `id` FROM `users` WHERE `del_flg` = 1")
+        _banned_user_ids = (generation, frozenset(row["id"] for row in rows))
+    return _banned_user_ids[1]
+
+
+async def recent_posts(max_created_at=None, max_id=None):
+    """app.recent_postsと同じ。BANされたユーザーの投稿を除いて、ちょうどPOSTS_PER_PAGE件を (created_at, id) で区切って返す"""
+    banned = await banned_user_ids()
+    posts = []
+    while len(posts) < POSTS_PER_PAGE:
+        rows = await fetchall(*timeline_page_query(max_created_at, max_id))
+        posts.extend(row for row in rows if row["user_id"] not in banned)
+        if len(rows) < POSTS_PER_PAGE:
+            break
+        max_created_at, max_id = rows[-1]["created_at"], rows[-1]["id"]
+    return posts[:POSTS_PER_PAGE]
+
+
+def _clear_upload_dir():
+    upload_image_dir = config()["image"]["dir"]
+    os.makedirs(upload_image_dir, exist_ok=True)
+    for filename in os.listdir(upload_image_dir):
+        file_path = os.path.join(upload_image_dir, filename)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+
+async def bump(*namespaces):
+    """InvalidationBus.bumpと同じ。同期版と混在させたときに、同期版ワーカーの手元のキャッシュを無効にする"""
+    for namespace in namespaces:
+        key = (INVALIDATION_KEY_PREFIX + namespace).encode()
+        if await _mc.incr(key, 1) is None and not await _mc.add(key, b"1"):
+            await _mc.incr(key, 1)
+
+
+async def purge_pages(*paths):
+    """app.purge_pagesと同じキーを消す。世代番号は手元に持っていないのでmemcachedから読む"""
+    generation = await generations("global", "users")
+    for path in paths:
+        key = page_purge_key(path).encode()
+        if await _mc.incr(key, 1) is None and not await _mc.add(key, b"1"):
+            await _mc.incr(key, 1)
+        await _mc.delete(page_cache_key(path, *generation).encode())
+
+
+# endpoints
+
+
+@app.route("/initialize")
+async def get_initialize():
+    for q in _INITIALIZE_SQLS:
+        await execute(q)
+    try:
+        await execute(_BODY_HTML_PROBE_SQL)
+    except aiomysql.OperationalError:
+        await execute(_ADD_BODY_HTML_SQL)
+    last_id = 0
+    while rows := await fetchall(_BODY_HTML_PENDING_SQL, (last_id, 500)):
+        await execute(*body_html_update(rows))
+        last_id = rows[-1]["id"]
+    for q in counter_rebuild_sqls():
+        await execute(q)
+    await asyncio.to_thread(_clear_upload_dir)
+    # 同期版がmemcachedに置いた組み立て済み投稿データを無効にする
+    if await _mc.incr(_POST_GENERATION_KEY.encode(), 1) is None:
+        await _mc.set(_POST_GENERATION_KEY.encode(), b"1")
+    await bump("global", "users")
+    # ウォームアップはしない（プロセス内のキャッシュを持たない）。前回の状態が残らないよう消しておく
+    await _mc.delete(WARMUP_STATUS_KEY.encode())
+    return ""
+
+
+@app.route("/initialize/status")
+async def get_initialize_status():
+    """同期版と同じ。同期版のワーカーが温めていればその状態を返す"""
+    value = await _mc.get(WARMUP_STATUS_KEY.encode())
+    return json.loads(value) if value else {"state": "idle"}
+
+
+@app.route("/login")
+async def get_login():
+    if await get_session_user():
+        return quart.redirect("/")
+    return await quart.render_template("login.html", me=None)
+
+
+@app.route("/login", methods=["POST"])
+async def post_login():
+    if await get_session_user():
+        return quart.redirect("/")
+
+    form = await quart.request.form
+    user = await try_login(form["account_name"], form["password"])
+    if user:
+        quart.session["user"] = {"id": user["id"]}
+        # passhashなどを持ち回らないよう同期版と同じ項目だけ入れる（versionは同期版のプロセス内の値なので付けない）
+        quart.session["user_data"] = {k: user[k] for k in _USER_SNAPSHOT_FIELDS}
+        quart.session["csrf_token"] = os.urandom(8).hex()
+        return quart.redirect("/")
+
+    await quart.flash("アカウント名かパスワードが間違っています")
+    return quart.redirect("/login")
+
+
+@app.route("/register")
+async def get_register():
+    if await get_session_user():
+        return quart.redirect("/")
+    return await quart.render_template("register.html", me=None)
+
+
+@app.route("/register", methods=["POST"])
+async def post_register():
+    if await get_session_user():
+        return quart.redirect("/")
+
+    form = await quart.request.form
+    account_name = form["account_name"]
+    password = form["password"]
+    if not validate_user(account_name, password):
+        await quart.flash(
+            "アカウント名は3文字以上、パスワードは6文字以上である必要があります"
+        )
+        return quart.redirect("/register")
+
+    if await fetchone("SELECT 1 FROM users WHERE `account_name` = %s", (account_name,)):
+        await quart.flash("アカウント名がすでに使われています")
+        return quart.redirect("/register")
+
+    user_id = await execute(
+        "INSERT INTO `users` (`account_name`, `passhash`) VALUES (%s, %s)",
+        (account_name, calculate_passhash(account_name, password)),
+    )
+    quart.session["user"] = {"id": user_id}
+    quart.session["csrf_token"] = os.urandom(8).hex()
+    return quart.redirect("/")
+
+
+@app.route("/logout")
+async def get_logout():
+    quart.session.clear()
+    return quart.redirect("/")
+
+
+@app.route("/")
+async def get_index():
+    me, results = await asyncio.gather(get_session_user(), recent_posts())
+    posts = await make_posts(results)
+    return await quart.render_template("index.html", posts=posts, me=me)
+
+
+@app.route("/@<account_name>")
+async def get_user_list(account_name):
+    user = await fetchone(
+        "SELECT * FROM `users` WHERE `account_name` = %s AND `del_flg` = 0",
+        (account_name,),
+    )
+    if user is None:
+        quart.abort(404)
+
+    results, stats, me = await asyncio.gather(
+        fetchall(
+            f"SELECT {_TIMELINE_COLUMNS} FROM `posts` WHERE `user_id` = %s ORDER BY `created_at` DESC LIMIT %s",
+            (user["id"], POSTS_PER_PAGE),
+        ),
+        fetchone(
+            "SELECT `post_count`, `comment_count`, `commented_count` FROM `user_stats` WHERE `user_id` = %s",
+            (user["id"],),
+        ),
+        get_session_user(),
+    )
+    posts = await make_posts(results)
+    stats = stats or {}
+
+    return await quart.render_template(
+        "user.html",
+        posts=posts,
+        user=user,
+        post_count=stats.get("post_count", 0),
+        comment_count=stats.get("comment_count", 0),
+        commented_count=stats.get("commented_count", 0),
+        me=me,
+    )
+
+
+@app.route("/posts")
+async def get_posts():
+    max_created_at = quart.request.args["max_created_at"] or None
+    if max_created_at:
+        max_created_at = _parse_iso8601(max_created_at)
+    # max_idがあれば (created_at, id) のキーセットで前ページの最後の投稿の直後から返す
+    max_id = quart.request.args.get("max_id", type=int) if max_created_at else None
+    posts = await make_posts(await recent_posts(max_created_at, max_id))
+    return await quart.render_template("posts.html", posts=posts)
+
+
+@app.route("/posts/<id>")
+async def get_posts_id(id):
+    results = await fetchall(
+        f"SELECT {_TIMELINE_COLUMNS} FROM `posts` WHERE `id` = %s", (id,)
+    )
+    posts = await make_posts(results, all_comments=True)
+    if not posts:
+        quart.abort(404)
+    return await quart.render_template("post.html", post=posts[0])
+
+
+@app.route("/", methods=["POST"])
+async def post_index():
+    me = await get_session_user()
+    if not me:
+        return quart.redirect("/login")
+
+    form = await quart.request.form
+    if form["csrf_token"] != quart.session["csrf_token"]:
+        quart.abort(422)
+
+    file = (await quart.request.files).get("file")
+    if not file:
+        await quart.flash("画像が必要です")
+        return quart.redirect("/")
+
+    mime = file.mimetype
+    if mime not in _MIME_BY_EXT.values():
+        await quart.flash("投稿できる画像形式はjpgとpngとgifだけです")
+        return quart.redirect("/")
+
+    # ファイル本体はフォームのパース中にImageUploadStreamが一時ファイルへ書き出し済み
+    upload = file.stream
+    if upload.too_large:
+        await quart.flash("ファイルサイズが大きすぎます")
+        return quart.redirect("/")
+
+    # 同期版と同じく、画像本体は画像ストアに置き、DBには参照だけを記録する
+    digest = await asyncio.to_thread(upload.commit)
+    body = form.get("body")
+    pid = await execute(
+        "INSERT INTO `posts` (`user_id`, `mime`, `imgdata`, `body`, `body_html`) VALUES (%s,%s,%s,%s,%s)",
+        (me["id"], mime, b"", body, render_body(body)),
+    )
+    await execute(
+        "INSERT INTO `post_images` (`post_id`, `sha256`, `size`) VALUES (%s, %s, %s)",
+        (pid, digest, upload.size),
+    )
+    await execute(_INCR_POST_COUNTER_SQL, {"user_id": me["id"]})
+    await bump("timeline")
+    await purge_pages("/", f"/@{me['account_name']}")
+
+    try:
+        await asyncio.to_thread(link_image_file, pid, image_ext(mime), digest)
+    except OSError as e:
+        app.logger.error(f"Error saving image to filesystem: {str(e)}")
+        # リンクに失敗してもget_imageがpost_imagesから張り直す
+
+    return quart.redirect("/posts/%d" % pid)
+
+
+async def cacheable_response(resp, etag, complete_length, last_modified):
+    set_validators(resp, etag, IMMUTABLE_CACHE_CONTROL, last_modified)
+    return await resp.make_conditional(quart.request, accept_ranges=True, complete_length=complete_length)
+
+
+async def image_response(pid, ext, mime, etag, last_modified):
+    accel_prefix = config()["image"]["accel_prefix"]
+    if accel_prefix:
+        resp = quart.Response(
+            b"", mimetype=mime, headers={"X-Accel-Redirect": f"{accel_prefix}{pid}{ext}"}
+        )
+        return set_validators(resp, etag, IMMUTABLE_CACHE_CONTROL, last_modified)
+    path = image_path(pid, ext)
+    resp = await quart.send_file(path, mimetype=mime, add_etags=False)
+    return await cacheable_response(resp, etag, os.path.getsize(path), last_modified)
+
+
+def image_not_modified(etag, last_modified):
+    return set_validators(quart.Response(b"", status=304), etag, IMMUTABLE_CACHE_CONTROL, last_modified)
+
+
+@app.route("/image/<id>.<ext>")
+async def get_image(id, ext):
+    if not id:
+        return ""
+    try:
+        id = int(id)
+        if id == 0:
+            return ""
+    except (ValueError, TypeError):
+        quart.abort(404)
+
+    ext = "." + ext
+    mime = _MIME_BY_EXT.get(ext)
+    if mime is None:
+        quart.abort(404)
+    validators = await asyncio.to_thread(image_file_validators, image_path(id, ext))
+    if validators is not None:
+        if is_not_modified(quart.request, *validators, immutable=True):
+            return image_not_modified(*validators)
+        return await image_response(id, ext, mime, *validators)
+
+    post = await fetchone(
+        "SELECT p.`mime`, p.`created_at`, i.`sha256` FROM `posts` p"
+        " LEFT JOIN `post_images` i ON i.`post_id` = p.`id` WHERE p.`id` = %s",
+        (id,),
+    )
+    if not post or post["mime"] != mime:
+        quart.abort(404)
+    # 投稿があってextも合っていると分かってから304を返す
+    last_modified = image_created_at(post)
+    if post["sha256"]:
+        etag = image_etag(post["sha256"])
+        if is_not_modified(quart.request, etag, last_modified, immutable=True):
+            return image_not_modified(etag, last_modified)
+        try:
+            await asyncio.to_thread(link_image_file, id, ext, post["sha256"])
+            return await image_response(id, ext, mime, etag, last_modified)
+        except FileNotFoundError:
+            # blobが消えている。imgdataが残っていればそちらから返す
+            app.logger.error(f"image blob {post['sha256']} for post {id} is missing")
+
+    post = await fetchone("SELECT `imgdata` FROM `posts` WHERE `id` = %s", (id,))
+    if not post["imgdata"]:
+        quart.abort(404)
+    etag = image_etag(hashlib.sha256(post["imgdata"]).hexdigest())
+    if is_not_modified(quart.request, etag, last_modified, immutable=True):
+        return image_not_modified(etag, last_modified)
+
+    try:
+        await asyncio.to_thread(write_image_file, id, ext, post["imgdata"])
+    except OSError as e:
+        app.logger.error(f"Error saving image to filesystem: {str(e)}")
+    return await cacheable_response(
+        quart.Response(post["imgdata"], mimetype=mime), etag, len(post["imgdata"]), last_modified
+    )
+
+
+@app.route("/comment", methods=["POST"])
+async def post_comment():
+    me = await get_session_user()
+    if not me:
+        return quart.redirect("/login")
+
+    form = await quart.request.form
+    if form["csrf_token"] != quart.session["csrf_token"]:
+        quart.abort(422)
+
+    post_id = form["post_id"]
+    if not re.match(r"[0-9]+", post_id):
+        return "post_idは整数のみです"
+    post_id = int(post_id)
+
+    await execute(
+        "INSERT INTO `comments` (`post_id`, `user_id`, `comment`) VALUES (%s, %s, %s)",
+        (post_id, me["id"], form["comment"]),
+    )
+    for q in _INCR_COMMENT_COUNTER_SQLS:
+        await execute(q, {"post_id": post_id, "user_id": me["id"]})
+    for all_comments in (False, True):
+        await _mc.delete(_post_cache_key(post_id, all_comments).encode())
+    await bump(f"post:{post_id}")
+    pages = ["/", f"/posts/{post_id}", f"/@{me['account_name']}"]
+    author = await fetchone(
+        "SELECT u.`account_name` FROM `posts` p JOIN `users` u ON u.`id` = p.`user_id` WHERE p.`id` = %s",
+        (post_id,),
+    )
+    if author:
+        pages.append(f"/@{author['account_name']}")
+    await purge_pages(*pages)
+
+    return quart.redirect("/posts/%d" % post_id)
+
+
+@app.route("/admin/banned")
+async def get_banned():
+    me = await get_session_user()
+    if not me:
+        return quart.redirect("/login")
+
+    if me["authority"] == 0:
+        quart.abort(403)
+
+    users = await fetchall(
+        "SELECT * FROM `users` WHERE `authority` = 0 AND `del_flg` = 0 ORDER BY `created_at` DESC"
+    )
+    return await quart.render_template("banned.html", users=users, me=me)
+
+
+@app.route("/admin/banned", methods=["POST"])
+async def post_banned():
+    me = await get_session_user()
+    if not me:
+        return quart.redirect("/login")
+
+    if me["authority"] == 0:
+        quart.abort(403)
+
+    form = await quart.request.form
+    if form["csrf_token"] != quart.session["csrf_token"]:
+        quart.abort(422)
+
+    for id in form.getlist("uid", type=int):
+        await execute("UPDATE `users` SET `del_flg` = %s WHERE `id` = %s", (1, id))
+    await bump("users")
+
+    return quart.redirect("/admin/banned")
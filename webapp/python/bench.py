@@ -0,0 +1,632 @@
+"""オフラインのベンチマーク
+
+nginxやベンチマーカーを通さずに、主要な関数とルートをFlaskのtest clientで繰り返し呼び、
+レイテンシの分布と1回あたりのクエリ数を出す。
+
+    python bench.py                        # sqliteのフェイクDBと、プロセス内のフェイクmemcachedで実行
+    python bench.py --db mysql             # ISUCONP_DB_* / ISUCONP_MEMCACHED_ADDRESS の環境で実行
+    python bench.py --save bench.json      # 結果をベースラインとして保存
+    python bench.py --compare bench.json   # ベースラインと比べ、遅くなったものがあれば終了コード1
+    python bench.py --db mysql --drivers   # 主要なSQLをMySQLdbとconnector（プリペアドステートメント）で比べる
+
+--db mysql は初期データを投入済みのDBを使う。/initialize を叩くのでベンチ用のDBで動かすこと。
+"""
+
+import argparse
+import datetime
+import io
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import benchstats
+
+
+# フェイクDB
+# MySQLdbのDictCursorと同じ呼び出し方で使えるsqliteのラッパー。
+# app.pyが発行するMySQL方言のSQLを、sqliteで通る形に書き換えてから実行する。
+_FAKE_SCHEMA = [
+    """
+    CREATE TABLE `users` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `account_name` varchar(64) NOT NULL UNIQUE,
+        `passhash` varchar(128) NOT NULL,
+        `authority` tinyint NOT NULL DEFAULT 0,
+        `del_flg` tinyint NOT NULL DEFAULT 0,
+        `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE `posts` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `user_id` int NOT NULL,
+        `mime` varchar(64) NOT NULL,
+        `imgdata` blob NOT NULL,
+        `body` text NOT NULL,
+        `body_html` mediumtext,
+        `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX `idx_posts_created_at` ON `posts` (`created_at`)",
+    "CREATE INDEX `idx_posts_user_id_created_at` ON `posts` (`user_id`, `created_at`)",
+    """
+    CREATE TABLE `comments` (
+        `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+        `post_id` int NOT NULL,
+        `user_id` int NOT NULL,
+        `comment` text NOT NULL,
+        `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX `idx_comments_post_id_created_at` ON `comments` (`post_id`, `created_at`)",
+    "CREATE INDEX `idx_comments_user_id` ON `comments` (`user_id`)",
+    """
+    CREATE TABLE `post_images` (
+        `post_id` int NOT NULL PRIMARY KEY,
+        `sha256` char(64) NOT NULL,
+        `size` int NOT NULL
+    )
+    """,
+    "CREATE INDEX `idx_post_images_sha256` ON `post_images` (`sha256`)",
+    """
+    CREATE TABLE `user_stats` (
+        `user_id` int NOT NULL PRIMARY KEY,
+        `post_count` int NOT NULL DEFAULT 0,
+        `comment_count` int NOT NULL DEFAULT 0,
+        `commented_count` int NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE `post_stats` (
+        `post_id` int NOT NULL PRIMARY KEY,
+        `comment_count` int NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+sqlite3.register_adapter(datetime.datetime, lambda v: v.strftime(_TIMESTAMP_FORMAT))
+sqlite3.register_converter(
+    "timestamp", lambda v: datetime.datetime.strptime(v.decode(), _TIMESTAMP_FORMAT)
+)
+
+_NAMED_PARAM_RE = re.compile(r"%\((\w+)\)s")
+_SQL_REWRITES = [
+    (re.compile(r"^\s*TRUNCATE TABLE", re.I), "DELETE FROM"),
+    (re.compile(r"\bINSERT IGNORE\b", re.I), "INSERT OR IGNORE"),
+    (re.compile(r"\bVALUES\((`?\w+`?)\)"), r"excluded.\1"),
+]
+_ON_DUPLICATE_RE = re.compile(r"\s+ON DUPLICATE KEY UPDATE\s+", re.I)
+
+
+def _translate(query, args):
+    """MySQLdb形式のクエリと引数を、sqlite3形式に変換する"""
+    for pattern, repl in _SQL_REWRITES:
+        query = pattern.sub(repl, query)
+
+    m = _ON_DUPLICATE_RE.search(query)
+    if m:
+        head = query[: m.start()]
+        # INSERT ... SELECT の後ろにON CONFLICTを置くにはWHERE句が必要
+        if re.search(r"\bSELECT\b", head, re.I) and not re.search(r"\bWHERE\b", head, re.I):
+            head += " WHERE true"
+        query = head + " ON CONFLICT DO UPDATE SET " + query[m.end():]
+
+    if args is None:
+        return query, ()
+    if isinstance(args, dict):
+        return _NAMED_PARAM_RE.sub(r":\1", query).replace("%%", "%"), args
+
+    # IN %s に渡されたリストは (?,?,...) に展開する
+    parts = query.split("%s")
+    if len(parts) - 1 != len(args):
+        raise ValueError(f"placeholder mismatch: {query!r} {args!r}")
+    out = [parts[0]]
+    params = []
+    for arg, part in zip(args, parts[1:]):
+        if isinstance(arg, (list, tuple, set, frozenset)):
+            arg = list(arg)
+            out.append("(" + ",".join("?" * len(arg)) + ")")
+            params.extend(arg)
+        else:
+            out.append("?")
+            params.append(arg)
+        out.append(part)
+    return "".join(out).replace("%%", "%"), params
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self._cur = conn.cursor()
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def execute(self, query, args=None):
+        # スキーマはフェイクDBの作成時に作ってある
+        if re.match(r"\s*CREATE TABLE IF NOT EXISTS", query, re.I):
+            return 0
+        self._cur.execute(*_translate(query, args))
+        return self._cur.rowcount
+
+    def executemany(self, query, args):
+        for a in args:
+            self.execute(query, a)
+
+    def fetchone(self):
+        row = self._cur.fetchone()
+        return dict(row) if row is not None else None
+
+    def fetchall(self):
+        return [dict(row) for row in self._cur.fetchall()]
+
+    def fetchmany(self, size=1):
+        return [dict(row) for row in self._cur.fetchmany(size)]
+
+    def __iter__(self):
+        return (dict(row) for row in self._cur)
+
+    def close(self):
+        self._cur.close()
+
+
+class FakeConnection:
+    """プールから見える1本の接続。実体はすべて同じsqliteのインメモリDBを共有する"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self._conn)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+
+def fake_database(passhash, seed=1, users=200, posts=2000, comments=10000):
+    """ランダムな初期データを入れたsqliteのインメモリDBを作る。パスワードはuser<id>pass"""
+    conn = sqlite3.connect(
+        ":memory:",
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        isolation_level=None,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    for q in _FAKE_SCHEMA:
+        conn.execute(q)
+
+    rnd = random.Random(seed)
+    base = datetime.datetime(2016, 1, 1)
+    conn.executemany(
+        "INSERT INTO `users` (`id`, `account_name`, `passhash`, `authority`, `created_at`) VALUES (?, ?, ?, ?, ?)",
+        [
+            (
+                i,
+                f"user{i}",
+                passhash(f"user{i}", f"user{i}pass"),
+                1 if i == 1 else 0,
+                base + datetime.timedelta(minutes=i),
+            )
+            for i in range(1, users + 1)
+        ],
+    )
+    mimes = ["image/jpeg", "image/png", "image/gif"]
+    lines = ["今日のランチ", "いい天気でした", "#isucon", "また行きたい"]
+    conn.executemany(
+        "INSERT INTO `posts` (`id`, `user_id`, `mime`, `imgdata`, `body`, `created_at`) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                i,
+                rnd.randint(1, users),
+                rnd.choice(mimes),
+                os.urandom(rnd.randint(512, 4096)),
+                "\n".join(rnd.choices(lines, k=rnd.randint(1, 6))),
+                base + datetime.timedelta(days=1, seconds=i * 60),
+            )
+            for i in range(1, posts + 1)
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO `comments` (`post_id`, `user_id`, `comment`, `created_at`) VALUES (?, ?, ?, ?)",
+        [
+            (
+                post_id,
+                rnd.randint(1, users),
+                rnd.choice(lines),
+                base + datetime.timedelta(days=1, seconds=post_id * 60 + rnd.randint(1, 59)),
+            )
+            for post_id in (rnd.randint(1, posts) for _ in range(comments))
+        ],
+    )
+    return conn
+
+
+class FakeMemcache:
+    """app.pyが使うpymemcacheのメソッドだけを持つ、プロセス内のmemcached"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # key -> (value, cas)
+        self._cas = 0
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+
+    def _store(self, key, value):
+        self._cas += 1
+        self._data[key] = (self._encode(value), self._cas)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        return entry[0] if entry else default
+
+    def get_many(self, keys):
+        return {k: self._data[k][0] for k in keys if k in self._data}
+
+    def gets(self, key):
+        entry = self._data.get(key)
+        return (entry[0], str(entry[1]).encode()) if entry else (None, None)
+
+    def gets_many(self, keys):
+        return {k: self.gets(k) for k in keys if k in self._data}
+
+    def set(self, key, value, expire=0, noreply=None, flags=None):
+        with self._lock:
+            self._store(key, value)
+        return True
+
+    def set_many(self, values, expire=0, noreply=None, flags=None):
+        with self._lock:
+            for k, v in values.items():
+                self._store(k, v)
+        return []
+
+    def add(self, key, value, expire=0, noreply=None, flags=None):
+        with self._lock:
+            if key in self._data:
+                return False
+            self._store(key, value)
+        return True
+
+    def cas(self, key, value, cas, expire=0, noreply=False, flags=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if str(entry[1]).encode() != cas:
+                return False
+            self._store(key, value)
+        return True
+
+    def incr(self, key, value, noreply=False):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            n = int(entry[0]) + value
+            self._store(key, n)
+        return n
+
+    def delete(self, key, noreply=None):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def delete_many(self, keys, noreply=None):
+        with self._lock:
+            for k in keys:
+                self._data.pop(k, None)
+        return True
+
+
+# クエリ数の計測
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+
+class _CountingCursor:
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, query, args=None):
+        self._counter.count += 1
+        return self._cursor.execute(query, args)
+
+    def executemany(self, query, args):
+        self._counter.count += 1
+        return self._cursor.executemany(query, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection:
+    def __init__(self, conn, counter):
+        self._conn = conn
+        self._counter = counter
+
+    def cursor(self, *args):
+        return _CountingCursor(self._conn.cursor(*args), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# 計測
+def summarize(samples, queries):
+    return {**benchstats.latency_summary(samples), "queries": sum(queries) / len(queries)}
+
+
+def measure(fn, counter, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    queries = []
+    for _ in range(iterations):
+        before = counter.count
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+        queries.append(counter.count - before)
+    return summarize(samples, queries)
+
+
+def _request(client, method, path, expect, **kwargs):
+    res = client.open(path, method=method, **kwargs)
+    if res.status_code != expect:
+        raise RuntimeError(f"{method} {path}: expected {expect}, got {res.status_code}")
+    return res
+
+
+def _login(isu, account_name, password):
+    client = isu.app.test_client()
+    _request(
+        client, "POST", "/login", 302,
+        data={"account_name": account_name, "password": password},
+    )
+    with client.session_transaction() as session:
+        if "user" not in session:
+            raise RuntimeError(f"login failed: {account_name}")
+        csrf_token = session["csrf_token"]
+    return client, csrf_token
+
+
+def bench_cases(isu, account_name, password):
+    """(名前, 呼び出す関数) のリストを返す"""
+    import flask
+
+    client = isu.app.test_client()
+    _request(client, "GET", "/initialize", 200)
+
+    with isu.app.test_request_context():
+        posts = isu.make_posts(isu.recent_posts())
+    if not posts:
+        raise RuntimeError("no posts to benchmark")
+    post = posts[0]
+    max_created_at = posts[-1]["created_at"].isoformat()
+    author = post["user"]["account_name"]
+    image = f"/image/{post['id']}{isu.image_ext(post['mime'])}"
+
+    body = "\n".join(["今日のランチ", "", "いい天気でした", "#isucon"] * 5)
+    nl2br_template = isu.app.jinja_env.from_string("{{ body|nl2br }}")
+
+    def make_posts():
+        with isu.app.test_request_context():
+            isu.make_posts(isu.recent_posts())
+
+    def render_index():
+        with isu.app.test_request_context():
+            flask.render_template("index.html", posts=[dict(p) for p in posts], me=None)
+
+    cases = [
+        ("func:nl2br", lambda: nl2br_template.render(body=body)),
+        ("func:make_posts", make_posts),
+        ("func:render_index", render_index),
+        ("GET /", lambda: _request(client, "GET", "/", 200)),
+        ("GET /posts", lambda: _request(
+            client, "GET", "/posts", 200, query_string={"max_created_at": max_created_at}
+        )),
+        ("GET /posts/<id>", lambda: _request(client, "GET", f"/posts/{post['id']}", 200)),
+        ("GET /@<account_name>", lambda: _request(client, "GET", f"/@{author}", 200)),
+        ("GET /image/<id>.<ext>", lambda: _request(client, "GET", image, 200)),
+        ("GET /login", lambda: _request(client, "GET", "/login", 200)),
+    ]
+
+    if account_name is None:
+        logging.warning("--account is not set; skipping routes that need login")
+        return cases
+
+    me, csrf_token = _login(isu, account_name, password)
+    png = b"\x89PNG\r\n\x1a\n" + os.urandom(2048)
+    cases += [
+        ("POST /login", lambda: _login(isu, account_name, password)),
+        ("GET / (login)", lambda: _request(me, "GET", "/", 200)),
+        ("POST /comment", lambda: _request(
+            me, "POST", "/comment", 302,
+            data={"post_id": str(post["id"]), "comment": "bench", "csrf_token": csrf_token},
+        )),
+        ("POST /", lambda: _request(
+            me, "POST", "/", 302,
+            data={
+                "file": (io.BytesIO(png), "bench.png", "image/png"),
+                "body": "bench",
+                "csrf_token": csrf_token,
+            },
+            content_type="multipart/form-data",
+        )),
+    ]
+    return cases
+
+
+# ドライバ比較
+# キャッシュを通さず、make_posts・get_image・get_session_user・get_user_listが発行するSQLをそのまま流す
+_DRIVERS = ["mysqldb", "connector"]
+
+
+def driver_cases(isu):
+    cur = isu.db().cursor()
+    cur.execute(
+        f"SELECT {isu._TIMELINE_COLUMNS} FROM `posts` ORDER BY `created_at` DESC LIMIT %s",
+        (isu.POSTS_PER_PAGE,),
+    )
+    posts = cur.fetchall()
+    if not posts:
+        raise RuntimeError("no posts to benchmark")
+    post_ids = [p["id"] for p in posts]
+    user_ids = sorted({p["user_id"] for p in posts})
+    post = posts[0]
+
+    def query(sql, args):
+        def run():
+            c = isu.db().cursor()
+            c.execute(sql, args)
+            c.fetchall()
+
+        return run
+
+    return [
+        ("make_posts:details", lambda: isu.load_post_details(post_ids)),
+        ("make_posts:users", query("SELECT * FROM `users` WHERE `id` IN %s", (user_ids,))),
+        ("get_session_user", query("SELECT * FROM `users` WHERE `id` IN %s", ([post["user_id"]],))),
+        ("get_image", query(
+            "SELECT p.`mime`, i.`sha256` FROM `posts` p"
+            " LEFT JOIN `post_images` i ON i.`post_id` = p.`id` WHERE p.`id` = %s",
+            (post["id"],),
+        )),
+        ("get_user_list:posts", query(
+            f"SELECT {isu._TIMELINE_COLUMNS} FROM `posts` WHERE `user_id` = %s ORDER BY `created_at` DESC LIMIT %s",
+            (post["user_id"], isu.POSTS_PER_PAGE),
+        )),
+        ("get_user_list:stats", query(
+            "SELECT `post_count`, `comment_count`, `commented_count` FROM `user_stats` WHERE `user_id` = %s",
+            (post["user_id"],),
+        )),
+    ]
+
+
+def bench_drivers(isu, counter, args):
+    """同じSQLをドライバごとに測り、並べて出す。結果のキーは「ドライバ名 ケース名」"""
+    results = {}
+    for driver in _DRIVERS:
+        isu.config()["db_driver"]["name"] = driver
+        isu._db_pool = None  # このドライバで接続を張り直させる
+        with isu.app.app_context():
+            for name, fn in driver_cases(isu):
+                if args.filter and args.filter not in name:
+                    continue
+                results[f"{driver} {name}"] = measure(fn, counter, args.iterations, args.warmup)
+
+    a, b = _DRIVERS
+    print(f"{'name':<24} {a + ' p50':>14} {b + ' p50':>14} {'diff':>8} {a + ' p99':>14} {b + ' p99':>14}")
+    for key in results:
+        if not key.startswith(a + " "):
+            continue
+        name = key[len(a) + 1:]
+        ra, rb = results[key], results[f"{b} {name}"]
+        diff = rb["p50_ms"] / ra["p50_ms"] - 1 if ra["p50_ms"] else 0.0
+        print(
+            f"{name:<24} {ra['p50_ms']:>14.3f} {rb['p50_ms']:>14.3f} {diff:>+8.1%}"
+            f" {ra['p99_ms']:>14.3f} {rb['p99_ms']:>14.3f}"
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", choices=["fake", "mysql"], default="fake")
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("-k", "--filter", help="名前にこの文字列を含むものだけ実行する")
+    parser.add_argument("--account", help="ログインが必要なルートで使うアカウント（--db fakeではuser2）")
+    parser.add_argument("--password")
+    parser.add_argument("--drivers", action="store_true", help="ルートの代わりに主要なSQLをDBドライバごとに比べる")
+    benchstats.add_baseline_arguments(parser, "p50")
+    args = parser.parse_args(argv)
+    if args.drivers and args.db != "mysql":
+        parser.error("--drivers needs --db mysql")
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    # app.pyはimport時に設定を読むので、その前に環境を整える
+    os.environ.setdefault("ISUCONP_IMAGE_DIR", tempfile.mkdtemp(prefix="isuconp-bench-"))
+    # トレースのコストを計測に含めない
+    os.environ.setdefault("ISUCONP_TELEMETRY", "off")
+    # /initialize後のウォームアップが計測と並行して走らないようにする
+    os.environ.setdefault("ISUCONP_WARMUP", "0")
+    # 匿名のページキャッシュに当たると描画のコストが測れないので切っておく
+    os.environ.setdefault("ISUCONP_PAGE_CACHE_TTL", "0")
+    if args.db == "fake":
+        # Flask-Sessionのmemcachedを使わないようCookieセッションにする
+        os.environ["ISUCONP_SESSION_BACKEND"] = "cookie"
+        os.environ.setdefault("ISUCONP_SESSION_SECRET", "bench")
+        if args.account is None:
+            args.account, args.password = "user2", "user2pass"
+
+    import app as isu
+
+    isu.app.logger.setLevel(logging.WARNING)
+    counter = QueryCounter()
+    if args.db == "fake":
+        conn = fake_database(isu.calculate_passhash)
+        isu._mcclient = FakeMemcache()
+        connect = lambda: FakeConnection(conn)
+    else:
+        connect = isu.db_connect
+    isu.db_connect = lambda: _CountingConnection(connect(), counter)
+
+    if args.drivers:
+        results = bench_drivers(isu, counter, args)
+    else:
+        results = {}
+        for name, fn in bench_cases(isu, args.account, args.password):
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = r = measure(fn, counter, args.iterations, args.warmup)
+            print(
+                f"{name:<24} n={r['n']:<5} mean={r['mean_ms']:8.3f}ms p50={r['p50_ms']:8.3f}ms"
+                f" p90={r['p90_ms']:8.3f}ms p99={r['p99_ms']:8.3f}ms max={r['max_ms']:8.3f}ms"
+                f" queries={r['queries']:.1f}",
+                flush=True,
+            )
+
+    if args.save:
+        benchstats.save(args.save, db=args.db, iterations=args.iterations, results=results)
+
+    if args.compare:
+        baseline = benchstats.load(args.compare)
+        # ベースラインよりp50がthreshold以上遅いか、クエリ数が増えたもの
+        regressions = benchstats.compare(
+            "name",
+            results,
+            baseline["results"],
+            "p50_ms",
+            args.threshold,
+            columns=[("queries", "q")],
+            regressed=lambda r, b: r["queries"] > b["queries"],
+        )
+        return benchstats.exit_status(regressions)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""bench.pyとloadgen.pyで共有する集計・ベースラインの保存と比較"""
+
+import datetime
+import json
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+def latency_summary(samples):
+    """所要時間（秒）のリストからレイテンシの分布（ms）を出す"""
+    ms = sorted(s * 1000 for s in samples)
+    return {
+        "n": len(ms),
+        "mean_ms": sum(ms) / len(ms) if ms else 0.0,
+        "p50_ms": percentile(ms, 50),
+        "p90_ms": percentile(ms, 90),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": ms[-1] if ms else 0.0,
+    }
+
+
+def add_baseline_arguments(parser, metric):
+    """--save / --compare / --threshold を足す。metricはregressionの判定に使う指標の表示名"""
+    parser.add_argument("--save", metavar="PATH", help="結果をJSONで保存する")
+    parser.add_argument("--compare", metavar="PATH", help="保存済みの結果と比較する")
+    parser.add_argument("--threshold", type=float, default=0.2, help=f"{metric}の悪化をregressionとみなす割合")
+
+
+def save(path, **data):
+    with open(path, "w") as f:
+        json.dump(
+            {"created_at": datetime.datetime.now().isoformat(timespec="seconds"), **data},
+            f,
+            indent=2,
+            ensure_ascii=False,
+        )
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(title, results, baseline, metric, threshold, columns=(), regressed=None, width=24):
+    """ベースラインよりmetric（p50_msなど）がthreshold以上遅いか、regressed(今回, ベースライン)が真のものを返す
+
+    columnsは (キー, 見出し) のリストで、ベースラインと今回の値を並べて表示するだけの列。
+    """
+    label = metric.split("_")[0]
+    header = f"\n{title:<{width}} {'base ' + label:>9} {label:>9} {'diff':>8}"
+    for _, heading in columns:
+        header += f" {'base ' + heading:>9} {heading:>9}"
+    print(header)
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None:
+            print(f"{name:<{width}} {'-':>9} {r[metric]:>9.3f}")
+            continue
+        diff = r[metric] / b[metric] - 1 if b[metric] else 0.0
+        line = f"{name:<{width}} {b[metric]:>9.3f} {r[metric]:>9.3f} {diff:>+8.1%}"
+        for key, _ in columns:
+            line += f" {b[key]:>9.1f} {r[key]:>9.1f}"
+        if diff > threshold or (regressed is not None and regressed(r, b)):
+            regressions.append(name)
+            line += "  <- regression"
+        print(line)
+    return regressions
+
+
+def exit_status(regressions):
+    """regressionがあれば一覧を出して1を返す。main()の戻り値にする"""
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
@@ -0,0 +1,623 @@
+"""app.py（Flask）とapp_async.py（Quart）で共有する設定・定数・関数
+
+importしても接続やアプリの生成などの副作用はない。DB・memcached・フレームワークに依存するものは各アプリに置く。
+"""
+import datetime
+import hashlib
+import mimetypes
+import gzip
+import os
+import pathlib
+import re
+import tempfile
+
+from jinja2 import pass_eval_context
+from markupsafe import Markup, escape
+
+try:
+    import brotli
+except ImportError:  # 入っていなければ静的ファイルはgzipだけ作る
+    brotli = None
+
+UPLOAD_LIMIT = 10 * 1024 * 1024  # 10mb
+POSTS_PER_PAGE = 20
+
+# 無効化バスの世代番号のmemcachedキーのprefix（名前空間を後ろに付ける）
+INVALIDATION_KEY_PREFIX = "inval:v1:"
+# /initialize後のウォームアップの進み具合。どのワーカーからも読めるようmemcachedに置く
+WARMUP_STATUS_KEY = "warmup:v1:status"
+
+
+_config = None
+
+
+def config():
+    global _config
+    if _config is None:
+        _config = {
+            "db": {
+                "host": os.environ.get("ISUCONP_DB_HOST", "localhost"),
+                "port": int(os.environ.get("ISUCONP_DB_PORT", "3306")),
+                "user": os.environ.get("ISUCONP_DB_USER", "root"),
+                "db": os.environ.get("ISUCONP_DB_NAME", "isuconp"),
+            },
+            "db_driver": {
+                # "mysqldb"（テキストプロトコル）または "connector"（mysql-connector-pythonのプリペアドステートメント）
+                "name": os.environ.get("ISUCONP_DB_DRIVER", "mysqldb"),
+                # connectorで接続ごとに保持するプリペアドステートメントの数
+                "statement_cache": int(os.environ.get("ISUCONP_DB_STATEMENT_CACHE", "128")),
+            },
+            "db_pool": {
+                "min_size": int(os.environ.get("ISUCONP_DB_POOL_MIN", "1")),
+                "max_size": int(os.environ.get("ISUCONP_DB_POOL_MAX", "10")),
+                # チェックアウト待ちの上限秒数
+                "timeout": float(os.environ.get("ISUCONP_DB_POOL_TIMEOUT", "5")),
+                # この秒数以上アイドルだった接続はチェックアウト時にpingする
+                "health_check_interval": float(
+                    os.environ.get("ISUCONP_DB_POOL_HEALTH_CHECK_INTERVAL", "30")
+                ),
+            },
+            "timeline": {
+                # タイムラインインデックスに保持する投稿数の上限。これより古いページはSQLで引く
+                "max_posts": int(os.environ.get("ISUCONP_TIMELINE_MAX_POSTS", "20000")),
+            },
+            "query_stats": {
+                # "1"ならリクエストごとにクエリを集計し、X-Query-Statsヘッダ・ログ・/debug/queriesに出す
+                "enabled": os.environ.get("ISUCONP_QUERY_STATS", "0") == "1",
+                # 同じ形のクエリをこの回数以上発行したリクエストをN+1として警告する
+                "repeat_threshold": int(os.environ.get("ISUCONP_QUERY_REPEAT_THRESHOLD", "3")),
+                # このミリ秒以上かかったSELECTはEXPLAINを取る。0なら取らない
+                "explain_ms": float(os.environ.get("ISUCONP_QUERY_EXPLAIN_MS", "0")),
+                # /debug/queriesで見られる直近のリクエスト数
+                "history": int(os.environ.get("ISUCONP_QUERY_HISTORY", "200")),
+            },
+            "compress": {
+                # これ以上のサイズのHTMLレスポンスをその場でgzipして返す。0なら圧縮しない。
+                # 毎回の圧縮はCPUを食うので既定では切っておき、ページキャッシュに置くときの一度だけ圧縮する
+                "min_size": int(os.environ.get("ISUCONP_COMPRESS_MIN_SIZE", "0")),
+                # ページキャッシュに置くページのうち、gzip済みのものも一緒に入れておくサイズ。0なら入れない
+                "cached_min_size": int(os.environ.get("ISUCONP_COMPRESS_CACHED_MIN_SIZE", "2048")),
+                "level": int(os.environ.get("ISUCONP_COMPRESS_LEVEL", "5")),
+            },
+            "invalidation": {
+                # 無効化の世代番号をmemcachedへ見に行く間隔（ミリ秒）。0ならリクエストごと
+                "interval_ms": float(os.environ.get("ISUCONP_INVALIDATION_INTERVAL_MS", "0")),
+            },
+            "warmup": {
+                # "1"なら/initializeの後にバックグラウンドでキャッシュと画像ファイルを温める
+                "enabled": os.environ.get("ISUCONP_WARMUP", "1") == "1",
+                # この秒数で打ち切る
+                "deadline": float(os.environ.get("ISUCONP_WARMUP_DEADLINE", "50")),
+                # フラグメントを作っておくタイムラインのページ数
+                "pages": int(os.environ.get("ISUCONP_WARMUP_PAGES", "10")),
+                # 画像ファイルを書き出しておく投稿の数（新しい順）と並列数
+                "images": int(os.environ.get("ISUCONP_WARMUP_IMAGES", "10000")),
+                "image_workers": int(os.environ.get("ISUCONP_WARMUP_IMAGE_WORKERS", "2")),
+            },
+            "page_cache": {
+                # ログインしていないリクエストの / と /@<account_name> と /posts/<id> を丸ごとキャッシュする秒数。0なら使わない
+                "ttl": float(os.environ.get("ISUCONP_PAGE_CACHE_TTL", "1")),
+                # ttlを過ぎてからこの秒数までは、1人が作り直す間ほかのリクエストに古いページを返す
+                "stale": float(os.environ.get("ISUCONP_PAGE_CACHE_STALE", "5")),
+                # ほかのリクエストが作っているページを待つ上限（ミリ秒）。過ぎたら自分で作る
+                "wait_ms": float(os.environ.get("ISUCONP_PAGE_CACHE_WAIT_MS", "200")),
+            },
+            "fragment": {
+                # post.htmlの描画結果キャッシュのエントリ数上限
+                "max_entries": int(os.environ.get("ISUCONP_FRAGMENT_MAX_ENTRIES", "20000")),
+            },
+            "session": {
+                # "memcached"（Flask-Session）または "cookie"（署名付きCookie、ストアへのI/Oなし）
+                "backend": os.environ.get("ISUCONP_SESSION_BACKEND", "memcached"),
+                "secret": os.environ.get("ISUCONP_SESSION_SECRET"),
+            },
+            "memcache": {
+                "address": os.environ.get(
+                    "ISUCONP_MEMCACHED_ADDRESS", "127.0.0.1:11211"
+                ),
+                # 組み立て済み投稿データの有効期限（秒）
+                "post_ttl": int(os.environ.get("ISUCONP_POST_CACHE_TTL", "300")),
+            },
+            "image": {
+                "dir": os.environ.get("ISUCONP_IMAGE_DIR", "/home/isucon/upload_images"),
+                # nginxのinternal locationのprefix。空にするとアプリから直接ファイルを返す
+                "accel_prefix": os.environ.get(
+                    "ISUCONP_IMAGE_ACCEL_PREFIX", "/_upload_images/"
+                ),
+            },
+            'otel': {
+                # "off"（OTelをimportしない）/ "sampled"（一部だけトレース）/ "full"
+                'mode': os.getenv('ISUCONP_TELEMETRY', 'off'),
+                # "otlp"（OTEL_ENDPOINTへgRPC）/ "stdout" / "file"（file_pathに1行1JSONで追記）
+                'exporter': os.getenv('ISUCONP_TELEMETRY_EXPORTER', 'otlp'),
+                'endpoint': os.getenv('OTEL_ENDPOINT'),
+                'insecure': True,
+                'file_path': os.getenv('ISUCONP_TELEMETRY_FILE', '/tmp/isuconp-telemetry.jsonl'),
+                # sampledでトレースを残すリクエストの割合
+                'sample_ratio': float(os.getenv('ISUCONP_TELEMETRY_SAMPLE_RATIO', '0.01')),
+                # sampledでこのミリ秒以上かかったリクエストは割合に関係なく残す。0なら割合だけで決める
+                'slow_ms': float(os.getenv('ISUCONP_TELEMETRY_SLOW_MS', '0')),
+                'export_interval_millis': int(os.getenv('OTEL_EXPORT_INTERVAL_MS', '5000')),
+            },
+        }
+        password = os.environ.get("ISUCONP_DB_PASSWORD")
+        if password:
+            _config["db"]["passwd"] = password
+    return _config
+
+
+# 画像ストアへの参照。posts.imgdataが空の投稿はこちらを見る
+_POST_IMAGES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS `post_images` (
+        `post_id` int NOT NULL PRIMARY KEY,
+        `sha256` char(64) NOT NULL,
+        `size` int NOT NULL,
+        KEY `idx_post_images_sha256` (`sha256`)
+    ) DEFAULT CHARSET=utf8mb4
+"""
+
+_INITIALIZE_SQLS = [
+    _POST_IMAGES_SCHEMA,
+    "DELETE FROM post_images WHERE post_id > 10000",
+    "DELETE FROM users WHERE id > 1000",
+    "DELETE FROM posts WHERE id > 10000",
+    "DELETE FROM comments WHERE id > 100000",
+    "UPDATE users SET del_flg = 0",
+    "UPDATE users SET del_flg = 1 WHERE id % 50 = 0",
+]
+
+
+# 非正規化したカウンタ（user_stats / post_stats）
+_COUNTER_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS `user_stats` (
+        `user_id` int NOT NULL PRIMARY KEY,
+        `post_count` int NOT NULL DEFAULT 0,
+        `comment_count` int NOT NULL DEFAULT 0,
+        `commented_count` int NOT NULL DEFAULT 0
+    ) DEFAULT CHARSET=utf8mb4
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS `post_stats` (
+        `post_id` int NOT NULL PRIMARY KEY,
+        `comment_count` int NOT NULL DEFAULT 0
+    ) DEFAULT CHARSET=utf8mb4
+    """,
+]
+
+# カウンタの正しい値を集計するクエリ。(キー, 値) の組を返す
+_COUNTER_SOURCES = {
+    ("user_stats", "post_count"):
+        "SELECT `user_id` AS k, COUNT(*) AS v FROM `posts` GROUP BY `user_id`",
+    ("user_stats", "comment_count"):
+        "SELECT `user_id` AS k, COUNT(*) AS v FROM `comments` GROUP BY `user_id`",
+    ("user_stats", "commented_count"):
+        "SELECT p.`user_id` AS k, COUNT(*) AS v FROM `comments` c"
+        " JOIN `posts` p ON p.`id` = c.`post_id` GROUP BY p.`user_id`",
+    ("post_stats", "comment_count"):
+        "SELECT `post_id` AS k, COUNT(*) AS v FROM `comments` GROUP BY `post_id`",
+}
+_COUNTER_KEYS = {"user_stats": "user_id", "post_stats": "post_id"}
+
+
+def counter_rebuild_sqls():
+    sqls = list(_COUNTER_SCHEMA)
+    sqls.append("TRUNCATE TABLE `user_stats`")
+    sqls.append("TRUNCATE TABLE `post_stats`")
+    for (table, column), source in _COUNTER_SOURCES.items():
+        key = _COUNTER_KEYS[table]
+        sqls.append(
+            f"INSERT INTO `{table}` (`{key}`, `{column}`) SELECT k, v FROM ({source}) src"
+            f" ON DUPLICATE KEY UPDATE `{column}` = VALUES(`{column}`)"
+        )
+    return sqls
+
+
+_INCR_POST_COUNTER_SQL = (
+    "INSERT INTO `user_stats` (`user_id`, `post_count`) VALUES (%(user_id)s, 1)"
+    " ON DUPLICATE KEY UPDATE `post_count` = `post_count` + 1"
+)
+_INCR_COMMENT_COUNTER_SQLS = [
+    "INSERT INTO `post_stats` (`post_id`, `comment_count`) VALUES (%(post_id)s, 1)"
+    " ON DUPLICATE KEY UPDATE `comment_count` = `comment_count` + 1",
+    "INSERT INTO `user_stats` (`user_id`, `comment_count`) VALUES (%(user_id)s, 1)"
+    " ON DUPLICATE KEY UPDATE `comment_count` = `comment_count` + 1",
+    "INSERT INTO `user_stats` (`user_id`, `commented_count`)"
+    " SELECT `user_id`, 1 FROM `posts` WHERE `id` = %(post_id)s"
+    " ON DUPLICATE KEY UPDATE `commented_count` = `commented_count` + 1",
+]
+
+
+# 投稿本文のHTML。投稿時にrender_bodyで作ってposts.body_htmlに保存する
+_BODY_HTML_PROBE_SQL = "SELECT `body_html` FROM `posts` LIMIT 0"
+_ADD_BODY_HTML_SQL = "ALTER TABLE `posts` ADD COLUMN `body_html` mediumtext"
+_BODY_HTML_PENDING_SQL = (
+    "SELECT `id`, `body` FROM `posts` WHERE `id` > %s AND `body_html` IS NULL ORDER BY `id` LIMIT %s"
+)
+
+
+def body_html_update(rows):
+    """rowsのbody_htmlを1文で書き込むクエリと引数を返す"""
+    cases = " ".join(["WHEN %s THEN %s"] * len(rows))
+    args = [v for row in rows for v in (row["id"], render_body(row["body"]))]
+    args.append([row["id"] for row in rows])
+    return f"UPDATE `posts` SET `body_html` = CASE `id` {cases} END WHERE `id` IN %s", args
+
+
+# 画像ストア
+# /image/<id>.<ext> は初回アクセス時にDBのimgdataを画像ディレクトリへ書き出し、
+# 以降はnginxがファイルを直接返す（X-Accel-Redirect / try_files）。
+_EXT_BY_MIME = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+}
+_MIME_BY_EXT = {ext: mime for mime, ext in _EXT_BY_MIME.items()}
+
+
+def image_ext(mime):
+    return _EXT_BY_MIME.get(mime, "")
+
+
+def image_path(pid, ext, image_dir=None):
+    """extは先頭のドットを含む（例: ".jpg"）"""
+    return os.path.join(image_dir or config()["image"]["dir"], f"{pid}{ext}")
+
+
+def _write_file_atomic(path, data):
+    """一時ファイルに書いてからrenameし、書きかけのファイルを配信しないようにする"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    # mkstempは0600で作るので、別ユーザーのnginxからも読めるようにする
+    os.fchmod(fd, 0o644)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_image_file(pid, ext, imgdata, image_dir=None):
+    path = image_path(pid, ext, image_dir)
+    _write_file_atomic(path, imgdata)
+    return path
+
+
+# アップロード画像はsha256で内容アドレス化して objects/<先頭2文字>/<sha256> に1つだけ置き、
+# post_imagesに参照を記録する。<pid><ext> はそこへのハードリンクなので複製はしない
+def image_blob_path(digest):
+    return os.path.join(config()["image"]["dir"], "objects", digest[:2], digest)
+
+
+def store_image_blob(imgdata):
+    digest = hashlib.sha256(imgdata).hexdigest()
+    blob_path = image_blob_path(digest)
+    if not os.path.exists(blob_path):
+        _write_file_atomic(blob_path, imgdata)
+    return digest
+
+
+class ImageUploadStream:
+    """multipartのファイルパートを画像ディレクトリ内の一時ファイルへ直接書き込む
+
+    書き込みながらsha256とサイズを計算し、limitを超えた時点で以降のデータは捨てる。
+    commit()されずに閉じられた場合（バリデーションエラーなど）は一時ファイルを消す。
+    """
+
+    def __init__(self, limit):
+        tmp_dir = os.path.join(config()["image"]["dir"], "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=tmp_dir)
+        os.fchmod(fd, 0o644)  # 画像ストアへリンクしてnginxから配信する
+        self._file = os.fdopen(fd, "w+b")
+        self._hash = hashlib.sha256()
+        self.limit = limit
+        self.size = 0
+        self.too_large = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            self.too_large = True
+        if self.too_large:
+            return len(data)
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def commit(self):
+        """内容アドレスの位置へ移動してsha256を返す。同じ画像が既にあれば一時ファイルを捨てる"""
+        self._file.close()
+        digest = self._hash.hexdigest()
+        blob_path = image_blob_path(digest)
+        if os.path.exists(blob_path):
+            os.unlink(self.path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(self.path, blob_path)
+        self.path = None
+        return digest
+
+    def close(self):
+        self._file.close()
+        if self.path:
+            os.unlink(self.path)
+            self.path = None
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def link_image_file(pid, ext, digest, image_dir=None):
+    path = image_path(pid, ext, image_dir)
+    try:
+        os.link(image_blob_path(digest), path)
+    except FileExistsError:
+        pass
+    return path
+
+
+# HTTPキャッシュ
+# 画像と静的ファイルで共通のバリデータ処理。304かどうかはボディを用意する前に判定する
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STATIC_CACHE_CONTROL = "public, max-age=86400"
+
+
+def is_not_modified(request, etag, last_modified=None, immutable=False):
+    """If-None-Match / If-Modified-Sinceが手元の版と一致するか
+
+    Last-Modifiedを出していない（last_modifiedがNone）ならIf-Modified-Sinceは見ず、ETagだけで判定する。
+    immutable=True（画像のように版が1つしかないもの）なら、If-Modified-Sinceがあれば日時によらず304にする。
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        if immutable:
+            return True
+        if last_modified is not None:
+            return last_modified <= request.if_modified_since
+    return False
+
+
+def set_validators(resp, etag, cache_control, last_modified=None):
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = cache_control
+    return resp
+
+
+# 静的ファイル
+# 起動時にwebapp/public以下をメモリに読み込み、gzip（brotliがあればbrも）を作っておく。
+# ETagは内容のハッシュなので強いバリデータになり、asset_urlの?v=が一致すればimmutableで返す
+_COMPRESSIBLE_MIMES = {
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+    "image/vnd.microsoft.icon",
+    "image/x-icon",
+}
+
+
+class Asset:
+    def __init__(self, data, mime, last_modified):
+        self.mime = mime
+        self.last_modified = last_modified
+        self.fingerprint = hashlib.sha256(data).hexdigest()[:16]
+        # Content-Encoding -> (本体, ETag)。"identity"は無圧縮
+        self.variants = {"identity": (data, self.fingerprint)}
+        if mime.startswith("text/") or mime in _COMPRESSIBLE_MIMES:
+            compressed = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(data)
+            for encoding, body in compressed.items():
+                # ほとんど縮まないものは無圧縮で返す
+                if len(body) < len(data) * 0.9:
+                    self.variants[encoding] = (body, f"{self.fingerprint}-{encoding}")
+
+    def negotiate(self, accept_encodings):
+        """Accept-Encodingに合う中で一番小さいもののContent-Encodingを返す"""
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accept_encodings.quality(encoding) > 0:
+                return encoding
+        return "identity"
+
+
+class AssetStore:
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self._assets = {}
+
+    def load(self):
+        assets = {}
+        for path in sorted(self.root.rglob("*")):
+            # build-assetsが置いた圧縮済みファイルと書きかけのファイルは読まない
+            if not path.is_file() or path.suffix in (".gz", ".br") or path.name.startswith(".tmp-"):
+                continue
+            mime = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+            last_modified = datetime.datetime.fromtimestamp(
+                int(path.stat().st_mtime), datetime.timezone.utc
+            )
+            assets[path.relative_to(self.root).as_posix()] = Asset(path.read_bytes(), mime, last_modified)
+        self._assets = assets
+
+    def get(self, name):
+        return self._assets.get(name)
+
+    def items(self):
+        return self._assets.items()
+
+
+def image_etag(digest):
+    # 画像は投稿後に変わらないので、内容のsha256をそのまま強いバリデータにする
+    return digest[:32]
+
+
+def image_created_at(post):
+    # DATETIMEはMySQLのタイムゾーン（UTC）で入っている
+    return post["created_at"].replace(tzinfo=datetime.timezone.utc)
+
+
+# 書き出し済みファイルの (パス, inode, mtime) -> sha256。同じファイルを何度もハッシュしない
+_image_digests = {}
+_IMAGE_DIGESTS_MAX = 50000
+
+
+def image_file_validators(path):
+    """書き出し済みの画像ファイルの (ETag, Last-Modified) を返す。ファイルがなければNone
+
+    DBを見ないので、Last-Modifiedは投稿日時ではなくファイルのmtime（nginxが返すものと同じ）にする。
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (path, st.st_ino, st.st_mtime_ns)
+    digest = _image_digests.get(key)
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        if len(_image_digests) >= _IMAGE_DIGESTS_MAX:
+            _image_digests.clear()
+        _image_digests[key] = digest
+    last_modified = datetime.datetime.fromtimestamp(int(st.st_mtime), datetime.timezone.utc)
+    return image_etag(digest), last_modified
+
+
+def validate_user(account_name: str, password: str):
+    if not re.match(r"[0-9a-zA-Z]{3,}", account_name):
+        return False
+    if not re.match(r"[0-9a-zA-Z_]{6,}", password):
+        return False
+    return True
+
+
+def digest(src: str, is_new_user=False):
+    src_bytes = src.encode('utf-8')
+
+    if is_new_user:
+        hashed_str = hashlib.sha1(src_bytes).hexdigest().strip()
+        hased_str = "NEWUSER" + hased_str
+    else:
+        hased_str = hashlib.sha512(src_bytes).hexdigest().strip()
+    
+    return hased_str
+
+
+def calculate_salt(account_name: str):
+    return digest(account_name)
+
+
+def calculate_passhash(account_name: str, password: str, is_new_user=False):
+    return digest(f"{password}:{calculate_salt(account_name)}", is_new_user)
+
+
+# セッションに持たせるユーザー情報。Cookieセッションでも載せられるようpasshashなどは含めない
+_USER_SNAPSHOT_FIELDS = ("id", "account_name", "authority", "del_flg")
+
+
+# タイムラインで読む投稿ヘッダの列
+_TIMELINE_COLUMNS = "`id`, `user_id`, `body`, `body_html`, `mime`, `created_at`"
+
+
+def timeline_page_query(max_created_at, max_id):
+    """(created_at, id) の降順で、カーソルより後ろのPOSTS_PER_PAGE件を読む (SQL, 引数) を返す"""
+    if max_created_at is None:
+        where, args = "", ()
+    elif max_id is None:
+        where, args = "WHERE `created_at` <= %s", (max_created_at,)
+    else:
+        where = "WHERE `created_at` < %s OR (`created_at` = %s AND `id` < %s)"
+        args = (max_created_at, max_created_at, max_id)
+    return (
+        f"SELECT {_TIMELINE_COLUMNS} FROM `posts` {where} ORDER BY `created_at` DESC, `id` DESC LIMIT %s",
+        args + (POSTS_PER_PAGE,),
+    )
+
+
+# memcachedに置く投稿ごとの組み立て済みデータのキー。形式を変えたら_POST_CACHE_VERSIONを上げる
+_POST_CACHE_VERSION = 2
+_POST_GENERATION_KEY = f"post:v{_POST_CACHE_VERSION}:generation"
+
+
+def _post_cache_key(post_id, all_comments):
+    return f"post:v{_POST_CACHE_VERSION}:{post_id}:{'all' if all_comments else 'recent'}"
+
+
+# webapp/public
+static_path = pathlib.Path(__file__).resolve().parent.parent / "public"
+
+
+_assets = None
+
+
+def assets():
+    global _assets
+    if _assets is None:
+        store = AssetStore(static_path)
+        store.load()
+        _assets = store
+    return _assets
+
+
+def asset_url(path):
+    """静的ファイルのURLに内容のハッシュを付ける。付いていればimmutableでキャッシュさせる"""
+    asset = assets().get(path.lstrip("/"))
+    if asset is None:
+        return path
+    return f"{path}?v={asset.fingerprint}"
+
+
+def image_url(post):
+    return "/image/%s%s" % (post["id"], image_ext(post["mime"]))
+
+
+# 匿名ユーザー向けのページキャッシュのキー。無効化バスのglobalとusersの世代番号を含める
+_PAGE_CACHE_PREFIX = "page:v2:"
+
+
+def page_cache_key(path, global_generation, users_generation):
+    return f"{_PAGE_CACHE_PREFIX}{global_generation}:{users_generation}:{path}"
+
+
+def page_purge_key(path):
+    """purge_pagesのたびに進むパスごとの番号。作り直しの間にpurgeされたかをこれで見る"""
+    return f"{_PAGE_CACHE_PREFIX}purge:{path}"
+
+
+# http://flask.pocoo.org/snippets/28/
+_paragraph_re = re.compile(r"(?:\r\n|\r|\n){2,}")
+
+
+def render_body(value):
+    """本文をエスケープして段落と改行をタグにする。nl2brと同じ出力"""
+    return "\n\n".join(
+        "<p>%s</p>" % p.replace("\n", "<br>\n")
+        for p in _paragraph_re.split(escape(value))
+    )
+
+
+@pass_eval_context
+def nl2br(eval_ctx, value):
+    result = render_body(value)
+    if eval_ctx.autoescape:
+        result = Markup(result)
+    return result
+
+
+def body_html(post):
+    """保存済みのbody_htmlを出す。まだ埋まっていない投稿はその場で作る"""
+    html = post.get("body_html")
+    if html is None:
+        html = render_body(post["body"])
+    return Markup(html)
+
+
+def _parse_iso8601(s):
+    # http://bugs.python.org/issue15873
+    # Ignore timezone
+    m = re.match(r"(\d{4})-(\d{2})-(\d{2})[ tT](\d{2}):(\d{2}):(\d{2}).*", s)
+    if not m:
+        raise ValueError("Invlaid iso8601 format: %r" % (s,))
+    return datetime.datetime(*map(int, m.groups()))
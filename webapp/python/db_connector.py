@@ -0,0 +1,323 @@
+"""mysql-connector-pythonのプリペアドステートメントを使うDBバックエンド
+
+app.db_connectから、ISUCONP_DB_DRIVER=connector のときだけimportされる。
+
+MySQLdbのDictCursorと同じ呼び出し方（%s と %(name)s、IN %s へのリスト渡し）で使えるようにラップし、
+SELECT/INSERT/UPDATE/DELETE/REPLACEはサーバーサイドのプリペアドステートメント（バイナリプロトコル）で実行する。
+プリペアしたステートメントは接続ごとにSQL文字列をキーとしてLRUで持ち、同じSQLの2回目からはPREPAREを省く。
+DDLなどそれ以外の文と、プレースホルダが多すぎる文はテキストプロトコルで実行する。
+
+結果は通常executeの中で読み切る。cursor()にSSCursor系（SSDictCursorなど）を渡したときだけ、
+テキストプロトコルのunbufferedカーソルで1行ずつ読む（画像の書き出しで全行のBLOBをメモリに載せないため）。
+プリペアドステートメントのカーソルはunbufferedにできないので、こちらはプリペアしない。
+例外はMySQLdbがエラー番号から選ぶのと同じ例外クラスに詰め替えるので、app.py側のexcept節はそのまま使える。
+"""
+import collections
+import re
+
+import MySQLdb
+import MySQLdb.cursors
+import mysql.connector
+from MySQLdb.constants import CR, ER
+from mysql.connector import errors
+
+_PREPARABLE = {"SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE"}
+_VERB_RE = re.compile(r"\s*\(?\s*(\w+)")
+_NAMED_RE = re.compile(r"%\((\w+)\)s")
+# これより多いプレースホルダを持つ文はプリペアしない（body_html_updateのCASE文のような一度きりの大きな文）
+MAX_PREPARED_PARAMS = 256
+
+# MySQLdb（_mysql.cの_mysql_Exception）がエラー番号で例外クラスを選ぶ表。ここにない1000以上はOperationalError
+_ERRNO_CLASSES = {
+    CR.COMMANDS_OUT_OF_SYNC: MySQLdb.ProgrammingError,
+    ER.DB_CREATE_EXISTS: MySQLdb.ProgrammingError,
+    ER.SYNTAX_ERROR: MySQLdb.ProgrammingError,
+    ER.PARSE_ERROR: MySQLdb.ProgrammingError,
+    ER.NO_SUCH_TABLE: MySQLdb.ProgrammingError,
+    ER.WRONG_DB_NAME: MySQLdb.ProgrammingError,
+    ER.WRONG_TABLE_NAME: MySQLdb.ProgrammingError,
+    ER.FIELD_SPECIFIED_TWICE: MySQLdb.ProgrammingError,
+    ER.INVALID_GROUP_FUNC_USE: MySQLdb.ProgrammingError,
+    ER.UNSUPPORTED_EXTENSION: MySQLdb.ProgrammingError,
+    ER.TABLE_MUST_HAVE_COLUMNS: MySQLdb.ProgrammingError,
+    ER.CANT_DO_THIS_DURING_AN_TRANSACTION: MySQLdb.ProgrammingError,
+    ER.WARN_DATA_TRUNCATED: MySQLdb.DataError,
+    ER.WARN_NULL_TO_NOTNULL: MySQLdb.DataError,
+    ER.WARN_DATA_OUT_OF_RANGE: MySQLdb.DataError,
+    ER.NO_DEFAULT: MySQLdb.DataError,
+    ER.PRIMARY_CANT_HAVE_NULL: MySQLdb.DataError,
+    ER.DATA_TOO_LONG: MySQLdb.DataError,
+    ER.DATETIME_FUNCTION_OVERFLOW: MySQLdb.DataError,
+    ER.DUP_ENTRY: MySQLdb.IntegrityError,
+    ER.DUP_UNIQUE: MySQLdb.IntegrityError,
+    ER.NO_REFERENCED_ROW: MySQLdb.IntegrityError,
+    ER.NO_REFERENCED_ROW_2: MySQLdb.IntegrityError,
+    ER.ROW_IS_REFERENCED: MySQLdb.IntegrityError,
+    ER.ROW_IS_REFERENCED_2: MySQLdb.IntegrityError,
+    ER.CANNOT_ADD_FOREIGN: MySQLdb.IntegrityError,
+    ER.NO_DEFAULT_FOR_FIELD: MySQLdb.IntegrityError,
+    ER.BAD_NULL_ERROR: MySQLdb.IntegrityError,
+    ER.WARNING_NOT_COMPLETE_ROLLBACK: MySQLdb.NotSupportedError,
+    ER.NOT_SUPPORTED_YET: MySQLdb.NotSupportedError,
+    ER.FEATURE_DISABLED: MySQLdb.NotSupportedError,
+    ER.UNKNOWN_STORAGE_ENGINE: MySQLdb.NotSupportedError,
+}
+
+# エラー番号のない（connector自身が出した）例外だけはクラスで対応させる
+_ERRORS = [
+    (errors.IntegrityError, MySQLdb.IntegrityError),
+    (errors.ProgrammingError, MySQLdb.ProgrammingError),
+    (errors.DataError, MySQLdb.DataError),
+    (errors.NotSupportedError, MySQLdb.NotSupportedError),
+    (errors.InternalError, MySQLdb.InternalError),
+    (errors.OperationalError, MySQLdb.OperationalError),
+    # 接続断（2013, 2055など）はconnectorではInterfaceErrorになる。プールが張り直せるようOperationalErrorにする
+    (errors.InterfaceError, MySQLdb.OperationalError),
+]
+
+
+def _translate_error(e):
+    """connectorの例外を、MySQLdbが同じエラー番号で投げる例外にする
+
+    connectorはクラスをSQLSTATEで選ぶので、たとえば1054（Unknown column）がProgrammingErrorになるが、
+    MySQLdbではOperationalErrorになる。app.pyはMySQLdbの分類でexceptしているのでエラー番号で揃える。
+    """
+    errno = e.errno if e.errno and e.errno > 0 else None
+    if errno is not None:
+        if errno in _ERRNO_CLASSES:
+            return _ERRNO_CLASSES[errno](errno, e.msg)
+        if errno < 1000:
+            return MySQLdb.InternalError(errno, e.msg)
+        return MySQLdb.OperationalError(errno, e.msg)
+    for src, dst in _ERRORS:
+        if isinstance(e, src):
+            return dst(e.errno, e.msg)
+    return MySQLdb.DatabaseError(e.errno, e.msg)
+
+
+def expand_params(query, args):
+    """%(name)s を位置引数にし、リストやタプルの引数を (%s, %s, ...) に展開して (query, params) を返す"""
+    if isinstance(args, dict):
+        names = _NAMED_RE.findall(query)
+        query = _NAMED_RE.sub("%s", query)
+        args = [args[name] for name in names]
+    if not args:
+        return query, ()
+    if not any(isinstance(arg, (list, tuple)) for arg in args):
+        return query, tuple(args)
+
+    parts = query.split("%s")
+    if len(parts) != len(args) + 1:
+        raise MySQLdb.ProgrammingError("not all arguments converted during string formatting")
+    out = [parts[0]]
+    params = []
+    for arg, part in zip(args, parts[1:]):
+        if isinstance(arg, (list, tuple)):
+            out.append("(" + ", ".join(["%s"] * len(arg)) + ")")
+            params.extend(arg)
+        else:
+            out.append("%s")
+            params.append(arg)
+        out.append(part)
+    return "".join(out), tuple(params)
+
+
+def _row(row):
+    # バイナリプロトコルではBLOBがbytearrayで返ることがあるので、MySQLdbと同じbytesに揃える
+    return {k: bytes(v) if type(v) is bytearray else v for k, v in row.items()}
+
+
+class PreparedCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._rows = []
+        self._pos = 0
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    def execute(self, query, args=None):
+        query, params = expand_params(query, args)
+        m = _VERB_RE.match(query)
+        try:
+            if m and m.group(1).upper() in _PREPARABLE and len(params) <= MAX_PREPARED_PARAMS:
+                cur = self._conn.statement(query)
+                cur.execute(query, params)
+            else:
+                cur = self._conn.raw.cursor(dictionary=True, buffered=True)
+                cur.execute(query, params or None)
+            rows = cur.fetchall() if cur.with_rows else []
+        except errors.Error as e:
+            raise _translate_error(e) from e
+        self._rows = [_row(row) for row in rows]
+        self._pos = 0
+        self.rowcount = cur.rowcount
+        self.lastrowid = cur.lastrowid
+        self.description = cur.description
+        return self.rowcount
+
+    def executemany(self, query, seq_of_args):
+        total = 0
+        for args in seq_of_args:
+            total += self.execute(query, args)
+        self.rowcount = total
+        return total
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        self._rows = []
+
+
+class StreamingCursor:
+    """SSDictCursorの代わり。executeでは結果を読まず、fetchやイテレートのたびにサーバーから1行ずつ読む
+
+    MySQLdbのSSCursorと同じく、読み切るかcloseするまで同じ接続でほかのクエリは実行できない。
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    def execute(self, query, args=None):
+        query, params = expand_params(query, args)
+        self.close()
+        try:
+            self._cur = self._conn.raw.cursor(dictionary=True, buffered=False)
+            self._cur.execute(query, params or None)
+        except errors.Error as e:
+            raise _translate_error(e) from e
+        self.rowcount = self._cur.rowcount
+        self.lastrowid = self._cur.lastrowid
+        self.description = self._cur.description
+        return self.rowcount
+
+    def _fetch(self, fetch, *args):
+        if self._cur is None or not self._cur.with_rows:
+            return None
+        try:
+            return fetch(*args)
+        except errors.Error as e:
+            raise _translate_error(e) from e
+
+    def fetchone(self):
+        row = self._fetch(lambda: self._cur.fetchone())
+        return _row(row) if row is not None else None
+
+    def fetchmany(self, size=1):
+        return [_row(row) for row in self._fetch(lambda: self._cur.fetchmany(size)) or []]
+
+    def fetchall(self):
+        return [_row(row) for row in self._fetch(lambda: self._cur.fetchall()) or []]
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        cur, self._cur = self._cur, None
+        if cur is None:
+            return
+        try:
+            # 読み残しがあると次のクエリが「Unread result found」になるので捨ててから閉じる
+            if cur.with_rows:
+                cur.fetchall()
+            cur.close()
+        except errors.Error as e:
+            raise _translate_error(e) from e
+
+
+class PreparedConnection:
+    """MySQLdbの接続と同じように使える、プリペアドステートメントのキャッシュを持つ接続"""
+
+    def __init__(self, conn, cache_size):
+        self.raw = conn
+        self._cache_size = cache_size
+        self._statements = collections.OrderedDict()  # SQL -> プリペア済みのカーソル
+        self.prepares = 0
+
+    def statement(self, query):
+        """queryをプリペアするカーソルを返す。PREPAREは最初のexecuteで行われる"""
+        stmt = self._statements.get(query)
+        if stmt is not None:
+            self._statements.move_to_end(query)
+            return stmt
+        stmt = self.raw.cursor(prepared=True, dictionary=True)
+        self._statements[query] = stmt
+        self.prepares += 1
+        while len(self._statements) > self._cache_size:
+            # 追い出したステートメントはサーバー側でもDEALLOCATEする
+            _, old = self._statements.popitem(last=False)
+            old.close()
+        return stmt
+
+    def cursor(self, cursorclass=None):
+        if cursorclass is not None and issubclass(cursorclass, MySQLdb.cursors.CursorUseResultMixIn):
+            return StreamingCursor(self)
+        return PreparedCursor(self)
+
+    def ping(self):
+        try:
+            self.raw.ping(reconnect=False)
+        except errors.Error as e:
+            raise _translate_error(e) from e
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        try:
+            for stmt in self._statements.values():
+                stmt.close()
+            self._statements.clear()
+            self.raw.close()
+        except errors.Error as e:
+            raise _translate_error(e) from e
+
+
+def connect(conf, cache_size):
+    """app.config()["db"]（MySQLdb.connectの引数）から接続する"""
+    try:
+        conn = mysql.connector.connect(
+            host=conf["host"],
+            port=conf["port"],
+            user=conf["user"],
+            password=conf.get("passwd", ""),
+            database=conf["db"],
+            charset="utf8mb4",
+            autocommit=True,
+        )
+    except errors.Error as e:
+        raise _translate_error(e) from e
+    return PreparedConnection(conn, cache_size)
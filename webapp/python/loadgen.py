@@ -0,0 +1,550 @@
+"""シナリオを再生する負荷ツール
+
+ベンチマーカー（benchmarker/scenario.go）と同じシナリオを同じ比率で、起動済みのインスタンスに流す。
+ベンチマーカーはスコアしか出さないので、どのシナリオ・どのルートが遅いかを見るために使う。
+
+    python loadgen.py                                  # http://localhost に60秒
+    python loadgen.py -t 30 -c 2 --target http://localhost:8080
+    python loadgen.py -s comment -s post_image         # 一部のシナリオだけ
+    python loadgen.py --save load.json                 # 結果をJSONで保存する
+    python loadgen.py --compare load.json              # 保存済みの結果と比べ、遅くなったものがあれば終了コード1
+
+シナリオごとの並列数はベンチマーカーと同じ（index_more_and_more 2, load_index 2, user_and_post_page 2,
+comment 1, post_image 1, login 2, ban 1）で、-c はその倍率。開始前に /initialize を叩くので、
+ベンチ用のDBに向けて使うこと。ユーザー名と投稿する画像は benchmarker/userdata から読む。
+"""
+
+import argparse
+import datetime
+import glob
+import http.client
+import http.cookies
+import mimetypes
+import os
+import random
+import re
+import string
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+import benchstats
+
+USER_AGENT = "isuconp-loadgen"
+POSTS_PER_PAGE = 20
+_USERDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "benchmarker", "userdata")
+_ASSETS = ["/favicon.ico", "/js/timeago.min.js", "/js/main.js", "/css/style.css"]
+_JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+# ルート名
+# URLをFlaskのルールの形にまとめて集計する
+_ROUTES = [
+    (re.compile(r"^/posts/\d+$"), "/posts/<id>"),
+    (re.compile(r"^/image/\d+\.\w+$"), "/image/<id>.<ext>"),
+    (re.compile(r"^/@"), "/@<account_name>"),
+    (re.compile(r"^/(css|js|img)/|^/favicon\.ico$"), "<static>"),
+]
+
+
+def route_of(method, path):
+    path = urllib.parse.urlsplit(path).path
+    for pattern, name in _ROUTES:
+        if pattern.search(path):
+            path = name
+            break
+    return f"{method} {path}"
+
+
+# 集計
+def summarize(samples, errors, elapsed):
+    return {
+        **benchstats.latency_summary(samples),
+        "errors": errors,
+        "rps": len(samples) / elapsed if elapsed else 0.0,
+    }
+
+
+class Recorder:
+    """ルートごと・シナリオごとの所要時間とエラー数を貯める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}  # name -> ([seconds], errors)
+        self.scenarios = {}
+        self.messages = {}  # エラーメッセージ -> 回数
+
+    def _add(self, table, name, seconds, ok):
+        with self._lock:
+            samples, errors = table.get(name, ([], 0))
+            samples.append(seconds)
+            table[name] = (samples, errors + (not ok))
+
+    def route(self, name, seconds, ok):
+        self._add(self.routes, name, seconds, ok)
+
+    def scenario(self, name, seconds, ok):
+        self._add(self.scenarios, name, seconds, ok)
+
+    def error(self, message):
+        with self._lock:
+            self.messages[message] = self.messages.get(message, 0) + 1
+
+    def report(self, elapsed):
+        return {
+            "routes": {k: summarize(s, e, elapsed) for k, (s, e) in sorted(self.routes.items())},
+            "scenarios": {k: summarize(s, e, elapsed) for k, (s, e) in sorted(self.scenarios.items())},
+            "errors": dict(sorted(self.messages.items(), key=lambda kv: -kv[1])),
+        }
+
+
+# HTTP
+class ScenarioError(Exception):
+    pass
+
+
+class Session:
+    """1ユーザー分のHTTPセッション。keep-aliveの接続とCookieを持ち、リダイレクトは自分で辿る"""
+
+    def __init__(self, target, recorder):
+        url = urllib.parse.urlsplit(target)
+        self.target = target
+        self.recorder = recorder
+        self._conn_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self._netloc = url.netloc
+        self._conn = None
+        self.cookies = {}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _send(self, method, path, body, headers):
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = self._conn_class(self._netloc, timeout=30)
+            try:
+                self._conn.request(method, path, body=body, headers=headers)
+                res = self._conn.getresponse()
+                return res, res.read()
+            except (http.client.HTTPException, ConnectionError):
+                # サーバーがkeep-aliveを切っていたら1回だけ繋ぎ直す
+                self.close()
+                if attempt:
+                    raise
+
+    def request(self, method, path, data=None, files=None, expect=200, location=None):
+        """リクエストを送り、リダイレクトを辿った最後のレスポンスの (status, body) を返す
+
+        locationを指定したら、最初のレスポンスが302でそのパスに飛ぶことを確かめる。
+        """
+        headers = {"User-Agent": USER_AGENT}
+        body = None
+        if files:
+            body, headers["Content-Type"] = _multipart(data or {}, files)
+        elif data is not None:
+            body = urllib.parse.urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        while True:
+            if self.cookies:
+                headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+            name = route_of(method, path)
+            start = time.perf_counter()
+            try:
+                res, content = self._send(method, path, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                self.recorder.route(name, time.perf_counter() - start, False)
+                raise ScenarioError(f"{name}: {e.__class__.__name__}")
+            elapsed = time.perf_counter() - start
+            for value in res.headers.get_all("Set-Cookie") or []:
+                for morsel in http.cookies.SimpleCookie(value).values():
+                    self.cookies[morsel.key] = morsel.value
+
+            if location is not None:
+                ok = res.status in (302, 303) and re.search(location, _location_path(res))
+                self.recorder.route(name, elapsed, bool(ok))
+                if not ok:
+                    raise ScenarioError(f"{name}: expected redirect to {location}, got {res.status}")
+                location = None
+            elif res.status in (301, 302, 303):
+                self.recorder.route(name, elapsed, True)
+            else:
+                ok = res.status == expect
+                self.recorder.route(name, elapsed, ok)
+                if not ok:
+                    raise ScenarioError(f"{name}: expected {expect}, got {res.status}")
+                return res.status, content
+
+            method, path, body = "GET", _location_path(res), None
+            headers.pop("Content-Type", None)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, data, **kwargs):
+        return self.request("POST", path, data=data, **kwargs)
+
+
+def _location_path(res):
+    url = urllib.parse.urlsplit(res.headers.get("Location", ""))
+    return url.path + (f"?{url.query}" if url.query else "")
+
+
+def _multipart(fields, files):
+    boundary = "isuconp" + "".join(random.choices(string.ascii_letters, k=24))
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for name, (filename, mime, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {mime}\r\n\r\n".encode() + content + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+# HTML
+_IMAGE_RE = re.compile(r'<img src="([^"]+)" class="isu-image">')
+_PERMALINK_RE = re.compile(r'<a href="([^"]+)" class="isu-post-permalink">')
+_CSRF_RE = re.compile(r'name="csrf_token" value="([^"]+)"')
+_POST_ID_RE = re.compile(r'name="post_id" value="(\d+)"')
+_ACCOUNT_NAME_RE = re.compile(r'class="isu-account-name">([^<]*)<')
+
+
+def _find_all(pattern, content):
+    return pattern.findall(content.decode("utf-8", "replace"))
+
+
+def _find(pattern, content, what):
+    found = _find_all(pattern, content)
+    if not found:
+        raise ScenarioError(f"{what} not found")
+    return found[0]
+
+
+# シナリオ
+# benchmarker/scenario.goの同名の関数と同じリクエストを同じ順に送る
+class Userdata:
+    def __init__(self, path, images_glob=None):
+        with open(os.path.join(path, "names.txt")) as f:
+            names = [line.strip() for line in f if line.strip()]
+        # 50で割れる行はBANされたユーザー、残りの先頭9人が管理者
+        users = [(n, n + n) for i, n in enumerate(names, 1) if i % 50 != 0]
+        self.admins = users[:9]
+        self.users = users[9:]
+        with open(os.path.join(path, "kaomoji.txt")) as f:
+            self.sentences = [line.strip() for line in f if line.strip()] or ["isuconp"]
+        self.images = []
+        for image in sorted(glob.glob(images_glob or os.path.join(path, "img", "000*"))):
+            with open(image, "rb") as f:
+                self.images.append((os.path.basename(image), mimetypes.guess_type(image)[0], f.read()))
+        if not self.images:
+            self.images.append(("loadgen.png", "image/png", _placeholder_png()))
+
+    def user(self):
+        return random.choice(self.users)
+
+    def admin(self):
+        return random.choice(self.admins)
+
+    def sentence(self):
+        return random.choice(self.sentences)
+
+    def image(self):
+        return random.choice(self.images)
+
+
+def _placeholder_png(size=64):
+    """userdataに画像がないとき用の、毎回中身の違う小さなPNG"""
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    raw = b"".join(b"\x00" + os.urandom(size * 3) for _ in range(size))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+def load_assets(s):
+    for path in _ASSETS:
+        s.get(path)
+
+
+def load_images(s, urls):
+    for url in urls:
+        s.get(url)
+
+
+def _random_string(n):
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=n))
+
+
+def _login(s, account):
+    name, password = account
+    return s.post("/login", {"account_name": name, "password": password}, location=r"^/$")
+
+
+def index_more_and_more(s, data, deadline):
+    _, content = s.get("/")
+    load_assets(s)
+    load_images(s, _find_all(_IMAGE_RE, content))
+    offset = random.randrange(10)
+    for i in range(10):
+        max_created_at = datetime.datetime(2016, 1, 2, 11, 46, 21, tzinfo=_JST) + datetime.timedelta(
+            seconds=offset - POSTS_PER_PAGE * i
+        )
+        query = urllib.parse.urlencode({"max_created_at": max_created_at.isoformat()})
+        _, content = s.get(f"/posts?{query}")
+        load_images(s, _find_all(_IMAGE_RE, content))
+        if time.monotonic() > deadline:
+            break
+
+
+def load_index(s, data, deadline):
+    _, content = s.get("/")
+    images = _find_all(_IMAGE_RE, content)
+    load_assets(s)
+    load_images(s, images)
+    for _ in range(4):
+        s.get("/")
+        load_assets(s)
+        load_images(s, images)
+        if time.monotonic() > deadline:
+            break
+
+
+def user_and_post_page(s, data, deadline):
+    _, content = s.get(f"/@{data.user()[0]}")
+    load_assets(s)
+    load_images(s, _find_all(_IMAGE_RE, content))
+    for link in _find_all(_PERMALINK_RE, content):
+        _, content = s.get(link)
+        load_assets(s)
+        load_images(s, _find_all(_IMAGE_RE, content))
+        if time.monotonic() > deadline:
+            break
+
+
+def comment(s, data, deadline):
+    _login(s, data.user())
+    _, content = s.get(f"/@{data.user()[0]}")
+    post_ids = _find_all(_POST_ID_RE, content)
+    if not post_ids:
+        return  # 1枚も投稿がないユーザー
+    csrf_token = _find(_CSRF_RE, content, "csrf_token")
+    s.post(
+        "/comment",
+        {"post_id": post_ids[0], "comment": data.sentence(), "csrf_token": csrf_token},
+        location=rf"^/posts/{post_ids[0]}$",
+    )
+
+
+def post_image(s, data, deadline):
+    _, content = _login(s, data.user())
+    csrf_token = _find(_CSRF_RE, content, "csrf_token")
+    _, content = s.request(
+        "POST",
+        "/",
+        data={"body": data.sentence(), "csrf_token": csrf_token},
+        files={"file": data.image()},
+        location=r"^/posts/\d+$",
+    )
+    s.get(_find(_IMAGE_RE, content, "posted image"))
+
+    # 間違ったCSRFトークンでは投稿できないこと
+    s.close()
+    s.cookies.clear()
+    _login(s, data.user())
+    s.request(
+        "POST",
+        "/",
+        data={"body": _random_string(25), "csrf_token": _random_string(64)},
+        files={"file": data.image()},
+        expect=422,
+    )
+
+
+def login(s, data, deadline):
+    account = data.user()
+    _, content = _login(s, account)
+    if _find(_ACCOUNT_NAME_RE, content, "account name") != account[0]:
+        raise ScenarioError("wrong account name after login")
+    load_assets(s)
+    load_images(s, _find_all(_IMAGE_RE, content))
+    _, content = s.get("/logout")
+    if _find_all(_ACCOUNT_NAME_RE, content):
+        raise ScenarioError("account name shown after logout")
+    load_assets(s)
+    load_images(s, _find_all(_IMAGE_RE, content))
+
+    # 存在しないユーザーと間違ったパスワードではログインできないこと
+    fake = _random_string(random.randrange(10, 25))
+    for name, password in ((fake, fake), (data.user()[0], _random_string(20))):
+        s.cookies.clear()
+        s.post("/login", {"account_name": name, "password": password}, location=r"^/login$")
+
+
+def ban(s, data, deadline):
+    name, password = _random_string(25), _random_string(25)
+    _, content = s.post("/register", {"account_name": name, "password": password}, location=r"^/$")
+    csrf_token = _find(_CSRF_RE, content, "csrf_token")
+    _, content = s.request(
+        "POST",
+        "/",
+        data={"body": _random_string(15), "csrf_token": csrf_token},
+        files={"file": data.image()},
+        location=r"^/posts/\d+$",
+    )
+    image_url = _find(_IMAGE_RE, content, "posted image")
+    s.get(image_url)
+
+    admin = Session(s.target, s.recorder)
+    try:
+        _login(admin, data.admin())
+        _, content = admin.get("/admin/banned")
+        csrf_token = _find(_CSRF_RE, content, "csrf_token")
+        match = re.search(rf'value="(\d+)" data-account-name="{name}"', content.decode())
+        if match is None:
+            raise ScenarioError("registered user not on /admin/banned")
+        admin.post("/admin/banned", {"uid[]": match.group(1), "csrf_token": csrf_token}, location=r"^/admin/banned$")
+        _, content = admin.get("/")
+        if image_url in _find_all(_IMAGE_RE, content):
+            raise ScenarioError("banned user's image still on /")
+
+        # 管理者でなければ/admin/bannedに入れないこと
+        admin.close()
+        admin.cookies.clear()
+        _login(admin, data.user())
+        admin.get("/admin/banned", expect=403)
+    finally:
+        admin.close()
+
+
+# (名前, 関数, ベンチマーカーでの並列数)
+SCENARIOS = [
+    ("index_more_and_more", index_more_and_more, 2),
+    ("load_index", load_index, 2),
+    ("user_and_post_page", user_and_post_page, 2),
+    ("comment", comment, 1),
+    ("post_image", post_image, 1),
+    ("login", login, 2),
+    ("ban", ban, 1),
+]
+
+
+def run(target, data, scenarios, concurrency, duration, scenario_timeout):
+    recorder = Recorder()
+    end = time.monotonic() + duration
+
+    def worker(name, fn):
+        while time.monotonic() < end:
+            s = Session(target, recorder)
+            start = time.perf_counter()
+            ok = True
+            try:
+                fn(s, data, time.monotonic() + scenario_timeout)
+            except ScenarioError as e:
+                ok = False
+                recorder.error(f"{name}: {e}")
+            finally:
+                s.close()
+            recorder.scenario(name, time.perf_counter() - start, ok)
+
+    threads = [
+        threading.Thread(target=worker, args=(name, fn), name=f"{name}-{i}", daemon=True)
+        for name, fn, parallel in SCENARIOS
+        if name in scenarios
+        for i in range(parallel * concurrency)
+    ]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder.report(time.monotonic() - started)
+
+
+def print_table(title, table):
+    print(f"\n{title:<28} {'n':>6} {'err':>5} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, r in table.items():
+        print(
+            f"{name:<28} {r['n']:>6} {r['errors']:>5} {r['rps']:>8.1f} {r['p50_ms']:>9.2f}"
+            f" {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['max_ms']:>9.2f}"
+        )
+
+
+def compare(result, baseline, threshold):
+    """ベースラインよりp95がthreshold以上遅くなったか、エラーが出るようになったものを返す"""
+    regressions = []
+    for kind in ("scenarios", "routes"):
+        names = benchstats.compare(
+            kind,
+            result[kind],
+            baseline[kind],
+            "p95_ms",
+            threshold,
+            columns=[("rps", "rps")],
+            regressed=lambda r, b: r["errors"] and not b["errors"],
+            width=28,
+        )
+        regressions += [f"{kind}:{name}" for name in names]
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", default="http://localhost")
+    parser.add_argument("-t", "--duration", type=float, default=60, help="負荷をかける秒数")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="シナリオごとの並列数の倍率")
+    parser.add_argument(
+        "-s", "--scenario", action="append", choices=[name for name, _, _ in SCENARIOS],
+        help="このシナリオだけ流す（複数指定可）",
+    )
+    parser.add_argument("--scenario-timeout", type=float, default=10, help="ページを辿るシナリオを打ち切る秒数")
+    parser.add_argument("--userdata", default=_USERDATA)
+    parser.add_argument("--images", help="投稿する画像のglob（既定はuserdata/img/000*）")
+    parser.add_argument("--no-initialize", action="store_true", help="開始前に/initializeを叩かない")
+    parser.add_argument("--seed", type=int)
+    benchstats.add_baseline_arguments(parser, "p95")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    data = Userdata(args.userdata, args.images)
+    scenarios = args.scenario or [name for name, _, _ in SCENARIOS]
+
+    if not args.no_initialize:
+        s = Session(args.target, Recorder())
+        s.get("/initialize")
+        s.close()
+
+    result = run(args.target, data, scenarios, args.concurrency, args.duration, args.scenario_timeout)
+    print_table("scenario", result["scenarios"])
+    print_table("route", result["routes"])
+    if result["errors"]:
+        print("\nerrors")
+        for message, count in result["errors"].items():
+            print(f"{count:>6}  {message}")
+
+    if args.save:
+        benchstats.save(
+            args.save, target=args.target, duration=args.duration, concurrency=args.concurrency, **result
+        )
+
+    if args.compare:
+        return benchstats.exit_status(compare(result, benchstats.load(args.compare), args.threshold))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,14 @@
+#!/bin/sh
+# ISUCONP_SERVER_MODE=async でasyncio版 (app_async:app) をhypercornで起動する
+set -e
+
+cd "$(dirname "$0")"
+
+if [ "${ISUCONP_SERVER_MODE:-sync}" = "async" ]; then
+  exec .venv/bin/hypercorn app_async:app -b 0.0.0.0:8080 \
+    -w "${ISUCONP_WORKERS:-1}" --access-logfile - --error-logfile -
+fi
+
+exec .venv/bin/gunicorn app:app -b 0.0.0.0:8080 \
+  -w "${ISUCONP_WORKERS:-1}" --worker-class gthread --threads 8 \
+  --log-file - --access-logfile -
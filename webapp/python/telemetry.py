@@ -0,0 +1,165 @@
+"""OpenTelemetryの設定
+
+app.otel_setupから、テレメトリがoff以外のときだけimportされる。
+
+    sampled: ルートごとのレイテンシヒストグラムと、一部のリクエストのトレースを送る
+             slow_msが0なら先頭でsample_ratioの割合だけ記録する（記録しないスパンはほぼ無コスト）
+             slow_msを指定すると全スパンを記録しておき、遅かったリクエストと抽選に当たったものだけ送る
+    full:    すべてのリクエストとクエリのトレースを送る
+
+exporterは otlp（OTEL_ENDPOINTへgRPC）、stdout、file（1行1JSONで追記）から選ぶ。
+"""
+import collections
+import sys
+import threading
+import time
+
+import flask
+from opentelemetry import metrics, trace
+from opentelemetry.instrumentation.flask import FlaskInstrumentor
+from opentelemetry.instrumentation.mysql import MySQLInstrumentor
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
+from opentelemetry.sdk.metrics.view import ExplicitBucketHistogramAggregation, View
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from opentelemetry.sdk.trace.sampling import ALWAYS_ON, ParentBased, TraceIdRatioBased
+
+ROUTE_DURATION = "http.server.route.duration"
+# ms単位。ISUCONのリクエストは大半が数ms〜数十msなのでその辺りを細かく切る
+_ROUTE_DURATION_BOUNDARIES = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """ローカルのルートスパンが終わるまでトレースのスパンを溜め、残すトレースだけdelegateに渡す
+
+    ルートスパンがslow_ms以上かかったか、trace_idがratioの抽選に当たったトレースを残す。
+    ルートが終わらないまま溜まったトレースはmax_traces件を超えたら古いものから捨てる。
+    """
+
+    def __init__(self, delegate, ratio, slow_ms, max_traces=1000):
+        self._delegate = delegate
+        # TraceIdRatioBasedと同じく、trace_idの下位64bitで抽選する
+        self._bound = round(ratio * (1 << 64))
+        self._slow_ns = slow_ms * 1_000_000
+        self._max_traces = max_traces
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()  # trace_id -> [span]
+
+    def on_start(self, span, parent_context=None):
+        pass
+
+    def on_end(self, span):
+        trace_id = span.context.trace_id
+        with self._lock:
+            if span.parent is not None and not span.parent.is_remote:
+                self._pending.setdefault(trace_id, []).append(span)
+                while len(self._pending) > self._max_traces:
+                    self._pending.popitem(last=False)
+                return
+            spans = self._pending.pop(trace_id, [])
+
+        slow = span.end_time - span.start_time >= self._slow_ns
+        if slow or (trace_id & 0xFFFFFFFFFFFFFFFF) < self._bound:
+            for s in spans:
+                self._delegate.on_end(s)
+            self._delegate.on_end(span)
+
+    def shutdown(self):
+        self._delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self._delegate.force_flush(timeout_millis)
+
+
+def _exporters(conf):
+    """(span exporter, metric exporter) を返す"""
+    kind = conf["exporter"]
+    if kind == "otlp":
+        if not conf["endpoint"]:
+            raise RuntimeError("OTEL_ENDPOINT is required for the otlp telemetry exporter")
+        from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+        return (
+            OTLPSpanExporter(endpoint=conf["endpoint"], insecure=conf["insecure"]),
+            OTLPMetricExporter(endpoint=conf["endpoint"], insecure=conf["insecure"]),
+        )
+
+    if kind == "stdout":
+        out = sys.stdout
+    elif kind == "file":
+        # 複数ワーカーから追記するので行単位でフラッシュする
+        out = open(conf["file_path"], "a", buffering=1)
+    else:
+        raise RuntimeError(f"unknown telemetry exporter: {kind}")
+    return (
+        ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n"),
+        ConsoleMetricExporter(out=out, formatter=lambda data: data.to_json(indent=None) + "\n"),
+    )
+
+
+def instrument_routes(app, meter):
+    """ルート（URLルール）ごとの処理時間をヒストグラムに記録する"""
+    duration = meter.create_histogram(
+        ROUTE_DURATION, unit="ms", description="ルートごとのリクエスト処理時間"
+    )
+
+    @app.before_request
+    def start_route_timer():
+        flask.g._route_started_at = time.perf_counter()
+
+    @app.after_request
+    def record_route_duration(response):
+        started_at = flask.g.pop("_route_started_at", None)
+        if started_at is not None:
+            rule = flask.request.url_rule
+            duration.record(
+                (time.perf_counter() - started_at) * 1000,
+                {
+                    "http.route": rule.rule if rule else "<unmatched>",
+                    "http.method": flask.request.method,
+                    "http.status_code": response.status_code,
+                },
+            )
+        return response
+
+
+def setup(app, conf):
+    mode = conf["mode"]
+    if mode not in ("sampled", "full"):
+        raise RuntimeError(f"unknown telemetry mode: {mode}")
+
+    resource = Resource.create({"service.name": "isuconp"})
+    span_exporter, metric_exporter = _exporters(conf)
+
+    processor = BatchSpanProcessor(span_exporter)
+    sampler = ALWAYS_ON
+    if mode == "sampled":
+        if conf["slow_ms"] > 0:
+            processor = TailSamplingProcessor(processor, conf["sample_ratio"], conf["slow_ms"])
+        else:
+            sampler = ParentBased(TraceIdRatioBased(conf["sample_ratio"]))
+    tracer_provider = TracerProvider(resource=resource, sampler=sampler)
+    tracer_provider.add_span_processor(processor)
+    trace.set_tracer_provider(tracer_provider)
+
+    reader = PeriodicExportingMetricReader(
+        metric_exporter, export_interval_millis=conf["export_interval_millis"]
+    )
+    meter_provider = MeterProvider(
+        metric_readers=[reader],
+        resource=resource,
+        views=[
+            View(
+                instrument_name=ROUTE_DURATION,
+                aggregation=ExplicitBucketHistogramAggregation(_ROUTE_DURATION_BOUNDARIES),
+            ),
+        ],
+    )
+    metrics.set_meter_provider(meter_provider)
+
+    instrument_routes(app, metrics.get_meter("isuconp"))
+    FlaskInstrumentor().instrument_app(app)
+    MySQLInstrumentor().instrument()
@@ -0,0 +1,75 @@
+import pathlib
+import sys
+
+import pytest
+
+MySQLdb = pytest.importorskip("MySQLdb")
+pytest.importorskip("mysql.connector")
+
+from mysql.connector import errors  # noqa: E402
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+import db_connector  # noqa: E402
+
+
+def test_expand_params_positional():
+    assert db_connector.expand_params("SELECT * FROM `posts` WHERE `id` = %s", (1,)) == (
+        "SELECT * FROM `posts` WHERE `id` = %s",
+        (1,),
+    )
+
+
+def test_expand_params_list():
+    query, params = db_connector.expand_params(
+        "SELECT * FROM `posts` WHERE `user_id` = %s AND `id` IN %s", (7, [1, 2, 3])
+    )
+    assert query == "SELECT * FROM `posts` WHERE `user_id` = %s AND `id` IN (%s, %s, %s)"
+    assert params == (7, 1, 2, 3)
+
+
+def test_expand_params_named():
+    query, params = db_connector.expand_params(
+        "UPDATE `users` SET `del_flg` = %(flg)s WHERE `id` = %(id)s", {"id": 3, "flg": 1}
+    )
+    assert query == "UPDATE `users` SET `del_flg` = %s WHERE `id` = %s"
+    assert params == (1, 3)
+
+
+def test_expand_params_mismatch():
+    with pytest.raises(MySQLdb.ProgrammingError):
+        db_connector.expand_params("SELECT %s, %s", ([1, 2],))
+
+
+def test_unknown_column_is_operational_error():
+    # connectorは1054をProgrammingErrorにするが、ensure_body_html_columnはMySQLdbと同じOperationalErrorを待つ
+    e = errors.ProgrammingError(msg="Unknown column 'body_html' in 'field list'", errno=1054)
+    translated = db_connector._translate_error(e)
+    assert type(translated) is MySQLdb.OperationalError
+    assert translated.args[0] == 1054
+
+
+@pytest.mark.parametrize(
+    "errno, expected",
+    [
+        (1062, MySQLdb.IntegrityError),
+        (1146, MySQLdb.ProgrammingError),
+        (1064, MySQLdb.ProgrammingError),
+        (1406, MySQLdb.DataError),
+        (2013, MySQLdb.OperationalError),
+    ],
+)
+def test_translate_error_by_errno(errno, expected):
+    e = errors.DatabaseError(msg="error", errno=errno)
+    assert type(db_connector._translate_error(e)) is expected
+
+
+def test_translate_error_without_errno():
+    assert type(db_connector._translate_error(errors.InterfaceError(msg="gone"))) is MySQLdb.OperationalError
+
+
+def test_ss_cursor_streams():
+    conn = db_connector.PreparedConnection(None, 4)
+    assert isinstance(conn.cursor(MySQLdb.cursors.SSDictCursor), db_connector.StreamingCursor)
+    assert isinstance(conn.cursor(MySQLdb.cursors.DictCursor), db_connector.PreparedCursor)
+    assert isinstance(conn.cursor(), db_connector.PreparedCursor)